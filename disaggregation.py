@@ -0,0 +1,49 @@
+import numpy as np
+
+
+# Disaggregation of the THL and HS statistics into daily values by erva and
+# age group, used by fetch_data.py. Everything works on whole arrays: the
+# weeks, days and ervas are axes of the arrays instead of loops
+
+
+def week_days(mondays, start_date=None):
+    # Dates (YYYY-MM-DD) of the 7 days of the weeks starting on mondays, with
+    # shape (weeks, 7), and the mask of the days on or after start_date (all
+    # the days if None)
+    days = np.array(mondays, dtype='datetime64[D]')[:, np.newaxis] + np.arange(7)
+    if start_date is None:
+        keep = np.ones(days.shape, dtype=bool)
+    else:
+        keep = days >= np.datetime64(start_date, 'D')
+    return np.datetime_as_string(days, unit='D'), keep
+
+
+def weekly_to_daily(weekly_values, axis=1):
+    # Weekly counts spread evenly over the 7 days of the week. The days are a
+    # new axis inserted at axis (by default after the axis of the weeks)
+    daily_values = np.expand_dims(weekly_values/7, axis)
+    shape = list(daily_values.shape)
+    shape[axis] = 7
+    return np.broadcast_to(daily_values, shape)
+
+
+def daily_dates(first_date, last_date):
+    # All the dates (YYYY-MM-DD) from first_date to last_date
+    days = np.arange(np.datetime64(first_date, 'D'), np.datetime64(last_date, 'D') + 1)
+    return np.datetime_as_string(days, unit='D')
+
+
+def weekend_source_dates(dates):
+    # Dates with the values of each of the dates. There is no data on
+    # weekends: Saturdays use the Friday before and Sundays the Monday after
+    days = np.array(dates, dtype='datetime64[D]')
+    # 1970-01-01 was a Thursday
+    weekday = (days.astype(np.int64) + 3) % 7
+    shift = np.where(weekday == 5, -1, np.where(weekday == 6, 1, 0))
+    return np.datetime_as_string(days + shift, unit='D')
+
+
+def split_by_age(values, probs_age):
+    # Values split into age groups with the probabilities of each age group.
+    # The age groups are a new last axis
+    return values[..., np.newaxis]*probs_age
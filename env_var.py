@@ -8,6 +8,21 @@ REQUESTS = {
     'hospitalizations': "https://w3qa5ydb4l.execute-api.eu-west-1.amazonaws.com/prod/finnishCoronaHospitalData",
 }
 
+# Cache of the API responses (see http_cache.py). Modes:
+# - 'revalidate': responses younger than max_age seconds are reused, older
+#   ones are revalidated with the API (ETag/Last-Modified)
+# - 'offline': only the cached (recorded) responses are used, no requests
+# - 'disabled': every request goes to the API
+# directory None is out/http_cache. The requests time out after timeout
+# seconds and are retried retries times (connection errors and 5xx)
+HTTP_CACHE = {
+    'mode': 'revalidate',
+    'max_age': 3600,
+    'directory': None,
+    'timeout': 60,
+    'retries': 3,
+}
+
 MAPPINGS = {
     "hcd_erva": {
         'Helsinki and Uusimaa Hospital District': 'HYKS',
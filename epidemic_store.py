@@ -0,0 +1,302 @@
+import numpy as np
+import pandas as pd
+import io
+import json
+import os
+import tempfile
+from env_var import EPIDEMIC
+
+
+# Columns of the initial state of the compartments
+STATE_COLUMNS = ['susceptible',
+                 'infected',
+                 'exposed',
+                 'recovered',
+                 'vaccinated',
+                 'vaccinated no imm',
+                 'ward',
+                 'icu']
+
+
+def store_paths(csv_name):
+    # The store of epidemic_finland_9.csv is epidemic_finland_9.npy with the
+    # values and epidemic_finland_9.json with the index
+    base_name, _ = os.path.splitext(csv_name)
+    return base_name + '.npy', base_name + '.json'
+
+
+def csv_signature(csv_name):
+    # Used to detect that the CSV changed after the store was written
+    csv_stat = os.stat(csv_name)
+    return [csv_stat.st_size, csv_stat.st_mtime_ns]
+
+
+def csv_date_offsets(data, row_dates, offset=0):
+    # Positions in the file (bytes) of the first row of every date. data are
+    # the CSV rows (without the header) of the dates row_dates, written at
+    # offset. None if the rows are not sorted by date, as the updates cut the
+    # file at the first row of a date
+    row_dates = np.asarray(row_dates, dtype=str)
+    line_ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+    if len(line_ends) != len(row_dates) or np.any(row_dates[1:] < row_dates[:-1]):
+        return None
+    row_starts = np.concatenate(([0], line_ends[:-1] + 1))
+    first_rows = np.flatnonzero(np.concatenate(([True], row_dates[1:] != row_dates[:-1])))
+    return (offset + row_starts[first_rows]).tolist()
+
+
+def store_values(epidemic_state, dates, ervas, ages, columns):
+    # Values of the rows of epidemic_state with shape (dates, ervas, age
+    # groups, columns)
+    epidemic_state = epidemic_state[epidemic_state['erva'].isin(ervas)]
+    date_idx = pd.Categorical(epidemic_state['date'], categories=dates).codes
+    erva_idx = pd.Categorical(epidemic_state['erva'], categories=ervas).codes
+    age_idx = pd.Categorical(epidemic_state['age'], categories=ages).codes
+
+    values = np.zeros((len(dates), len(ervas), len(ages), len(columns)))
+    values[date_idx, erva_idx, age_idx, :] = epidemic_state[columns].values.astype(np.float64)
+    return values
+
+
+def write_array(array_name, values):
+    # Writing to a temporary file first so that parallel runs never read
+    # a partial array
+    array_dir = os.path.dirname(os.path.abspath(array_name))
+    fd, tmp_name = tempfile.mkstemp(suffix='.npy', dir=array_dir)
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, values)
+    os.replace(tmp_name, array_name)
+
+
+def write_store_index(csv_name, index):
+    # Written last: the index has the signature of the CSV the arrays
+    # correspond to
+    _, json_name = store_paths(csv_name)
+    json_dir = os.path.dirname(os.path.abspath(json_name))
+    fd, tmp_json = tempfile.mkstemp(suffix='.json', dir=json_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_json, json_name)
+
+
+def write_epidemic_store(epidemic_state, csv_name, cases=None):
+    # Writes the values of the epidemic state written to csv_name as an
+    # array of shape (dates, ervas, age groups, columns), so that the state
+    # of a single date is a contiguous block. Ervas are in the order of
+    # ervas_order (without Ahvenanmaa or Aland) and age groups in the order
+    # of the CSV. cases are the daily detected cases (ervas, ages, values)
+    # used to construct the CSV, with values of shape (dates, ervas, ages)
+    ervas_order = EPIDEMIC['ervas_order']
+    in_store = epidemic_state[epidemic_state['erva'].isin(ervas_order)]
+
+    dates = sorted(pd.unique(in_store['date']))
+    ages = list(pd.unique(in_store['age']))
+    columns = [column for column in epidemic_state.columns
+               if column not in ('date', 'erva', 'age')]
+
+    with open(csv_name, 'rb') as f:
+        header_size = len(f.readline())
+        data = f.read()
+    offsets = csv_date_offsets(data, epidemic_state['date'].values, header_size)
+    if offsets is not None and len(offsets) != len(dates):
+        offsets = None
+
+    index = {
+        'dates': dates,
+        'ervas': ervas_order,
+        'ages': ages,
+        'columns': columns,
+        'csv_offsets': offsets,
+        'csv_signature': csv_signature(csv_name),
+    }
+
+    npy_name, _ = store_paths(csv_name)
+    write_array(npy_name, store_values(epidemic_state, dates, ervas_order, ages, columns))
+    if cases is not None:
+        cases_ervas, cases_ages, cases_values = cases
+        if len(cases_values) != len(dates):
+            raise ValueError('Cases of %d dates for the %d dates of %s' % (len(cases_values),
+                                                                           len(dates),
+                                                                           csv_name))
+        write_array(cases_state_path(csv_name), np.asarray(cases_values, dtype=np.float64))
+        index['cases'] = {'ervas': list(cases_ervas), 'ages': list(cases_ages)}
+    write_store_index(csv_name, index)
+
+
+def write_epidemic_state(epidemic_state, csv_name, cases):
+    # Writes the epidemic state to csv_name, sorted by date, with its store
+    # and the daily detected cases
+    epidemic_state.to_csv(csv_name, index=False)
+    write_epidemic_store(epidemic_state, csv_name, cases)
+
+
+def replace_last_rows(array_name, start, values):
+    # Replaces the rows (first axis) of the array from start with values. The
+    # header of np.save has room for a longer first axis, so the length is
+    # changed in place and only the new rows are written. Otherwise (or with
+    # older numpy versions) the whole array is written again
+    length = start + len(values)
+    with open(array_name, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        header_size = f.tell()
+        header = io.BytesIO()
+        new_header = {
+            'descr': np.lib.format.dtype_to_descr(dtype),
+            'fortran_order': fortran_order,
+            'shape': (length, ) + shape[1:],
+        }
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, new_header)
+        else:
+            np.lib.format.write_array_header_2_0(header, new_header)
+        in_place = (not fortran_order and shape[1:] == values.shape[1:]
+                    and len(header.getvalue()) == header_size)
+        if in_place:
+            f.seek(0)
+            f.write(header.getvalue())
+            f.truncate(header_size + length*int(np.prod(shape[1:]))*dtype.itemsize)
+
+    if in_place:
+        array = np.load(array_name, mmap_mode='r+')
+        array[start:] = values
+        array.flush()
+        del array
+    else:
+        previous = np.load(array_name, mmap_mode='r')
+        write_array(array_name, np.concatenate((previous[:start], values)))
+
+
+def append_epidemic_state(epidemic_state, csv_name, cases, start_date):
+    # Replaces the dates of csv_name from start_date (a stored date or the
+    # day after the last one) with epidemic_state, which must start on
+    # start_date, in the CSV, its store and the daily detected cases. Only
+    # the rows of those dates are written: the CSV is cut at the first row of
+    # the date and the new rows appended. An interrupted update leaves files
+    # that do not match the index, and the next update constructs all the
+    # days again
+    index = read_store_index(csv_name)
+    if index is None or index['csv_offsets'] is None or 'cases' not in index:
+        raise ValueError('No store to update for %s' % (csv_name, ))
+    columns = [column for column in epidemic_state.columns
+               if column not in ('date', 'erva', 'age')]
+    if columns != index['columns']:
+        raise ValueError('Columns %s do not match the ones of %s: %s' % (columns, csv_name,
+                                                                         index['columns']))
+    new_dates = sorted(pd.unique(epidemic_state['date']))
+    if len(new_dates) == 0 or new_dates[0] != start_date:
+        raise ValueError('The state to append to %s does not start on %s' % (csv_name,
+                                                                              start_date))
+    stored_dates = index['dates']
+    next_date = pd.Timestamp(stored_dates[-1]) + pd.Timedelta(days=1)
+    if start_date in stored_dates:
+        start_i = stored_dates.index(start_date)
+    elif start_date == next_date.strftime('%Y-%m-%d'):
+        start_i = len(stored_dates)
+    else:
+        raise ValueError('Date %s is not stored in %s nor the day after the last one' % (
+            start_date, csv_name))
+
+    cases_ervas, cases_ages, cases_values = cases
+    if len(cases_values) != len(new_dates):
+        raise ValueError('Cases of %d dates for %d new dates' % (len(cases_values),
+                                                                len(new_dates)))
+
+    data = epidemic_state.to_csv(index=False, header=False).encode('utf-8')
+    with open(csv_name, 'r+b') as f:
+        if start_i < len(stored_dates):
+            f.truncate(index['csv_offsets'][start_i])
+        end = f.seek(0, os.SEEK_END)
+        f.write(data)
+    new_offsets = csv_date_offsets(data, epidemic_state['date'].values, end)
+    if new_offsets is not None and len(new_offsets) != len(new_dates):
+        new_offsets = None
+
+    npy_name, _ = store_paths(csv_name)
+    replace_last_rows(npy_name, start_i, store_values(epidemic_state, new_dates, index['ervas'],
+                                                     index['ages'], columns))
+    replace_last_rows(cases_state_path(csv_name), start_i,
+                      np.asarray(cases_values, dtype=np.float64))
+
+    index['dates'] = stored_dates[:start_i] + new_dates
+    if new_offsets is None:
+        index['csv_offsets'] = None
+    else:
+        index['csv_offsets'] = index['csv_offsets'][:start_i] + new_offsets
+    index['cases'] = {'ervas': list(cases_ervas), 'ages': list(cases_ages)}
+    index['csv_signature'] = csv_signature(csv_name)
+    write_store_index(csv_name, index)
+
+
+def read_store_index(csv_name):
+    # Index of the store or None if it is missing or older than the CSV
+    npy_name, json_name = store_paths(csv_name)
+    if not (os.path.isfile(npy_name) and os.path.isfile(json_name)):
+        return None
+    with open(json_name) as f:
+        index = json.load(f)
+    if index['csv_signature'] != csv_signature(csv_name):
+        return None
+    return index
+
+
+def read_epidemic_state(csv_name, t0, columns=STATE_COLUMNS):
+    # Values of the columns at date t0 with shape (ervas, age groups, columns),
+    # ervas in the order of ervas_order. Only the block of t0 is read from
+    # the store, which is (re)built from the CSV if needed
+    index = read_store_index(csv_name)
+    if index is None:
+        write_epidemic_store(pd.read_csv(csv_name), csv_name)
+        index = read_store_index(csv_name)
+
+    if t0 not in index['dates']:
+        raise ValueError('Date %s not found in %s' % (t0, csv_name))
+    date_i = index['dates'].index(t0)
+    columns_i = [index['columns'].index(column) for column in columns]
+
+    npy_name, _ = store_paths(csv_name)
+    values = np.load(npy_name, mmap_mode='r')
+
+    return np.array(values[date_i][:, :, columns_i])
+
+
+def read_csv_rows(csv_name, index, start, stop):
+    # Rows of the CSV of the dates index['dates'][start:stop], read with the
+    # offsets of the index
+    offsets = index['csv_offsets'] + [csv_signature(csv_name)[0]]
+    with open(csv_name, 'rb') as f:
+        header = f.readline()
+        f.seek(offsets[start])
+        data = f.read(offsets[stop] - offsets[start])
+    return pd.read_csv(io.BytesIO(header + data), float_precision='round_trip')
+
+
+def cases_state_path(csv_name):
+    # Daily detected cases used to construct epidemic_finland_9.csv, kept in
+    # epidemic_finland_9_cases.npy (with the dates of the store) for the
+    # incremental updates
+    base_name, _ = os.path.splitext(csv_name)
+    return base_name + '_cases.npy'
+
+
+def read_cases_state(csv_name):
+    # Daily detected cases of csv_name or None if they are missing or the
+    # CSV changed after they were written. The cases are memory-mapped
+    if not os.path.isfile(csv_name):
+        return None
+    index = read_store_index(csv_name)
+    if index is None or index['csv_offsets'] is None or 'cases' not in index:
+        return None
+    cases = np.load(cases_state_path(csv_name), mmap_mode='r')
+    if len(cases) != len(index['dates']):
+        return None
+    return {
+        'dates': index['dates'],
+        'ervas': index['cases']['ervas'],
+        'ages': index['cases']['ages'],
+        'cases': cases,
+        'index': index,
+    }
@@ -1,15 +1,38 @@
 from forward_integration import (
-    forward_integration, get_model_parameters, read_initial_values
+    forward_integration, forward_integration_stream, get_model_parameters,
+    read_initial_values
 )
 import numpy as np
 from multiprocessing import Pool
 import os
 import time
 import datetime
+import tempfile
+from strategy_library import find_strategy, library_strategy, read_strategy_library
+
+
+# Observables stored in the results of every experiment
+RESULTS_OBSERVABLES = [
+    'total hospitalizations',
+    'infectious people',
+    'incidence',
+    'mortality',
+    'vaccinations',
+    'vaccinations_raw',
+    'new hospitalizations',
+]
+
+# Array parameters placed once in memory-mapped files for the pool workers
+SHARED_PARAMETERS = ['c1', 'c_gh', 'pop_hat', 'age_er', 'epidemic_npy']
+
+# Memory-mapped arrays already opened by the current pool worker (see
+# reset_shared_arrays)
+shared_arrays = {}
 
 
 def get_experiments_results(num_age_groups, num_ervas, e, taus, u_offset,
-                            init_vacc, strategies, u, T, r_experiments, t0):
+                            init_vacc, strategies, u, T, r_experiments, t0,
+                            batched=True):
     experiments_params = {
         'num_ervas': num_ervas,
         'num_age_groups': num_age_groups,
@@ -49,8 +72,8 @@ def get_experiments_results(num_age_groups, num_ervas, e, taus, u_offset,
 
     epidemic_npy = read_initial_values(age_er, init_vacc, t0)
 
-    age_er_prop = age_er.T
-    age_er_prop = age_er_prop[:, :, np.newaxis]
+    # Optimized strategies of all the R and tau values, read when needed
+    library = read_strategy_library()
 
     experiments = {r: {tau: {} for tau in taus} for r in r_experiments}
     num_experiments = 0
@@ -59,11 +82,18 @@ def get_experiments_results(num_age_groups, num_ervas, e, taus, u_offset,
             beta = r/tau_params[tau]['rho']
             for ws, label in strategies:
                 # ws is None mean go to optimized strategy
+                u_op = None
                 if type(ws) is not list:
                     dir_path = os.path.dirname(os.path.realpath(__file__))
                     u_op_file = 'R_%s_op_sol_tau%s.npy' % (r, tau)
                     u_op_file_path = os.path.join(dir_path, 'out', u_op_file)
-                    if os.path.isfile(u_op_file_path):
+                    library_s = find_strategy(library, r, tau)
+                    if library_s is not None:
+                        exec_experiment = True
+                        u_op = library_strategy(library, library_s)
+                        u_op_file_path = None
+                        print('Found strategy in library: R: %s. tau: %s' % (r, tau))
+                    elif os.path.isfile(u_op_file_path):
                         exec_experiment = True
                         print('Found file: %s' % (u_op_file_path, ))
                     else:
@@ -90,6 +120,7 @@ def get_experiments_results(num_age_groups, num_ervas, e, taus, u_offset,
                         'init_vacc': init_vacc,
                         'epidemic_npy': epidemic_npy,
                         'u_op_file': u_op_file_path,
+                        'u_op': u_op,
                         'num_exp': num_experiments,
                         'r': r,
                         'tau': tau,
@@ -98,34 +129,103 @@ def get_experiments_results(num_age_groups, num_ervas, e, taus, u_offset,
                     experiments[r][tau][label] = {}
                     experiments[r][tau][label]['parameters'] = parameters
 
-    num_cpus = os.cpu_count()
+    run_experiments(experiments, num_experiments, batched)
+
+    return experiments
+
+
+def run_experiments(experiments, num_experiments, batched):
+    # Adds the results of every experiment to the experiments dictionary
     start_time = time.time()
+    if batched:
+        print('Running %s experiments in a single batch.' % (num_experiments, ))
+        execute_batched_forward(experiments)
+    else:
+        with tempfile.TemporaryDirectory() as shared_dir:
+            execute_pool_forward(experiments, num_experiments, shared_dir)
+    elapsed_time = time.time() - start_time
+    elapsed_delta = datetime.timedelta(seconds=elapsed_time)
+    print('Finished experiments. Elapsed: %s' % (elapsed_delta, ))
+
+
+def execute_pool_forward(experiments, num_experiments, shared_dir):
+    # The array parameters are written once to shared_dir and the workers
+    # write their results in a shared block indexed by scenario, so only
+    # file names and scalars are sent between the processes
+    shared_files = {}
+    scenarios = []
+    for r, r_level in experiments.items():
+        for tau, tau_level in r_level.items():
+            for label, label_level in tau_level.items():
+                policy_params = dict(label_level['parameters'])
+                for key in SHARED_PARAMETERS:
+                    array = policy_params[key]
+                    # Experiments with the same tau share the same arrays
+                    if id(array) not in shared_files:
+                        file_name = 'param_%d.npy' % (len(shared_files), )
+                        file_path = os.path.join(shared_dir, file_name)
+                        np.save(file_path, array)
+                        shared_files[id(array)] = file_path
+                    policy_params[key] = shared_files[id(array)]
+                policy_params['scenario'] = len(scenarios)
+                scenarios.append((r, tau, label, policy_params))
+
+    if len(scenarios) == 0:
+        return
+
+    # Results of all the scenarios with shape
+    # (num scenarios, num observables, N_g, N_p, T)
+    params = scenarios[0][3]
+    num_ervas, num_age_groups = np.load(params['age_er'], mmap_mode='r').shape
+    output_path = os.path.join(shared_dir, 'results.npy')
+    output = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float64,
+                                       shape=(len(scenarios),
+                                              len(RESULTS_OBSERVABLES),
+                                              num_age_groups,
+                                              num_ervas,
+                                              params['T']))
+    output.flush()
+
+    # Running on all the available CPUs of the computer
+    num_cpus = os.cpu_count()
     print('Running %s experiments with %s CPUS.' % (num_experiments, num_cpus))
-    with Pool(processes=num_cpus) as pool:
+    with Pool(processes=num_cpus, initializer=reset_shared_arrays) as pool:
         # Calling the function to execute forward simulation in asynchronous way
         async_res = []
-        for r, r_level in experiments.items():
-            for tau, tau_level in r_level.items():
-                for label, label_level in tau_level.items():
-                    policy_params = label_level['parameters']
-                    async_res.append(
-                        pool.apply_async(execute_parallel_forward,
-                                         kwds=policy_params)
-                    )
+        for r, tau, label, policy_params in scenarios:
+            async_res.append(
+                pool.apply_async(execute_parallel_forward,
+                                 args=(output_path, ),
+                                 kwds=policy_params)
+            )
 
         # Waiting for the values of the async execution
         for res in async_res:
-            r, tau, label, results = res.get()
+            r, tau, label, scenario = res.get()
             # Adding the results to our dictionary
+            results = {name: np.array(output[scenario, k])
+                       for k, name in enumerate(RESULTS_OBSERVABLES)}
             experiments[r][tau][label]['results'] = results
-    elapsed_time = time.time() - start_time
-    elapsed_delta = datetime.timedelta(seconds=elapsed_time)
-    print('Finished experiments. Elapsed: %s' % (elapsed_delta, ))
 
-    return experiments
+    del output
+
 
+def reset_shared_arrays():
+    # Initializer of the pool workers: the files of shared_dir only exist
+    # while the pool is running, so nothing is kept from a previous pool
+    shared_arrays.clear()
 
-def execute_parallel_forward(**params):
+
+def load_shared_array(value, mode='r'):
+    # Arrays of the shared parameters are given by the path of their file
+    if not isinstance(value, str):
+        return value
+    if (value, mode) not in shared_arrays:
+        shared_arrays[(value, mode)] = np.load(value, mmap_mode=mode)
+    return shared_arrays[(value, mode)]
+
+
+def execute_parallel_forward(output_path, **params):
     # Function that executes in parallel the forward simulations
     start_time = time.time()
     proc_number = os.getpid()
@@ -133,15 +233,83 @@ def execute_parallel_forward(**params):
     r = params.pop('r')
     tau = params.pop('tau')
     label = params.pop('label')
+    scenario = params.pop('scenario')
     print('Start (%s). Exp: %s. R: %s. tau: %s. Policy: %s' % (proc_number,
                                                                num_exp,
                                                                r,
                                                                tau,
                                                                label))
 
+    for key in SHARED_PARAMETERS:
+        params[key] = load_shared_array(params[key])
+
     _, _, H_wg, H_cg, H_rg, I_g, D_g, u_g, hops_i, infs_i = forward_integration(**params)
 
-    age_er_prop = params['age_er'].T
+    results = construct_results(params['age_er'], H_wg, H_cg, H_rg, I_g, D_g,
+                                u_g, hops_i, infs_i)
+
+    # Writing the results in the block of the scenario
+    output = load_shared_array(output_path, mode='r+')
+    for k, name in enumerate(RESULTS_OBSERVABLES):
+        output[scenario, k] = results[name]
+    output.flush()
+
+    elapsed_time = time.time() - start_time
+    elapsed_delta = datetime.timedelta(seconds=elapsed_time)
+    print('Finished (%s). Exp: %s. Elapsed: %s' % (proc_number,
+                                                   num_exp,
+                                                   elapsed_delta))
+
+    return r, tau, label, scenario
+
+
+def execute_batched_forward(experiments):
+    # Executes all the experiments in a single call to forward_integration_stream
+    # Scenarios are stacked in the order of the experiments dictionary
+    scenarios = []
+    for r, r_level in experiments.items():
+        for tau, tau_level in r_level.items():
+            for label in tau_level.keys():
+                scenarios.append((r, tau, label))
+
+    if len(scenarios) == 0:
+        return
+
+    all_params = [experiments[r][tau][label]['parameters'] for r, tau, label in scenarios]
+    # Parameters shared by all the experiments
+    params = all_params[0]
+    age_er = params['age_er']
+
+    u_op = []
+    for scenario_params in all_params:
+        if scenario_params['u_op_file'] is None:
+            u_op.append(scenario_params['u_op'])
+        else:
+            u_op.append(np.load(scenario_params['u_op_file']))
+
+    # Only the observables of the results are kept during the integration
+    outputs = forward_integration_stream(
+        u_con=params['u_con'],
+        c1=np.stack([p['c1'] for p in all_params]),
+        beta=[p['beta'] for p in all_params],
+        c_gh=np.stack([p['c_gh'] for p in all_params]),
+        T=params['T'],
+        pop_hat=np.stack([p['pop_hat'] for p in all_params]),
+        age_er=age_er,
+        ws_vacc=[p['ws_vacc'] for p in all_params],
+        e=params['e'],
+        epidemic_npy=params['epidemic_npy'],
+        observables=RESULTS_OBSERVABLES,
+        u_op=u_op
+    )
+
+    for s, (r, tau, label) in enumerate(scenarios):
+        results = {name: outputs[name][s] for name in RESULTS_OBSERVABLES}
+        experiments[r][tau][label]['results'] = results
+
+
+def construct_results(age_er, H_wg, H_cg, H_rg, I_g, D_g, u_g, hops_i, infs_i):
+    age_er_prop = age_er.T
     age_er_prop = age_er_prop[:, :, np.newaxis]
 
     total_hosp = H_wg + H_cg + H_rg
@@ -161,17 +329,12 @@ def execute_parallel_forward(**params):
         'new hospitalizations': hops_i*age_er_prop,
     }
 
-    elapsed_time = time.time() - start_time
-    elapsed_delta = datetime.timedelta(seconds=elapsed_time)
-    print('Finished (%s). Exp: %s. Elapsed: %s' % (proc_number,
-                                                   num_exp,
-                                                   elapsed_delta))
-
-    return r, tau, label, results
+    return results
 
 
 def search_best_ws_r_metric(num_age_groups, num_ervas, init_vacc,
-                            u, T, r_experiments, t0, e, taus, search_num_ws):
+                            u, T, r_experiments, t0, e, taus, search_num_ws,
+                            batched=True):
     # Constructing ws. Endpoint=False avoids the case 1, 0, 0
     w1 = np.linspace(0, 1, search_num_ws)
 
@@ -189,9 +352,6 @@ def search_best_ws_r_metric(num_age_groups, num_ervas, init_vacc,
 
     epidemic_npy = read_initial_values(age_er, init_vacc, t0)
 
-    age_er_prop = age_er.T
-    age_er_prop = age_er_prop[:, :, np.newaxis]
-
     experiments = {r: {tau: {} for tau in taus} for r in r_experiments}
     num_experiments = 0
     for tau in taus:
@@ -215,6 +375,7 @@ def search_best_ws_r_metric(num_age_groups, num_ervas, init_vacc,
                     'init_vacc': init_vacc,
                     'epidemic_npy': epidemic_npy,
                     'u_op_file': None,
+                    'u_op': None,
                     'num_exp': num_experiments,
                     'r': r,
                     'tau': tau,
@@ -223,29 +384,6 @@ def search_best_ws_r_metric(num_age_groups, num_ervas, init_vacc,
                 experiments[r][tau][label] = {}
                 experiments[r][tau][label]['parameters'] = parameters
 
-    # Running on all the available CPUs of the computer
-    num_cpus = os.cpu_count()
-    start_time = time.time()
-    print('Running %s experiments with %s CPUS.' % (num_experiments, num_cpus))
-    with Pool(processes=num_cpus) as pool:
-        # Calling the function to execute forward simulation in asynchronous way
-        async_res = []
-        for r, r_level in experiments.items():
-            for tau, tau_level in r_level.items():
-                for label, label_level in tau_level.items():
-                    policy_params = label_level['parameters']
-                    async_res.append(
-                        pool.apply_async(execute_parallel_forward,
-                                         kwds=policy_params)
-                    )
-
-        # Waiting for the values of the async execution
-        for res in async_res:
-            r, tau, label, results = res.get()
-            # Adding the results to our dictionary
-            experiments[r][tau][label]['results'] = results
-    elapsed_time = time.time() - start_time
-    elapsed_delta = datetime.timedelta(seconds=elapsed_time)
-    print('Finished experiments. Elapsed: %s' % (elapsed_delta, ))
+    run_experiments(experiments, num_experiments, batched)
 
     return experiments
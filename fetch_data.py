@@ -1,10 +1,13 @@
-import requests
 import json
 from io import StringIO
 import pandas as pd
 import numpy as np
 import datetime
 from env_var import REQUESTS, MAPPINGS, EPIDEMIC
+from http_cache import cached_get
+from disaggregation import (
+    daily_dates, split_by_age, week_days, weekend_source_dates, weekly_to_daily
+)
 
 
 def transform_thl_week_datetime(thl_time):
@@ -21,6 +24,69 @@ def transform_thl_week_datetime(thl_time):
     return monday_of_week
 
 
+def week_after(monday_of_week, start_date):
+    # True if some day of the week is on or after start_date (YYYY-MM-DD)
+    if start_date is None:
+        return True
+    sunday_of_week = monday_of_week + datetime.timedelta(days=6)
+    return sunday_of_week.strftime('%Y-%m-%d') >= start_date
+
+
+def filter_weeks(dataframe, start_date):
+    # Rows of the THL weeks with some day on or after start_date, without the
+    # rows of all the times
+    if start_date is None:
+        return dataframe
+    times = pd.unique(dataframe['Time'])
+    keep_times = [time for time in times
+                  if 'All' not in time and week_after(transform_thl_week_datetime(time), start_date)]
+    return dataframe[dataframe['Time'].isin(keep_times)]
+
+
+def label_categories(mapping):
+    # Sorted labels of the mapping (MAPPINGS), the categories of map_labels
+    return sorted(set(mapping.values()))
+
+
+def map_labels(labels, mapping, name='label'):
+    # Labels (pandas Series) mapped with mapping (MAPPINGS) as a categorical,
+    # stored as small integer codes of label_categories(mapping). Only the
+    # distinct labels are looked up and unknown labels raise ValueError
+    labels = pd.Categorical(labels)
+    unknown = [label for label in labels.categories if label not in mapping]
+    if (labels.codes < 0).any():
+        unknown.append(np.nan)
+    if len(unknown) > 0:
+        raise ValueError('Unknown %s labels: %s' % (name, unknown))
+    categories = label_categories(mapping)
+    category_codes = np.array([categories.index(mapping[label]) for label in labels.categories],
+                              dtype=np.int8)
+    return pd.Categorical.from_codes(category_codes[labels.codes], categories=categories)
+
+
+def sort_groups(grouped, columns):
+    # Groups of groupby(..., observed=True) sorted by columns. The groups of
+    # categoricals are in the order they appear in pandas < 2
+    return grouped.sort_values(columns).reset_index(drop=True)
+
+
+def erva_age_categoricals(dataframe, number_age_groups=9):
+    # Columns erva and age of a daily dataframe as categoricals, with the same
+    # categories in all the dataframes so that merging them keeps the codes.
+    # Labels outside the categories raise ValueError, as in map_labels
+    column_categories = {
+        'erva': label_categories(MAPPINGS['hcd_erva']),
+        'age': MAPPINGS['age_groups'][number_age_groups]['names'],
+    }
+    for column, categories in column_categories.items():
+        labels = pd.Categorical(dataframe[column], categories=categories)
+        if (labels.codes < 0).any():
+            unknown = list(pd.unique(dataframe[column].values[labels.codes < 0]))
+            raise ValueError('Unknown %s labels: %s' % (column, unknown))
+        dataframe[column] = labels
+    return dataframe
+
+
 def static_population_erva_age(logger, csv_file, number_age_groups=9):
     logger.info('Getting population of ervas by age (2020)')
     population_age_df = pd.read_csv(csv_file, sep=";", encoding='utf-8')
@@ -31,9 +97,11 @@ def static_population_erva_age(logger, csv_file, number_age_groups=9):
     population_age_df = population_age_df[~population_age_df['Age'].str.contains('Total')]
 
     age_group_mapping = MAPPINGS['age_groups'][number_age_groups]['population']
-    population_age_df['age_group'] = population_age_df.apply(lambda row: age_group_mapping[row['Age']], axis=1)
+    population_age_df['age_group'] = map_labels(population_age_df['Age'], age_group_mapping,
+                                                name='population age')
     population_age_df = population_age_df.groupby(by=['erva', 'age_group'],
-                                                  as_index=False).sum()
+                                                  as_index=False, observed=True).sum()
+    population_age_df = sort_groups(population_age_df, ['erva', 'age_group'])
     pop_age_prop = population_age_df.copy()
     ervas = pd.unique(pop_age_prop['erva'])
     for erva in ervas:
@@ -44,7 +112,9 @@ def static_population_erva_age(logger, csv_file, number_age_groups=9):
     return population_age_df, pop_age_prop
 
 
-def fetch_thl_vaccines_erva_weekly(logger, filename=None, number_age_groups=9):
+def fetch_thl_vaccines_erva_weekly(logger, filename=None, number_age_groups=9,
+                                   start_date=None):
+    # With start_date (YYYY-MM-DD) only the weeks with days from start_date are kept
     logger.info('Getting THL vaccination statistics (weekly)')
 
     # Select the appropriate URL
@@ -57,7 +127,7 @@ def fetch_thl_vaccines_erva_weekly(logger, filename=None, number_age_groups=9):
                   'Headers: %s\n') % (url,
                                       json.dumps(headers, indent=1)))
     # Load data from THL's API as CSV
-    response = requests.get(url, headers=headers)
+    response = cached_get(logger, url, headers=headers)
     if response.status_code != 200:
         logger.error(response.content)
         raise RuntimeError("THL's API failed!")
@@ -70,22 +140,24 @@ def fetch_thl_vaccines_erva_weekly(logger, filename=None, number_age_groups=9):
     vaccinated_df = pd.read_csv(buffer_for_pandas, sep=";")
     logger.debug('Constructed pandas dataframe')
 
+    vaccinated_df = filter_weeks(vaccinated_df, start_date)
+
     vaccinated_df = vaccinated_df.fillna(0)
     logger.debug('Filled NaNs with zeros')
 
     hcd_erva_mapping = MAPPINGS['hcd_erva']
-    vaccinated_df['erva'] = vaccinated_df.apply(lambda row: hcd_erva_mapping[row['Area']], axis=1)
+    vaccinated_df['erva'] = map_labels(vaccinated_df['Area'], hcd_erva_mapping, name='area')
     logger.debug('Augmented data with erva')
 
     age_group_mapping = MAPPINGS['age_groups'][number_age_groups]['vaccines']
-    vaccinated_df['age group'] = vaccinated_df.apply(lambda row: age_group_mapping[row['Age']], axis=1)
+    vaccinated_df['age group'] = map_labels(vaccinated_df['Age'], age_group_mapping, name='age')
     logger.debug('Augmented data with age groups')
 
     columns_agg_erva = ['age group',
                         'Vaccination dose',
                         'Time',
                         'erva']
-    vaccinated_erva = vaccinated_df.groupby(by=columns_agg_erva, as_index=False).sum()
+    vaccinated_erva = vaccinated_df.groupby(by=columns_agg_erva, as_index=False, observed=True).sum()
 
     vaccinated_erva = vaccinated_erva[['erva', 'Time', 'age group', 'Vaccination dose', 'val']]
     vaccinated_erva = vaccinated_erva.sort_values(by=['erva', 'Time', 'age group', 'Vaccination dose'])
@@ -104,7 +176,9 @@ def fetch_thl_vaccines_erva_weekly(logger, filename=None, number_age_groups=9):
     return vaccinated_erva
 
 
-def fetch_hs_hospitalizations(logger):
+def fetch_hs_hospitalizations(logger, start_date=None):
+    # With start_date (YYYY-MM-DD) only the days from the day before
+    # start_date are kept (a Saturday uses the values of Friday)
     logger.info('Getting HS hospitalizations by ERVA (daily)')
 
     # Select the appropriate URL
@@ -117,7 +191,7 @@ def fetch_hs_hospitalizations(logger):
                   'Headers: %s\n') % (url,
                                       json.dumps(headers, indent=1)))
     # Load data from THL's API as CSV
-    response = requests.get(url, headers=headers)
+    response = cached_get(logger, url, headers=headers)
     if response.status_code != 200:
         logger.error(response.content)
         raise RuntimeError("HS API failed!")
@@ -130,117 +204,91 @@ def fetch_hs_hospitalizations(logger):
     hospital_df = pd.DataFrame(hospitalizations)
 
     hospital_df = hospital_df[~hospital_df['area'].str.contains('Finland')]
+    if start_date is not None:
+        previous_date = datetime.datetime.strptime(start_date, "%Y-%m-%d") - datetime.timedelta(days=1)
+        hospital_df = hospital_df[hospital_df['date'].str[:10] >= previous_date.strftime("%Y-%m-%d")]
     hospital_df.columns = ['date', 'erva', 'hospitalized', 'ward', 'icu', 'dead']
 
-    hospital_df['date'] = hospital_df.apply(
-                            lambda row: row['date'].split('T')[0],
-                            axis=1
-                          )
+    hospital_df['date'] = hospital_df['date'].str.split('T').str[0]
     hospital_df = hospital_df.sort_values(['date', 'erva'])
 
     return hospital_df
 
 
-def construct_hs_hosp_age_erva(logger, number_age_groups=9):
+def construct_hs_hosp_age_erva(logger, number_age_groups=9, start_date=None):
+    # With start_date (YYYY-MM-DD) only the days from start_date are constructed
     logger.info('Constructing hospitalizations by age and erva (daily)')
 
+    # All the days are kept: the first constructed day is start_date only if
+    # the data starts before it, which the rows from start_date do not tell
+    # when start_date is a Sunday (the data has only weekdays)
     hosp_by_erva = fetch_hs_hospitalizations(logger)
     age_groups = MAPPINGS['age_groups'][number_age_groups]['names']
     probs_age_icu = EPIDEMIC['proportion_icu_age'][number_age_groups]
     probs_age_ward = EPIDEMIC['proportion_ward_age'][number_age_groups]
     probs_age_death = EPIDEMIC['proportion_deaths_age'][number_age_groups]
 
-    hosp_by_erva_list = hosp_by_erva.values
-    dates = np.unique(hosp_by_erva_list[:, 0])
-    curr_date = datetime.datetime.strptime(dates[0], "%Y-%m-%d")
-    last_date = datetime.datetime.strptime(dates[-1], "%Y-%m-%d")
-    ervas = np.unique(hosp_by_erva_list[:, 1])
-
-    header = 'date;erva;age;ward;icu;death'
-    final_lines = [header, ]
-    while curr_date <= last_date:
-        day_of_week = curr_date.weekday()
-        for erva in ervas:
-            # If we are on weekend
-            if day_of_week == 5:
-                friday_date = curr_date - datetime.timedelta(days=1)
-                use_date = friday_date.strftime("%Y-%m-%d")
-            elif day_of_week == 6:
-                monday_date = curr_date + datetime.timedelta(days=1)
-                use_date = monday_date.strftime("%Y-%m-%d")
-            else:
-                use_date = curr_date.strftime("%Y-%m-%d")
-
-            date = curr_date.strftime("%Y-%m-%d")
-            values_day_erva = hosp_by_erva_list[np.where((
-                                hosp_by_erva_list[:, 0] == use_date) & (hosp_by_erva_list[:, 1] == erva)
-                              )]
-            ward_day_erva = 0 if len(values_day_erva[:, 3]) == 0 else values_day_erva[:, 3].item()
-            icu_day_erva = 0 if len(values_day_erva[:, 4]) == 0 else values_day_erva[:, 4].item()
-            death_day_erva = 0 if len(values_day_erva[:, 5]) == 0 else values_day_erva[:, 5].item()
-
-            ward_age_day_erva = ward_day_erva*probs_age_ward
-            icu_age_day_erva = icu_day_erva*probs_age_icu
-            death_age_day_erva = death_day_erva*probs_age_death
-            for i, group in enumerate(age_groups):
-                line = [date,
-                        erva,
-                        group,
-                        str(ward_age_day_erva[i]),
-                        str(icu_age_day_erva[i]),
-                        str(death_age_day_erva[i])]
-                line_str = ';'.join(line)
-                final_lines.append(line_str)
-        curr_date = curr_date + datetime.timedelta(days=1)
-    complete_csv = '\n'.join(final_lines)
-
-    buffer_for_pandas = StringIO(complete_csv)
-    hosp_age_erva_daily = pd.read_csv(buffer_for_pandas, sep=";")
-
-    return hosp_age_erva_daily
-
-
-def construct_thl_vaccines_erva_daily(logger, filename=None, number_age_groups=9):
+    first_date = hosp_by_erva['date'].min()
+    if start_date is not None:
+        first_date = max(first_date, start_date)
+    dates = daily_dates(first_date, hosp_by_erva['date'].max())
+    ervas = np.unique(hosp_by_erva['erva'])
+
+    # Values of every date and erva, the ones of the weekends taken from the
+    # closest weekday and 0 when missing
+    source_index = pd.MultiIndex.from_product([weekend_source_dates(dates), ervas])
+    values_day_erva = hosp_by_erva.set_index(['date', 'erva'])[['ward', 'icu', 'dead']]
+    values_day_erva = values_day_erva.reindex(source_index, fill_value=0).values
+
+    # Rows by date, erva and age group
+    num_rows = len(dates)*len(ervas)*len(age_groups)
+    hosp_age_erva_daily = pd.DataFrame(data={
+        'date': np.repeat(dates, len(ervas)*len(age_groups)),
+        'erva': np.tile(np.repeat(ervas, len(age_groups)), len(dates)),
+        'age': np.tile(age_groups, len(dates)*len(ervas)),
+        'ward': split_by_age(values_day_erva[:, 0], probs_age_ward).reshape(num_rows),
+        'icu': split_by_age(values_day_erva[:, 1], probs_age_icu).reshape(num_rows),
+        'death': split_by_age(values_day_erva[:, 2], probs_age_death).reshape(num_rows),
+    })
+
+    return erva_age_categoricals(hosp_age_erva_daily, number_age_groups=number_age_groups)
+
+
+def construct_thl_vaccines_erva_daily(logger, filename=None, number_age_groups=9,
+                                      start_date=None):
+    # With start_date (YYYY-MM-DD) only the days from start_date are constructed
     logger.info('Constructing vaccinations (daily)')
     vaccinated_weekly = fetch_thl_vaccines_erva_weekly(logger,
-                                                       number_age_groups=number_age_groups)
-    vaccinated_list = vaccinated_weekly.values
-
-    dates = np.unique(vaccinated_list[:, 1])
-    ervas = np.unique(vaccinated_list[:, 0])
-
+                                                       number_age_groups=number_age_groups,
+                                                       start_date=start_date)
+    weeks = np.unique(vaccinated_weekly['Time'])
+    ervas = np.unique(vaccinated_weekly['erva'])
     age_groups = pd.unique(vaccinated_weekly['age group'])
 
-    header = 'date;erva;age;First dose;Second dose'
-    final_lines = [header, ]
-    for date in dates:
-        for erva in ervas:
-            vacc_week = vaccinated_list[np.where(
-                            (vaccinated_list[:, 1] == date) & (vaccinated_list[:, 0] == erva)
-                        )]
-            vacc_day = np.copy(vacc_week)
-            vacc_day_vals = vacc_day[:, 4]/7
-
-            monday_of_week = transform_thl_week_datetime(date)
-            # Augment by day, start on monday and finish sunday (7 days)
-            for day in range(7):
-                date_i = monday_of_week + datetime.timedelta(days=day)
-                date_str = date_i.strftime('%Y-%m-%d')
-                line_counter = 0
-                for age_g in age_groups:
-                    line = [date_str,
-                            erva,
-                            age_g,
-                            str(vacc_day_vals[line_counter]),
-                            str(vacc_day_vals[line_counter+1])]
-                    line_str = ';'.join(line)
-                    final_lines.append(line_str)
-                    line_counter += 2
-
-    complete_csv = '\n'.join(final_lines)
-
-    buffer_for_pandas = StringIO(complete_csv)
-    vaccinated_daily = pd.read_csv(buffer_for_pandas, sep=";")
+    # Rows sorted by erva, week, age group and dose: values with shape
+    # (weeks, ervas, age groups, doses)
+    vaccinated_values = vaccinated_weekly['val'].values.astype(np.float64)
+    vaccinated_values = vaccinated_values.reshape(len(ervas), len(weeks), len(age_groups), 2)
+    vaccinated_values = vaccinated_values.transpose(1, 0, 2, 3)
+
+    # Augment by day, start on monday and finish sunday (7 days), rows by
+    # week, erva, day and age group
+    dates, keep = week_days([transform_thl_week_datetime(week) for week in weeks],
+                            start_date=start_date)
+    vaccinated_values = weekly_to_daily(vaccinated_values, axis=2)
+    keep = np.broadcast_to(keep[:, np.newaxis, :], vaccinated_values.shape[:3])
+    dates = np.broadcast_to(dates[:, np.newaxis, :], keep.shape)[keep]
+    ervas = np.broadcast_to(ervas[np.newaxis, :, np.newaxis], keep.shape)[keep]
+    vaccinated_values = vaccinated_values[keep]
+
+    vaccinated_daily = pd.DataFrame(data={
+        'date': np.repeat(dates, len(age_groups)),
+        'erva': np.repeat(ervas, len(age_groups)),
+        'age': np.tile(age_groups, len(dates)),
+        'First dose': vaccinated_values[:, :, 0].ravel(),
+        'Second dose': vaccinated_values[:, :, 1].ravel(),
+    })
+    vaccinated_daily = erva_age_categoricals(vaccinated_daily, number_age_groups=number_age_groups)
 
     logger.debug('Constructed pandas dataframe')
     if filename is not None:
@@ -250,7 +298,8 @@ def construct_thl_vaccines_erva_daily(logger, filename=None, number_age_groups=9
     return vaccinated_daily
 
 
-def fetch_thl_cases_erva_daily(logger):
+def fetch_thl_cases_erva_daily(logger, start_date=None):
+    # With start_date (YYYY-MM-DD) only the days from start_date are kept
     logger.debug('Getting THL reported cases by ERVA (daily)')
 
     # Select the appropriate URL
@@ -263,7 +312,7 @@ def fetch_thl_cases_erva_daily(logger):
                   'Headers: %s\n') % (url,
                                       json.dumps(headers, indent=1)))
     # Load data from THL's API as CSV
-    response = requests.get(url, headers=headers)
+    response = cached_get(logger, url, headers=headers)
     if response.status_code != 200:
         logger.error(response.content)
         raise RuntimeError("THL's API failed!")
@@ -278,6 +327,8 @@ def fetch_thl_cases_erva_daily(logger):
 
     new_cases_df = new_cases_df[~new_cases_df['Time'].str.contains('Week|All')]
     logger.debug('Removed total counts and weekly counts')
+    if start_date is not None:
+        new_cases_df = new_cases_df[new_cases_df['Time'] >= start_date]
 
     new_cases_df = new_cases_df.fillna(0)
     logger.debug('Filled NaNs with zeros')
@@ -286,10 +337,11 @@ def fetch_thl_cases_erva_daily(logger):
     logger.debug('Removed unecessary Measure column')
 
     hcd_erva_mapping = MAPPINGS['hcd_erva']
-    new_cases_df['erva'] = new_cases_df.apply(lambda row: hcd_erva_mapping[row['Area']], axis=1)
+    new_cases_df['erva'] = map_labels(new_cases_df['Area'], hcd_erva_mapping, name='area')
     logger.debug('Augmented data with erva')
 
-    reported_cases_erva = new_cases_df.groupby(by=['Time', 'erva'], as_index=False).sum()
+    reported_cases_erva = new_cases_df.groupby(by=['Time', 'erva'], as_index=False, observed=True).sum()
+    reported_cases_erva = sort_groups(reported_cases_erva, ['Time', 'erva'])
     logger.debug('Keeping only ervas')
 
     # Remove the counts for Finland
@@ -298,7 +350,8 @@ def fetch_thl_cases_erva_daily(logger):
     return reported_cases_erva
 
 
-def fetch_finland_cases_age_weekly(logger, number_age_groups=9):
+def fetch_finland_cases_age_weekly(logger, number_age_groups=9, start_date=None):
+    # With start_date (YYYY-MM-DD) only the weeks with days from start_date are kept
     logger.debug('Getting THL reported cases by age (weekly)')
 
     # Select the appropriate URL
@@ -311,7 +364,7 @@ def fetch_finland_cases_age_weekly(logger, number_age_groups=9):
                   'Headers: %s\n') % (url,
                                       json.dumps(headers, indent=1)))
     # Load data from THL's API as CSV
-    response = requests.get(url, headers=headers)
+    response = cached_get(logger, url, headers=headers)
     if response.status_code != 200:
         logger.error(response.content)
         raise RuntimeError("THL's API failed!")
@@ -326,6 +379,7 @@ def fetch_finland_cases_age_weekly(logger, number_age_groups=9):
 
     new_cases_df = new_cases_df[~new_cases_df['Time'].str.contains('All')]
     logger.debug('Removed total counts and weekly counts')
+    new_cases_df = filter_weeks(new_cases_df, start_date)
 
     new_cases_df.loc[new_cases_df['val'] == '..', 'val'] = 0
 
@@ -333,42 +387,41 @@ def fetch_finland_cases_age_weekly(logger, number_age_groups=9):
     logger.debug('Filled NaNs with zeros')
 
     age_group_mapping = MAPPINGS['age_groups'][number_age_groups]['cases']
-    new_cases_df['age_group'] = new_cases_df.apply(lambda row: age_group_mapping[row['Age']], axis=1)
+    new_cases_df['age_group'] = map_labels(new_cases_df['Age'], age_group_mapping, name='age')
     logger.debug('Augmented data age groups')
 
     new_cases_df = new_cases_df.astype({'val': 'int32'})
 
-    cases_age = new_cases_df.groupby(by=['Time', 'age_group'], as_index=False).sum()
+    cases_age = new_cases_df.groupby(by=['Time', 'age_group'], as_index=False, observed=True).sum()
+    cases_age = sort_groups(cases_age, ['Time', 'age_group'])
     logger.debug('Keeping only age groups')
 
     age_groups = MAPPINGS['age_groups'][number_age_groups]['names']
     cases_age_prop = cases_age.copy()
-    all_times = pd.unique(cases_age['Time'])
-    for time in all_times:
-        date_df = cases_age.loc[cases_age['Time'] == time, ]
-        tot_reported = date_df[date_df['age_group'].str.contains('All')]
-        age_reported = date_df[~date_df['age_group'].str.contains('All')]
-        tot_val = tot_reported['val'].values[0]
-        age_val = np.sum(age_reported['val'].values)
-        # Checking if there's a difference between sum in age groups and total
-        if age_val != tot_val:
-            missing_cases = tot_val - age_val
-            logger.debug('%s. Missing: %d' % (time, missing_cases))
-            add_cases = np.floor(missing_cases / len(age_groups))
-            cases_age.loc[cases_age['Time'] == time, 'val'] += add_cases
-            left_cases = missing_cases % len(age_groups)
-            if left_cases != 0:
-                age_i = 0
-                while left_cases > 0:
-                    select_age_group = age_groups[age_i]
-                    condition = (cases_age['Time'] == time) & (cases_age['age_group'] == select_age_group)
-                    cases_age.loc[condition, 'val'] += 1
-                    age_i += 1
-                    left_cases -= 1
-
-        if tot_val != 0:
-            # Getting the proportion of the age wrt total cases
-            cases_age_prop.loc[cases_age['Time'] == time, 'val'] = cases_age.loc[cases_age['Time'] == time, 'val'] / tot_val
+
+    # Total reported and sum of the age groups of every week, for every row
+    is_total = cases_age['age_group'].str.contains('All').values
+    tot_val = cases_age.loc[is_total].set_index('Time')['val']
+    age_val = cases_age.loc[~is_total].groupby('Time')['val'].sum()
+    missing_cases = (tot_val - age_val).reindex(tot_val.index)
+    for time, missing in missing_cases[missing_cases != 0].items():
+        logger.debug('%s. Missing: %d' % (time, missing))
+    tot_val = cases_age['Time'].map(tot_val).values
+    missing_cases = cases_age['Time'].map(missing_cases).values
+
+    # Checking if there's a difference between sum in age groups and total:
+    # the missing cases are split evenly in all the rows of the week and the
+    # ones left are added to the first age groups, one each
+    add_cases = np.floor(missing_cases / len(age_groups))
+    left_cases = missing_cases % len(age_groups)
+    age_i = pd.Categorical(cases_age['age_group'], categories=age_groups).codes
+    add_left = (~is_total) & (age_i < left_cases)
+    cases_age['val'] = ((cases_age['val'].values + add_cases) + add_left).astype(cases_age['val'].dtype)
+
+    # Getting the proportion of the age wrt total cases
+    cases_age_prop['val'] = np.where(tot_val != 0,
+                                     cases_age['val'].values / np.where(tot_val != 0, tot_val, 1),
+                                     cases_age_prop['val'].values)
 
     cases_age_prop = cases_age_prop.fillna(0)
     # Remove the column of total age counts
@@ -378,79 +431,78 @@ def fetch_finland_cases_age_weekly(logger, number_age_groups=9):
     return cases_age, cases_age_prop
 
 
-def construct_finland_age_cases_daily(logger, number_age_groups=9):
+def construct_finland_age_cases_daily(logger, number_age_groups=9, start_date=None):
+    # With start_date (YYYY-MM-DD) only the days from start_date are constructed
     logger.info('Constructing cases by age (daily)')
     cases, cases_prop = fetch_finland_cases_age_weekly(logger,
-                                                       number_age_groups=number_age_groups)
-    cases_list = cases.values
-    cases_prop_list = cases_prop.values
-    dates = np.unique(cases_list[:, 0])
-
+                                                       number_age_groups=number_age_groups,
+                                                       start_date=start_date)
+    weeks = np.unique(cases['Time'])
     age_groups = MAPPINGS['age_groups'][number_age_groups]['names']
-    header = 'Time'
-    for age_i in age_groups:
-        header += ';%s' % age_i
-    final_lines_day = [header, ]
-    final_lines_prop = [header, ]
-    for date in dates:
-        cases_week = cases_list[np.where(cases_list[:, 0] == date)]
-        cases_day = np.copy(cases_week)
-        cases_daily_vals = cases_day[:, 2]/7
-
-        cases_week_prop = cases_prop_list[np.where(cases_prop_list[:, 0] == date)]
-
-        monday_of_week = transform_thl_week_datetime(date)
-        # Augment by day, start on monday and finish sunday (7 days)
-        for day in range(7):
-            date_i = monday_of_week + datetime.timedelta(days=day)
-            date_str = date_i.strftime('%Y-%m-%d')
-            line_day = [date_str, ]
-            line_prop = [date_str, ]
-            for i, age_i in enumerate(age_groups):
-                line_day.append(str(cases_daily_vals[i]))
-                line_prop.append(str(cases_week_prop[i, 2]))
-            line_str_day = ';'.join(line_day)
-            line_str_prop = ';'.join(line_prop)
-            final_lines_day.append(line_str_day)
-            final_lines_prop.append(line_str_prop)
-
-    complete_csv_day = '\n'.join(final_lines_day)
-    complete_csv_prop = '\n'.join(final_lines_prop)
-
-    buffer_for_pandas = StringIO(complete_csv_day)
-    age_cases_daily = pd.read_csv(buffer_for_pandas, sep=";")
-    buffer_for_pandas = StringIO(complete_csv_prop)
-    age_cases_prop = pd.read_csv(buffer_for_pandas, sep=";")
+
+    # Rows sorted by week and age group: values with shape (weeks, age groups)
+    cases_values = cases['val'].values.astype(np.float64).reshape(len(weeks), len(age_groups))
+    prop_values = cases_prop['val'].values.astype(np.float64).reshape(len(weeks), len(age_groups))
+
+    # Augment by day, start on monday and finish sunday (7 days). The
+    # proportions of the week are the ones of every day
+    dates, keep = week_days([transform_thl_week_datetime(week) for week in weeks],
+                            start_date=start_date)
+    cases_daily_values = weekly_to_daily(cases_values)[keep]
+    prop_daily_values = np.broadcast_to(prop_values[:, np.newaxis, :],
+                                        (len(weeks), 7, len(age_groups)))[keep]
+
+    age_cases_daily = pd.DataFrame(data=cases_daily_values, columns=age_groups)
+    age_cases_daily.insert(0, 'Time', dates[keep])
+    age_cases_prop = pd.DataFrame(data=prop_daily_values, columns=age_groups)
+    age_cases_prop.insert(0, 'Time', dates[keep])
     logger.debug('Constructed pandas dataframe')
 
     return age_cases_daily, age_cases_prop
 
 
-def construct_cases_age_erva_daily(logger, number_age_groups=9):
+def construct_cases_age_erva_array(logger, number_age_groups=9, start_date=None):
+    # Detected cases by day, erva and age group: the daily cases of every erva
+    # split with the proportions of the age groups of the day. Returns the
+    # dates, ervas, age groups and the cases with shape (dates, ervas, age
+    # groups). With start_date (YYYY-MM-DD) only the days from start_date
+    # are constructed
     logger.info('Constructing cases by age and erva (daily)')
     _, cases_age_prop = construct_finland_age_cases_daily(logger,
-                                                          number_age_groups=number_age_groups)
-    cases_erva = fetch_thl_cases_erva_daily(logger)
-
-    cases_age_prop_list = cases_age_prop.values
-
-    cases_by_age_erva = []
-    for row_age_prop in cases_age_prop_list:
-        time, *probs = row_age_prop
-
-        cases_erva_date = cases_erva.loc[cases_erva['Time'] == time, ]
-        cases_erva_date = cases_erva_date.values
-        for cases_line in cases_erva_date:
-            _, erva, cases = cases_line
-            cases_ages = cases*np.array(probs)
-
-            new_line = [time, erva, *cases_ages]
-            cases_by_age_erva.append(new_line)
-
+                                                          number_age_groups=number_age_groups,
+                                                          start_date=start_date)
+    cases_erva = fetch_thl_cases_erva_daily(logger, start_date=start_date)
     age_groups = MAPPINGS['age_groups'][number_age_groups]['names']
-    columns = ['Time', 'erva']
-    for age_i in age_groups:
-        columns.append(age_i)
-    cases_by_age_erva = pd.DataFrame(data=cases_by_age_erva, columns=columns)
+
+    # Cases of every date (of the proportions) and erva, NaN when missing
+    dates = cases_age_prop['Time'].values
+    ervas = np.unique(cases_erva['erva'])
+    date_i = pd.Index(dates).get_indexer(cases_erva['Time'])
+    erva_i = pd.Index(ervas).get_indexer(cases_erva['erva'])
+    keep = date_i >= 0
+    cases_date_erva = np.full((len(dates), len(ervas)), np.nan)
+    cases_date_erva[date_i[keep], erva_i[keep]] = cases_erva['val'].values[keep]
+
+    # Only the dates with reported cases, which must have all the ervas
+    reported = ~np.all(np.isnan(cases_date_erva), axis=1)
+    assert not np.any(np.isnan(cases_date_erva[reported]))
+    dates = dates[reported]
+    probs_age = cases_age_prop[age_groups].values.astype(np.float64)[reported]
+    cases_by_age_erva = split_by_age(cases_date_erva[reported], probs_age[:, np.newaxis, :])
+
+    return dates, ervas, age_groups, cases_by_age_erva
+
+
+def construct_cases_age_erva_daily(logger, number_age_groups=9, start_date=None):
+    # construct_cases_age_erva_array as a dataframe with the columns Time,
+    # erva and the age groups, rows by date and erva
+    dates, ervas, age_groups, cases_by_age_erva = construct_cases_age_erva_array(
+        logger, number_age_groups=number_age_groups, start_date=start_date
+    )
+    num_dates, num_ervas, num_ages = cases_by_age_erva.shape
+    cases_by_age_erva = pd.DataFrame(data=cases_by_age_erva.reshape(num_dates*num_ervas, num_ages),
+                                     columns=age_groups)
+    cases_by_age_erva.insert(0, 'Time', np.repeat(dates, num_ervas))
+    cases_by_age_erva.insert(1, 'erva', np.tile(ervas, num_dates))
 
     return cases_by_age_erva
@@ -1,24 +1,282 @@
 import numpy as np
 import pandas as pd
+import hashlib
 import logging
+import os
+import tempfile
 from fetch_data import (
     static_population_erva_age,
 )
 from scipy.linalg import eigvals
+from scipy.sparse.linalg import LinearOperator, eigs
+from epidemic_store import STATE_COLUMNS, read_epidemic_state
+from numba_kernels import (
+    age_parameters, check_numba, epidemic_rates, forward_step
+)
 from env_var import EPIDEMIC, EXPERIMENTS
 
 
+def mobility_kernel(mob, pop_hat):
+    # theta_km*theta_lm/N_hat_m summed over the visited erva m
+    # Leading axes in mob and pop_hat are broadcasted (e.g. scenarios)
+    return (mob/pop_hat[..., np.newaxis, :]) @ np.swapaxes(mob, -1, -2)
+
+
+def force_of_infection(I_h, c_gh, kernel, age_er):
+    # Force of infection (without beta) for every age group g and erva k:
+    # sum_h sum_l c_gh[h, g]*kernel[k, l]*I_h[h, l]*age_er[l, h]
+    # Leading axes in I_h, c_gh and kernel are broadcasted (e.g. scenarios)
+    infectious = I_h*age_er.T
+    return np.swapaxes(c_gh, -1, -2) @ infectious @ np.swapaxes(kernel, -1, -2)
+
+
+def allocate_vaccines(u_j, u_erva, S_left, age_er, age_group_indicators):
+    # Greedy allocation of the vaccines of each erva (u_erva) starting
+    # from the oldest age group. S_left are the susceptibles remaining
+    # after the infections of the timestep. u_j, u_erva and
+    # age_group_indicators are modified in place.
+    # Returns the vaccines that could not be used in this timestep
+    num_ervas, num_age_groups = age_er.shape
+    N_p = num_ervas
+    N_g = num_age_groups
+
+    remain_last = 0
+    # Go over all ervas
+    for n in range(N_p):
+        # Go over all age groups starting from the last one
+        for g in range(N_g-1, -1, -1):
+            # Enter if no one else is missing to vaccinate in age g,
+            # region n and timestep j
+            if S_left[g, n] <= 0:
+                # Continue to next age group
+                age_group_indicators[n] = g - 1
+
+                # If we reach here it means  that we have vaccines
+                # that we are not going to use. Distribute to next erva
+                if g <= 1 and u_erva[n] > 0:
+                    if n+1 < N_p:
+                        u_erva[n+1] += u_erva[n]
+                        u_erva[n] = 0
+                    else:
+                        # If the next erva is the last one then to next timestep
+                        remain_last += u_erva[n]
+
+            # Assign the vaccines to the current age group and erva
+            age_group_indicator = age_group_indicators[n]
+            if age_group_indicator == g and g > 1:
+                # Get the total amount of vaccines
+                u_j[g, n] += u_erva[n]/age_er[n, g]
+
+                u_erva[n] = 0
+
+                # Check for leftovers in the current age group
+                all_aplied = S_left[g, n] - u_j[g, n]
+                # We have some leftovers
+                if all_aplied < 0:
+                    # Indicate that we should continue to next age group
+                    age_group_indicators[n] = g - 1
+                    # Get the number of leftovers
+                    left_over = np.abs(all_aplied)
+                    left_over_real = left_over*age_er[n, g]
+                    # The next age group will only have the lefotvers
+                    if g-1 >= 0:
+                        u_erva[n] = left_over_real
+                    # If we finnish with the age groups then give to the next erva
+                    elif n+1 < N_p:
+                        u_erva[n+1] += left_over_real
+                    # If it was the last erva then keep the vaccines for next timestep
+                    else:
+                        remain_last += left_over_real
+            elif g <= 1:
+                if u_erva[n] > 0:
+                    if n+1 < N_p:
+                        u_erva[n+1] += u_erva[n]
+                        u_erva[n] = 0
+                    else:
+                        # If the next erva is the last one then to next timestep
+                        remain_last += u_erva[n]
+
+    return remain_last
+
+
+def get_metric_erva_weigth(metric_erva, use_ervas):
+    # Normalized metric (infectious or hospitalized) per erva.
+    # metric_erva are the counts of the last period summed over the age groups
+
+    # If all the values are close to 0 then assign 1 to all ervas
+    # This case can happen at the beginning when we have no hospitalizations
+    if np.allclose(metric_erva, 0):
+        metric_erva = np.ones(metric_erva.shape)
+
+    # Preallocate an array with 0s
+    metric_erva_norm = np.zeros(metric_erva.shape)
+    # Use_ervas is a boolean flag to indicate
+    # which ERVAs have not finished vaccination. Use only these to normalize
+    use_metric_ervas = metric_erva[use_ervas]
+    metric_t_erva = use_metric_ervas/np.sum(use_metric_ervas)
+    # The rest of the ervas will have a count of 0
+    metric_erva_norm[use_ervas] = metric_t_erva
+
+    return metric_erva_norm
+
+
+def allocate_policy_vaccines(u_j, u_con, remain_last, hosp_t, infe_t, S_left,
+                             ws_vacc, use_policy, age_er, age_group_indicators):
+    # Assigns the u_con vaccines of timestep j of the scenarios that follow
+    # the policy weights. hosp_t and infe_t are the counts of the last period
+    # per scenario and erva and S_left the susceptibles left after the
+    # infections. u_j, remain_last and age_group_indicators are modified in place
+    pop_erva = age_er.sum(axis=1)
+    for s in np.flatnonzero(use_policy):
+        # Sum the remaining vaccines from the last timestep if any
+        u_con_remain = u_con + remain_last[s]
+        remain_last[s] = 0
+
+        # Checking which ervas have still people to be vaccinated
+        use_ervas = age_group_indicators[s] != -1
+
+        # Proportional population of the ERVA
+        pops_erva_prop = np.zeros(pop_erva.shape)
+        # Only getting the missing ervas
+        use_pops = pop_erva[use_ervas]
+        # Normalizing with the population of the missing ervas
+        use_pops_prop = use_pops/np.sum(use_pops)
+        pops_erva_prop[use_ervas] = use_pops_prop
+
+        # Get the normalized counts of infected people and hosp
+        hosp_norm = get_metric_erva_weigth(hosp_t[s], use_ervas)
+        infe_norm = get_metric_erva_weigth(infe_t[s], use_ervas)
+        # Construct the final policy
+        ws = ws_vacc[s]
+        policy = ws[0]*pops_erva_prop + ws[1]*infe_norm + ws[2]*hosp_norm
+
+        # Get the vaccines assigned to each erva
+        u_erva = u_con_remain*policy
+
+        remain_last[s] = allocate_vaccines(u_j[s], u_erva, S_left[s], age_er,
+                                           age_group_indicators[s])
+
+
+# Compartments of the model in the order used by compartments_step
+COMPARTMENTS = ('S_g', 'S_xg', 'S_vg', 'S_pg', 'V_g', 'E_g', 'E2_g', 'I_g',
+                'I2_g', 'Q_0g', 'Q_1g', 'H_wg', 'H_cg', 'H_rg', 'R_g', 'D_g')
+
+
+def compartments_step(x, u_j, beta_s, lambda_j, e, age_params):
+    # Vectorized timestep of system of equations (1). x has the compartments
+    # of timestep j with shape (..., N_g, N_p) and u_j the vaccines assigned
+    # in timestep j. Returns the vaccines actually applied and the
+    # compartments of timestep j+1
+    T_E = EPIDEMIC['T_E']
+    T_V = EPIDEMIC['T_V']
+    T_I = EPIDEMIC['T_I']
+    T_q0 = EPIDEMIC['T_q0']
+    T_q1 = EPIDEMIC['T_q1']
+    T_hw = EPIDEMIC['T_hw']
+    T_hc = EPIDEMIC['T_hc']
+    T_hr = EPIDEMIC['T_hr']
+    omega = EPIDEMIC['omega']
+    pi = EPIDEMIC['pi']
+    # Per age group parameters broadcasted over the ervas
+    mu_q_g, mu_w_g, mu_c_g, p_H_g, p_c_g = age_params[:, :, np.newaxis]
+
+    S_g = x['S_g']
+    S_xg = x['S_xg']
+    S_vg = x['S_vg']
+    S_pg = x['S_pg']
+    V_g = x['V_g']
+    E_g = x['E_g']
+    E2_g = x['E2_g']
+    I_g = x['I_g']
+    I2_g = x['I2_g']
+    Q_0g = x['Q_0g']
+    Q_1g = x['Q_1g']
+    H_wg = x['H_wg']
+    H_cg = x['H_cg']
+    H_rg = x['H_rg']
+    R_g = x['R_g']
+    D_g = x['D_g']
+
+    # Ensures that we do not keep vaccinating after there are no susceptibles left
+    u_j = np.minimum(u_j, np.maximum(0.0, S_g - beta_s*lambda_j*S_g))
+
+    x_1 = {
+        'S_g': S_g - beta_s*lambda_j*S_g - u_j,
+        'S_xg': S_xg - beta_s*lambda_j*S_xg,
+        'S_vg': S_vg - beta_s*lambda_j*S_vg + u_j - T_V*S_vg,
+        'S_pg': S_pg - omega*beta_s*lambda_j*S_pg + (1.-e)*T_V*S_vg,
+        'V_g': V_g + e*T_V*S_vg,
+        'E_g': E_g + beta_s*lambda_j*(S_g+S_vg +S_xg )  - T_E*E_g,
+        'E2_g': E2_g + omega*beta_s*lambda_j*S_pg  - T_E*E2_g,
+        'I_g': I_g + T_E*E_g - T_I*I_g,
+        'I2_g': I2_g + T_E*E2_g - T_I*I2_g,
+        'Q_0g': Q_0g + (1.-p_H_g)*T_I*I_g - T_q0*Q_0g + (1.-pi*p_H_g)*T_I*I2_g,
+        'Q_1g': Q_1g + p_H_g*T_I*I_g + pi*p_H_g*T_I*I2_g - T_q1*Q_1g,
+        'H_wg': H_wg + T_q1*Q_1g - T_hw*H_wg,
+        'H_cg': H_cg + p_c_g*T_hw*H_wg - T_hc*H_cg,
+        'H_rg': H_rg + (1.-mu_c_g)*T_hc*H_cg - T_hr*H_rg,
+        'R_g': R_g + T_hr*H_rg + (1.-mu_w_g)*(1.-p_c_g)*T_hw*H_wg + (1.-mu_q_g)*T_q0*Q_0g,
+        'D_g': D_g + mu_q_g*T_q0*Q_0g+mu_w_g*(1.-p_c_g)*T_hw*H_wg + mu_c_g*T_hc*H_cg,
+    }
+
+    return u_j, x_1
+
+
 def forward_integration(u_con, c1, beta, c_gh, T, pop_hat, age_er,
                         t0, ws_vacc, e, epidemic_npy, init_vacc, checks=False,
-                        u_op_file=None):
+                        u_op_file=None, backend='numpy', u_op=None):
+    # Single scenario run, a batch of one in forward_integration_batch
+    # The optimized strategy is u_op or the one in u_op_file
+    if u_op_file is not None:
+        u_op = np.load(u_op_file)
+
+    outputs = forward_integration_batch(u_con,
+                                        c1[np.newaxis],
+                                        [beta],
+                                        c_gh[np.newaxis],
+                                        T,
+                                        pop_hat[np.newaxis],
+                                        age_er,
+                                        [ws_vacc],
+                                        e,
+                                        epidemic_npy,
+                                        u_op=[u_op],
+                                        checks=checks,
+                                        backend=backend)
+
+    return tuple(output[0] for output in outputs)
+
+
+def forward_integration_batch(u_con, c1, beta, c_gh, T, pop_hat, age_er,
+                              ws_vacc, e, epidemic_npy, u_op=None,
+                              checks=False, backend='numpy'):
+    # Integrates several scenarios at once. The scenarios are stacked in
+    # the leading axis of the parameters and of all the compartments:
+    # c1 (N_s, N_p, N_p), beta (N_s, ), c_gh (N_s, N_g, N_g), pop_hat (N_s, N_p).
+    # ws_vacc is a list with the N_s policy weights and u_op a list with
+    # the N_s precomputed strategies (None to use the policy weights).
+    # backend='numpy' runs the vectorized stepper, backend='python' updates
+    # the compartments one age group and erva at a time (reference) and
+    # backend='numba' runs the reference operations compiled with numba
+    if backend not in ('numpy', 'python', 'numba'):
+        raise ValueError('Unknown backend: %s' % (backend, ))
+    if backend == 'numba':
+        check_numba()
+
     # number of age groups and ervas
     num_ervas, num_age_groups = age_er.shape
     N_p = num_ervas
     N_g = num_age_groups
     N_t = T
+    N_s = len(ws_vacc)
     omega = EPIDEMIC['omega']
     pi = EPIDEMIC['pi']
-    
+
+    if u_op is None:
+        u_op = [None]*N_s
+    beta = np.asarray(beta, dtype=np.float64)
+    assert beta.shape == (N_s, ) and len(u_op) == N_s
+
     # Time periods for epidemic
     T_E = EPIDEMIC['T_E']
     T_V = EPIDEMIC['T_V']
@@ -41,274 +299,330 @@ def forward_integration(u_con, c1, beta, c_gh, T, pop_hat, age_er,
     p_c = EPIDEMIC['p_c'][num_age_groups]
     alpha = EPIDEMIC['alpha']
 
-    pop_erva = age_er.sum(axis=1)
     # Initializing all group indicators in the last group
-    age_group_indicators = np.array([N_g-1]*N_p)
+    age_group_indicators = np.full((N_s, N_p), N_g-1)
     delay_check_vacc = EPIDEMIC['delay_check_vacc']
 
     # Initialize vaccination rate
-    u = np.zeros((N_g, N_p, N_t))
-    if u_op_file is None:
-        assert np.isclose(np.sum(ws_vacc), 0) or np.isclose(np.sum(ws_vacc), 1)
-    else:
-        u_load = np.load(u_op_file)
-        t_u_load = u_load.shape[-1]
-        u[:, :, :t_u_load] = u_load
+    u = np.zeros((N_s, N_g, N_p, N_t))
+    # Scenarios that follow the policy weights instead of a precomputed strategy
+    use_policy = np.array([u_op_s is None for u_op_s in u_op])
+    for s in range(N_s):
+        if use_policy[s]:
+            assert np.isclose(np.sum(ws_vacc[s]), 0) or np.isclose(np.sum(ws_vacc[s]), 1)
+        else:
+            u_load = u_op[s]
+            t_u_load = u_load.shape[-1]
+            u[s, :, :, :t_u_load] = u_load
+
+            assert np.all(u[s, :, :, :t_u_load] == u_load)
 
-        assert np.all(u[:, :, :t_u_load] == u_load)
-
-    # Allocating space for compartments
     # Allocating space for compartments
-    S_g = np.zeros((N_g, N_p, N_t))
-    I_g = np.zeros((N_g, N_p, N_t))
-    E_g = np.zeros((N_g, N_p, N_t))
-    R_g = np.zeros((N_g, N_p, N_t))
-    V_g = np.zeros((N_g, N_p, N_t))
-    H_wg = np.zeros((N_g, N_p, N_t))
-    H_cg = np.zeros((N_g, N_p, N_t))
-    S_xg = np.zeros((N_g, N_p, N_t))
-    I2_g = np.zeros((N_g, N_p, N_t))
-    E2_g = np.zeros((N_g, N_p, N_t))
-    S_pg = np.zeros((N_g, N_p, N_t))
-    D_g = np.zeros((N_g, N_p, N_t))
-    Q_0g = np.zeros((N_g, N_p, N_t))
-    Q_1g = np.zeros((N_g, N_p, N_t))
-    H_rg = np.zeros((N_g, N_p, N_t))
-    S_vg = np.zeros((N_g, N_p, N_t))
-
-    # Initializing with CSV values
-    S_g[:, :, 0] = epidemic_npy[:, :, 0]
-    I_g[:, :, 0] = 0.9*epidemic_npy[:, :, 1]
-    I2_g[:, :, 0] = 0.1*epidemic_npy[:, :, 1]
-    E_g[:, :, 0] = 0.9*epidemic_npy[:, :, 2]
-    E2_g[:, :, 0] = 0.1*epidemic_npy[:, :, 2]
-    R_g[:, :, 0] = epidemic_npy[:, :, 3]
-    V_g[:, :, 0] = epidemic_npy[:, :, 4]
-    S_xg[:, :, 0] = epidemic_npy[:, :, 5]
-    H_wg[:, :, 0] = epidemic_npy[:, :, 6]
-    H_cg[:, :, 0] = epidemic_npy[:, :, 7]
-
-    hospitalized_incidence = np.zeros((N_g, N_p, N_t))
-    infections_incidence = np.zeros((N_g, N_p, N_t))
+    S_g = np.zeros((N_s, N_g, N_p, N_t))
+    I_g = np.zeros((N_s, N_g, N_p, N_t))
+    E_g = np.zeros((N_s, N_g, N_p, N_t))
+    R_g = np.zeros((N_s, N_g, N_p, N_t))
+    V_g = np.zeros((N_s, N_g, N_p, N_t))
+    H_wg = np.zeros((N_s, N_g, N_p, N_t))
+    H_cg = np.zeros((N_s, N_g, N_p, N_t))
+    S_xg = np.zeros((N_s, N_g, N_p, N_t))
+    I2_g = np.zeros((N_s, N_g, N_p, N_t))
+    E2_g = np.zeros((N_s, N_g, N_p, N_t))
+    S_pg = np.zeros((N_s, N_g, N_p, N_t))
+    D_g = np.zeros((N_s, N_g, N_p, N_t))
+    Q_0g = np.zeros((N_s, N_g, N_p, N_t))
+    Q_1g = np.zeros((N_s, N_g, N_p, N_t))
+    H_rg = np.zeros((N_s, N_g, N_p, N_t))
+    S_vg = np.zeros((N_s, N_g, N_p, N_t))
+
+    # Initializing with CSV values, the same for all the scenarios
+    S_g[..., 0] = epidemic_npy[:, :, 0]
+    I_g[..., 0] = 0.9*epidemic_npy[:, :, 1]
+    I2_g[..., 0] = 0.1*epidemic_npy[:, :, 1]
+    E_g[..., 0] = 0.9*epidemic_npy[:, :, 2]
+    E2_g[..., 0] = 0.1*epidemic_npy[:, :, 2]
+    R_g[..., 0] = epidemic_npy[:, :, 3]
+    V_g[..., 0] = epidemic_npy[:, :, 4]
+    S_xg[..., 0] = epidemic_npy[:, :, 5]
+    H_wg[..., 0] = epidemic_npy[:, :, 6]
+    H_cg[..., 0] = epidemic_npy[:, :, 7]
+
+    hospitalized_incidence = np.zeros((N_s, N_g, N_p, N_t))
+    infections_incidence = np.zeros((N_s, N_g, N_p, N_t))
 
     # I store the values for the force of infection (needed for the adjoint equations)
-    L_g = np.zeros((N_g, N_p, N_t))
-
-    # Function to calculate the force of infection
-    def force_of_inf(I_h, c_gh, k, N_g, N_p, mob, pop_hat,I_2):
-        fi = 0.0
-        for h in range(N_g):
-            for m in range(N_p):
-                for l in range(N_p):
-                    fi = fi + (mob[k, m]*mob[l, m]*(I_h[h, l]+I_2[h,l])*c_gh[h]*age_er[l, h])/pop_hat[m]
-        return fi
-
-    # Short method to get the normalized metric (infectious or hospitalized)
-    # In the lat t-delay period
-    def get_metric_erva_weigth(metric, t, delay, use_ervas):
-        tot_delay = t - delay
-        if tot_delay < 0:
-            tot_delay = 0
-
-        # Get the counts in the last period
-        metric_t = metric[:, :, tot_delay:t]
-
-        assert metric_t.shape[2] <= delay
-
-        # Sum over all time
-        metric_t = metric_t.sum(axis=2)
-        # Metric_t is a proportion of erva and age group
-        # Here transforming to actual number
-        metric_t = metric_t*age_er.T
-        # Sum over all age groups
-        metric_t_all_ages = metric_t.sum(axis=0)
-
-        # If all the values are close to 0 then assign 1 to all ervas
-        # This case can happen at the beginning when we have no hospitalizations
-        if np.allclose(metric_t_all_ages, 0):
-            metric_t_all_ages[:] = 1
-
-        # Preallocate an array with 0s
-        metric_t_erva_norm = np.zeros(metric_t_all_ages.shape)
-        # Use_ervas is a boolean flag to indicate
-        # which ERVAs have not finished vaccination. Use only these to normalize
-        use_metric_ervas = metric_t_all_ages[use_ervas]
-        metric_t_erva = use_metric_ervas/np.sum(use_metric_ervas)
-        # The rest of the ervas will have a count of 0
-        metric_t_erva_norm[use_ervas] = metric_t_erva
-
-        return metric_t_erva_norm, metric_t_all_ages
+    L_g = np.zeros((N_s, N_g, N_p, N_t))
+
+    # Mobility operator shared by the force of infection of every timestep
+    kernel = mobility_kernel(c1, pop_hat)
+
+    # Parameters packed for the numba stepper
+    rates = epidemic_rates(EPIDEMIC)
+    age_params = age_parameters(EPIDEMIC, num_age_groups)
+
+    # beta broadcasted over (scenario, age group, erva)
+    beta_s = beta[:, np.newaxis, np.newaxis]
+    # Compartments by name for the vectorized stepper
+    compartments = {
+        'S_g': S_g, 'S_xg': S_xg, 'S_vg': S_vg, 'S_pg': S_pg, 'V_g': V_g,
+        'E_g': E_g, 'E2_g': E2_g, 'I_g': I_g, 'I2_g': I2_g, 'Q_0g': Q_0g,
+        'Q_1g': Q_1g, 'H_wg': H_wg, 'H_cg': H_cg, 'H_rg': H_rg, 'R_g': R_g,
+        'D_g': D_g
+    }
 
     # Variable to store the spare vaccines from the last timestep
-    remain_last = 0
+    remain_last = np.zeros(N_s)
     # Forward integration for system of equations (1)
     for j in range(N_t-1):
-        if u_op_file is None:
-            # Sum the remaining vaccines from the last timestep if any
-            u_con_remain = u_con + remain_last
-            remain_last = 0
-
-            # Checking which ervas have still people to be vaccinated
-            use_ervas = age_group_indicators != -1
-
-            # Proportional population of the ERVA
-            pops_erva_prop = np.zeros(pop_erva.shape)
-            # Only getting the missing ervas
-            use_pops = pop_erva[use_ervas]
-            # Normalizing with the population of the missing ervas
-            use_pops_prop = use_pops/np.sum(use_pops)
-            pops_erva_prop[use_ervas] = use_pops_prop
-
-            # Get the normalized counts of infected people and hosp
-            hosp_norm, hosp = get_metric_erva_weigth(H_wg+H_cg+H_rg, j, delay_check_vacc, use_ervas)
-            infe_norm, infe = get_metric_erva_weigth(infections_incidence, j, delay_check_vacc, use_ervas)
-            # Construct the final policy
-            policy = ws_vacc[0]*pops_erva_prop + ws_vacc[1]*infe_norm + ws_vacc[2]*hosp_norm
-
-            # Get the vaccines assigned to each erva
-            u_erva = u_con_remain*policy
-
-        # Go over all ervas
-        for n in range(N_p):
-            # Go over all age groups starting from the last one
-            for g in range(N_g-1, -1, -1):
-                # Calculate the force of infection
-                lambda_g = force_of_inf(I_g[:, :, j], c_gh[:, g], n, N_g, N_p, c1, pop_hat,I2_g[:,:,j])
-                L_g[g, n, j] = beta*lambda_g
-
-                if u_op_file is None:
-                    # Enter if no one else is missing to vaccinate in age g,
-                    # region n and timestep j
-                    if S_g[g, n, j] - beta*lambda_g*S_g[g, n, j] <= 0:
-                        # Continue to next age group
-                        age_group_indicators[n] = g - 1
-
-                        # If we reach here it means  that we have vaccines
-                        # that we are not going to use. Distribute to next erva
-                        if g <= 1 and u_erva[n] > 0:
-                            print('AAA ENTER')
-                            if n+1 < N_p:
-                                u_erva[n+1] += u_erva[n]
-                                u_erva[n] = 0
-                            else:
-                                # If the next erva is the last one then to next timestep
-                                remain_last += u_erva[n]
-
-                    # Assign the vaccines to the current age group and erva
-                    age_group_indicator = age_group_indicators[n]
-                    if age_group_indicator == g and g > 1:
-                        # Get the total amount of vaccines
-                        u[g, n, j] += u_erva[n]/age_er[n, g]
-
-                        u_erva[n] = 0
-
-                        # Check for leftovers in the current age group
-                        all_aplied = S_g[g, n, j] - beta*lambda_g*S_g[g, n, j] - u[g, n, j]
-                        # We have some leftovers
-                        if all_aplied < 0:
-                            # Indicate that we should continue to next age group
-                            age_group_indicators[n] = g - 1
-                            # Get the number of leftovers
-                            left_over = np.abs(all_aplied)
-                            left_over_real = left_over*age_er[n, g]
-                            # The next age group will only have the lefotvers
-                            if g-1 >= 0:
-                                u_erva[n] = left_over_real
-                            # If we finnish with the age groups then give to the next erva
-                            elif n+1 < N_p:
-                                u_erva[n+1] += left_over_real
-                            # If it was the last erva then keep the vaccines for next timestep
-                            else:
-                                remain_last += left_over_real
-                    elif g <= 1:
-                        if u_erva[n] > 0:
-                            if n+1 < N_p:
-                                u_erva[n+1] += u_erva[n]
-                                u_erva[n] = 0
-                            else:
-                                # If the next erva is the last one then to next timestep
-                                remain_last += u_erva[n]
-
-                # if g == 0 or g == 1:
-                #     u[g, n, j] = 0
-
-                # Ensures that we do not keep vaccinating after there are no susceptibles left
-                u[g, n, j] = min(u[g, n, j], max(0.0, S_g[g, n, j] - beta*lambda_g*S_g[g, n, j]))
-                
-                S_g[g, n, j+1] = S_g[g, n, j] - beta*lambda_g*S_g[g, n, j] - u[g, n, j]
-                S_xg[g, n, j+1] = S_xg[g, n, j] - beta*lambda_g*S_xg[g, n, j] 
-                S_vg[g, n, j+1] = S_vg[g, n, j] - beta*lambda_g*S_vg[g, n, j] + u[g, n, j] - T_V*S_vg[g, n, j]
-                S_pg[g, n, j+1] = S_pg[g, n, j] - omega*beta*lambda_g*S_pg[g, n, j] + (1.-e)*T_V*S_vg[g, n, j]
-                V_g[g, n, j+1] = V_g[g, n, j] + e*T_V*S_vg[g, n, j]
-                E_g[g, n, j+1] = E_g[g, n, j] + beta*lambda_g*(S_g[g, n, j]+S_vg[g, n, j] +S_xg[g, n, j] )  - T_E*E_g[g, n, j]
-                E2_g[g, n, j+1] = E2_g[g, n, j] + omega*beta*lambda_g*S_pg[g, n, j]  - T_E*E2_g[g, n, j]                      
-                I_g[g, n, j+1] = I_g[g, n, j] + T_E*E_g[g, n, j] - T_I*I_g[g, n, j]
-                I2_g[g, n, j+1] = I2_g[g, n, j] + T_E*E2_g[g, n, j] - T_I*I2_g[g, n, j]
-                Q_0g[g, n, j+1] = Q_0g[g, n, j] + (1.-p_H[g])*T_I*I_g[g, n, j] - T_q0*Q_0g[g, n, j] + (1.-pi*p_H[g])*T_I*I2_g[g, n, j]
-                Q_1g[g, n, j+1] = Q_1g[g, n, j] + p_H[g]*T_I*I_g[g, n, j] + pi*p_H[g]*T_I*I2_g[g, n, j] - T_q1*Q_1g[g, n, j]
-                H_wg[g, n, j+1] = H_wg[g, n, j] + T_q1*Q_1g[g, n, j] - T_hw*H_wg[g, n, j]
-                H_cg[g, n, j+1] = H_cg[g, n, j] + p_c[g]*T_hw*H_wg[g, n, j] - T_hc*H_cg[g, n, j]
-                H_rg[g, n, j+1] = H_rg[g, n, j] + (1.-mu_c[g])*T_hc*H_cg[g, n, j] - T_hr*H_rg[g, n, j]
-                R_g[g, n, j+1] = R_g[g, n, j] + T_hr*H_rg[g, n, j] + (1.-mu_w[g])*(1.-p_c[g])*T_hw*H_wg[g, n, j] + (1.-mu_q[g])*T_q0*Q_0g[g, n, j]
-                D_g[g, n, j+1] = D_g[g, n, j] + mu_q[g]*T_q0*Q_0g[g, n, j]+mu_w[g]*(1.-p_c[g])*T_hw*H_wg[g, n, j] + mu_c[g]*T_hc*H_cg[g, n, j]
-     
-                
-                hospitalized_incidence[g, n, j] = T_q1*Q_1g[g, n, j]
-                infections_incidence[g, n, j] = T_E*E_g[g, n, j]
-
-    hospitalized_incidence[:, :, T-1] = T_q1*Q_1g[:, :, T-1]
-    infections_incidence[:, :, T-1] = T_E*E_g[:, :, T-1]
+        # Force of infection for all scenarios, age groups and ervas in timestep j
+        lambda_j = force_of_infection(I_g[..., j] + I2_g[..., j], c_gh, kernel, age_er)
+        L_g[..., j] = beta_s*lambda_j
+
+        if np.any(use_policy):
+            # Counts of hospitalized and new infected in the last period
+            # In the lat t-delay period. Transforming the proportions of
+            # erva and age group to actual numbers and summing over age groups
+            tot_delay = max(j - delay_check_vacc, 0)
+            hosp_t = (H_wg[..., tot_delay:j] + H_cg[..., tot_delay:j] + H_rg[..., tot_delay:j]).sum(axis=-1)
+            hosp_t = (hosp_t*age_er.T).sum(axis=1)
+            infe_t = infections_incidence[..., tot_delay:j].sum(axis=-1)
+            infe_t = (infe_t*age_er.T).sum(axis=1)
+
+            # Susceptibles left in timestep j after the infections
+            S_left = S_g[..., j] - L_g[..., j]*S_g[..., j]
+
+            allocate_policy_vaccines(u[..., j], u_con, remain_last, hosp_t, infe_t,
+                                     S_left, ws_vacc, use_policy, age_er,
+                                     age_group_indicators)
+
+        if backend == 'python':
+            # Reference implementation, updating one age group and erva at a time
+            for s in range(N_s):
+                beta_c = beta_s[s, 0, 0]
+                for n in range(N_p):
+                    for g in range(N_g-1, -1, -1):
+                        lambda_g = lambda_j[s, g, n]
+                        c = (s, g, n, j)
+                        c_1 = (s, g, n, j+1)
+
+                        # Ensures that we do not keep vaccinating after there are no susceptibles left
+                        u[c] = min(u[c], max(0.0, S_g[c] - beta_c*lambda_g*S_g[c]))
+
+                        S_g[c_1] = S_g[c] - beta_c*lambda_g*S_g[c] - u[c]
+                        S_xg[c_1] = S_xg[c] - beta_c*lambda_g*S_xg[c]
+                        S_vg[c_1] = S_vg[c] - beta_c*lambda_g*S_vg[c] + u[c] - T_V*S_vg[c]
+                        S_pg[c_1] = S_pg[c] - omega*beta_c*lambda_g*S_pg[c] + (1.-e)*T_V*S_vg[c]
+                        V_g[c_1] = V_g[c] + e*T_V*S_vg[c]
+                        E_g[c_1] = E_g[c] + beta_c*lambda_g*(S_g[c]+S_vg[c] +S_xg[c] )  - T_E*E_g[c]
+                        E2_g[c_1] = E2_g[c] + omega*beta_c*lambda_g*S_pg[c]  - T_E*E2_g[c]
+                        I_g[c_1] = I_g[c] + T_E*E_g[c] - T_I*I_g[c]
+                        I2_g[c_1] = I2_g[c] + T_E*E2_g[c] - T_I*I2_g[c]
+                        Q_0g[c_1] = Q_0g[c] + (1.-p_H[g])*T_I*I_g[c] - T_q0*Q_0g[c] + (1.-pi*p_H[g])*T_I*I2_g[c]
+                        Q_1g[c_1] = Q_1g[c] + p_H[g]*T_I*I_g[c] + pi*p_H[g]*T_I*I2_g[c] - T_q1*Q_1g[c]
+                        H_wg[c_1] = H_wg[c] + T_q1*Q_1g[c] - T_hw*H_wg[c]
+                        H_cg[c_1] = H_cg[c] + p_c[g]*T_hw*H_wg[c] - T_hc*H_cg[c]
+                        H_rg[c_1] = H_rg[c] + (1.-mu_c[g])*T_hc*H_cg[c] - T_hr*H_rg[c]
+                        R_g[c_1] = R_g[c] + T_hr*H_rg[c] + (1.-mu_w[g])*(1.-p_c[g])*T_hw*H_wg[c] + (1.-mu_q[g])*T_q0*Q_0g[c]
+                        D_g[c_1] = D_g[c] + mu_q[g]*T_q0*Q_0g[c]+mu_w[g]*(1.-p_c[g])*T_hw*H_wg[c] + mu_c[g]*T_hc*H_cg[c]
+
+                        hospitalized_incidence[c] = T_q1*Q_1g[c]
+                        infections_incidence[c] = T_E*E_g[c]
+        elif backend == 'numba':
+            # Compiled stepper, same operations as the reference implementation
+            forward_step(j, beta, lambda_j, e, omega, pi, rates, age_params, u,
+                         S_g, S_xg, S_vg, S_pg, V_g, E_g, E2_g, I_g, I2_g, Q_0g, Q_1g,
+                         H_wg, H_cg, H_rg, R_g, D_g, hospitalized_incidence,
+                         infections_incidence)
+        else:
+            # Vectorized stepper, all scenarios, age groups and ervas in one go
+            x = {name: compartments[name][..., j] for name in COMPARTMENTS}
+            u[..., j], x_1 = compartments_step(x, u[..., j], beta_s, lambda_j, e, age_params)
+            for name in COMPARTMENTS:
+                compartments[name][..., j+1] = x_1[name]
+
+            hospitalized_incidence[..., j] = T_q1*Q_1g[..., j]
+            infections_incidence[..., j] = T_E*E_g[..., j]
+
+    hospitalized_incidence[..., T-1] = T_q1*Q_1g[..., T-1]
+    infections_incidence[..., T-1] = T_E*E_g[..., T-1]
 
     if checks:
         # Final check to see that we always vaccinate u_con people
         u_final = u*age_er.T[:, :, np.newaxis]
         # Sum across all regions and age groups, Get vacc per time
-        u_final = u_final.sum(axis=(0, 1))
+        u_final = u_final.sum(axis=(1, 2))
         print(u_final)
         print(np.where(~np.isclose(u_final, u_con)))
 
     return S_g, E_g, H_wg, H_cg, H_rg, I_g, D_g, u, hospitalized_incidence, infections_incidence
 
 
-def read_initial_values(age_er, init_vacc, t0):
+# Observables that forward_integration_stream can record. Each one maps the
+# values of a timestep (compartments, 'u', 'hospitalized_incidence',
+# 'infections_incidence' and 'deaths_incidence', all proportions of the age
+# group and erva) and age_er_prop (N_g, N_p) to the value to store.
+# Names and scales are the ones used by the results of experiments.py
+OBSERVABLES = {
+    'total hospitalizations': lambda x, age_er_prop: (x['H_wg'] + x['H_cg'] + x['H_rg'])*age_er_prop,
+    'infectious people': lambda x, age_er_prop: x['I_g']*age_er_prop,
+    'incidence': lambda x, age_er_prop: x['infections_incidence']*age_er_prop,
+    'mortality': lambda x, age_er_prop: x['deaths_incidence']*age_er_prop,
+    'vaccinations': lambda x, age_er_prop: x['u']*age_er_prop,
+    'vaccinations_raw': lambda x, age_er_prop: x['u'],
+    'new hospitalizations': lambda x, age_er_prop: x['hospitalized_incidence']*age_er_prop,
+}
+
+
+def register_observable(name, observable):
+    # Adds an observable with the signature of the ones in OBSERVABLES
+    OBSERVABLES[name] = observable
+
+
+def aggregate_observable(values, aggregate):
+    # values have shape (N_s, N_g, N_p)
+    if aggregate is None:
+        return values
+    elif aggregate == 'age':
+        return values.sum(axis=1)
+    elif aggregate == 'erva':
+        return values.sum(axis=2)
+    elif aggregate == 'all':
+        return values.sum(axis=(1, 2))
+    else:
+        raise ValueError('Unknown aggregate: %s' % (aggregate, ))
+
+
+def forward_integration_stream(u_con, c1, beta, c_gh, T, pop_hat, age_er,
+                               ws_vacc, e, epidemic_npy, observables,
+                               u_op=None, aggregate=None):
+    # Same integration as forward_integration_batch (numpy backend) but only
+    # the compartments of the current timestep are kept in memory.
+    # observables is a list of names in OBSERVABLES. The recorded values have
+    # shape (N_s, N_g, N_p, N_t) or are summed over the age groups
+    # (aggregate='age'), the ervas (aggregate='erva') or both (aggregate='all').
+    # Returns a dictionary with the values of every observable
     num_ervas, num_age_groups = age_er.shape
     N_p = num_ervas
     N_g = num_age_groups
+    N_t = T
+    N_s = len(ws_vacc)
+
+    if u_op is None:
+        u_op = [None]*N_s
+    beta = np.asarray(beta, dtype=np.float64)
+    assert beta.shape == (N_s, ) and len(u_op) == N_s
+    for name in observables:
+        if name not in OBSERVABLES:
+            raise ValueError('Unknown observable: %s' % (name, ))
+
+    T_E = EPIDEMIC['T_E']
+    T_q1 = EPIDEMIC['T_q1']
+    age_params = age_parameters(EPIDEMIC, num_age_groups)
+    age_er_prop = age_er.T
+
+    # Initializing all group indicators in the last group
+    age_group_indicators = np.full((N_s, N_p), N_g-1)
+    delay_check_vacc = EPIDEMIC['delay_check_vacc']
+
+    # Scenarios that follow the policy weights instead of a precomputed strategy
+    use_policy = np.array([u_op_s is None for u_op_s in u_op])
+    for s in range(N_s):
+        if use_policy[s]:
+            assert np.isclose(np.sum(ws_vacc[s]), 0) or np.isclose(np.sum(ws_vacc[s]), 1)
+
+    # Compartments of the current timestep, initialized with CSV values
+    x = {name: np.zeros((N_s, N_g, N_p)) for name in COMPARTMENTS}
+    x['S_g'][:] = epidemic_npy[:, :, 0]
+    x['I_g'][:] = 0.9*epidemic_npy[:, :, 1]
+    x['I2_g'][:] = 0.1*epidemic_npy[:, :, 1]
+    x['E_g'][:] = 0.9*epidemic_npy[:, :, 2]
+    x['E2_g'][:] = 0.1*epidemic_npy[:, :, 2]
+    x['R_g'][:] = epidemic_npy[:, :, 3]
+    x['V_g'][:] = epidemic_npy[:, :, 4]
+    x['S_xg'][:] = epidemic_npy[:, :, 5]
+    x['H_wg'][:] = epidemic_npy[:, :, 6]
+    x['H_cg'][:] = epidemic_npy[:, :, 7]
+
+    # Hospitalized and new infected of the last delay_check_vacc timesteps,
+    # oldest first, needed by the vaccination policy
+    hosp_window = np.zeros((N_s, N_g, N_p, delay_check_vacc))
+    infe_window = np.zeros((N_s, N_g, N_p, delay_check_vacc))
+
+    outputs = {}
+    for name in observables:
+        shape = aggregate_observable(np.zeros((N_s, N_g, N_p)), aggregate).shape
+        outputs[name] = np.zeros(shape + (N_t, ))
+
+    kernel = mobility_kernel(c1, pop_hat)
+    beta_s = beta[:, np.newaxis, np.newaxis]
+
+    # Variable to store the spare vaccines from the last timestep
+    remain_last = np.zeros(N_s)
+    D_last = x['D_g']
+    for j in range(N_t):
+        # Vaccines of the precomputed strategies in timestep j
+        u_j = np.zeros((N_s, N_g, N_p))
+        for s in np.flatnonzero(~use_policy):
+            if j < u_op[s].shape[-1]:
+                u_j[s] = u_op[s][:, :, j]
+
+        if j < N_t-1:
+            lambda_j = force_of_infection(x['I_g'] + x['I2_g'], c_gh, kernel, age_er)
+
+            if np.any(use_policy):
+                # Counts of hospitalized and new infected in the last period
+                num_window = min(j, delay_check_vacc)
+                window = slice(delay_check_vacc - num_window, delay_check_vacc)
+                hosp_t = hosp_window[..., window].sum(axis=-1)
+                hosp_t = (hosp_t*age_er.T).sum(axis=1)
+                infe_t = infe_window[..., window].sum(axis=-1)
+                infe_t = (infe_t*age_er.T).sum(axis=1)
+
+                # Susceptibles left in timestep j after the infections
+                L_j = beta_s*lambda_j
+                S_left = x['S_g'] - L_j*x['S_g']
+
+                allocate_policy_vaccines(u_j, u_con, remain_last, hosp_t, infe_t,
+                                         S_left, ws_vacc, use_policy, age_er,
+                                         age_group_indicators)
+
+            u_j, x_1 = compartments_step(x, u_j, beta_s, lambda_j, e, age_params)
+
+        # Recording the observables of timestep j
+        record = dict(x)
+        record['u'] = u_j
+        record['hospitalized_incidence'] = T_q1*x['Q_1g']
+        record['infections_incidence'] = T_E*x['E_g']
+        if j == 0:
+            record['deaths_incidence'] = x['D_g']
+        else:
+            record['deaths_incidence'] = x['D_g'] - D_last
+        for name in observables:
+            values = OBSERVABLES[name](record, age_er_prop)
+            outputs[name][..., j] = aggregate_observable(values, aggregate)
+
+        if j < N_t-1:
+            hosp_window[..., :-1] = hosp_window[..., 1:]
+            hosp_window[..., -1] = x['H_wg'] + x['H_cg'] + x['H_rg']
+            infe_window[..., :-1] = infe_window[..., 1:]
+            infe_window[..., -1] = record['infections_incidence']
+
+            D_last = x['D_g']
+            x = x_1
+
+    return outputs
+
+
+def read_initial_values(age_er, init_vacc, t0):
+    num_ervas, num_age_groups = age_er.shape
 
     if init_vacc:
         csv_name = 'out/epidemic_finland_%d.csv' % (num_age_groups, )
     else:
         csv_name = 'out/epidemic_finland_%d_no_vacc.csv' % (num_age_groups, )
 
-    # Reading CSV
-    epidemic_csv = pd.read_csv(csv_name)
-    # Getting only date t0
-    epidemic_zero = epidemic_csv.loc[epidemic_csv['date'] == t0, :]
-    # Removing Ahvenanmaa or Aland
-    epidemic_zero = epidemic_zero[~epidemic_zero['erva'].str.contains('land')]
-
-    # Getting the order the ervas have inside the dataframe
-    ervas_order = EPIDEMIC['ervas_order']
-    ervas_df = list(pd.unique(epidemic_zero['erva']))
-    ervas_pd_order = [ervas_df.index(erva) for erva in ervas_order]
-
-    select_columns = ['susceptible',
-                      'infected',
-                      'exposed',
-                      'recovered',
-                      'vaccinated',
-                      'vaccinated no imm',
-                      'ward',
-                      'icu']
-    # Selecting the columns to use
-    epidemic_zero = epidemic_zero[select_columns]
-    # Converting to numpy
-    epidemic_npy = epidemic_zero.values
-    # Reshaping to 3d array
-    epidemic_npy = epidemic_npy.reshape(N_p, N_g, len(select_columns))
-
-    # Rearranging the order of the matrix with correct order
-    epidemic_npy = epidemic_npy[ervas_pd_order, :]
+    # Values of the date t0 with shape (N_p, N_g, compartments)
+    epidemic_npy = read_epidemic_state(csv_name, t0, STATE_COLUMNS)
 
     # Adding 1 dimension to age_er to do array division
     age_er_div = age_er[:, :, np.newaxis]
@@ -322,9 +636,66 @@ def read_initial_values(age_er, init_vacc, t0):
     return epidemic_npy
 
 
-def get_model_parameters(number_age_groups, num_ervas, init_vacc, t0, tau):
+# Version of the computation of the cached parameters, increase it when
+# the results change so that old cache files are not used
+PARAMETERS_CACHE_VERSION = 2
+# Directory with the cached model parameters (see cached_parameters)
+PARAMETERS_CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                    'out', 'parameters_cache')
+
+
+def file_digest(file_path):
+    # sha256 of the content of a file
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def parameters_digest(*items):
+    # sha256 of the items that determine a set of parameters
+    sha = hashlib.sha256()
+    sha.update(repr(PARAMETERS_CACHE_VERSION).encode())
+    for item in items:
+        if isinstance(item, np.ndarray):
+            sha.update(str(item.shape).encode())
+            sha.update(np.ascontiguousarray(item, dtype=np.float64).tobytes())
+        else:
+            sha.update(repr(item).encode())
+        sha.update(b'|')
+    return sha.hexdigest()
+
+
+def cached_parameters(prefix, digest, compute, use_cache=True):
+    # Returns the tuple of arrays of compute(), reading them from the cache
+    # file of the digest if it exists and writing it otherwise
+    if not use_cache:
+        return compute()
+
+    cache_file = os.path.join(PARAMETERS_CACHE_DIR, '%s_%s.npz' % (prefix, digest))
+    if os.path.isfile(cache_file):
+        with np.load(cache_file) as cached:
+            # 0-d arrays are returned as scalars
+            return tuple(cached['arr_%d' % (i, )][()] for i in range(len(cached.files)))
+
+    values = compute()
+    os.makedirs(PARAMETERS_CACHE_DIR, exist_ok=True)
+    # Writing to a temporary file first so that parallel runs never read
+    # a partial cache file
+    fd, tmp_file = tempfile.mkstemp(suffix='.npz', dir=PARAMETERS_CACHE_DIR)
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, *values)
+    os.replace(tmp_file, cache_file)
+
+    return values
+
+
+def get_population_erva_age(number_age_groups, num_ervas):
+    # Population of every erva (rows, in the order of ervas_order) and age group
     logger = logging.getLogger()
-    erva_pop_file = 'stats/erva_population_age_2020.csv'
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    erva_pop_file = os.path.join(dir_path, 'stats', 'erva_population_age_2020.csv')
     pop_ervas_age, _ = static_population_erva_age(logger, erva_pop_file,
                                                   number_age_groups=number_age_groups)
     pop_ervas_age = pop_ervas_age[~pop_ervas_age['erva'].str.contains('All')]
@@ -340,39 +711,11 @@ def get_model_parameters(number_age_groups, num_ervas, init_vacc, t0, tau):
     # Rearrange rows in the correct order
     age_er = pop_ervas_npy[ervas_pd_order, :]
 
-    if init_vacc:
-        csv_name = 'out/epidemic_finland_%d.csv' % (number_age_groups, )
-    else:
-        csv_name = 'out/epidemic_finland_%d_no_vacc.csv' % (number_age_groups, )
-
-    # Reading CSV
-    epidemic_csv = pd.read_csv(csv_name)
-    # Getting only date t0
-    epidemic_zero = epidemic_csv.loc[epidemic_csv['date'] == t0, :]
-    # Removing Ahvenanmaa or Aland
-    epidemic_zero = epidemic_zero[~epidemic_zero['erva'].str.contains('land')]
-
-    # Getting the order the ervas have inside the dataframe
-    ervas_df = list(pd.unique(epidemic_zero['erva']))
-    ervas_pd_order = [ervas_df.index(erva) for erva in ervas_order]
-
-    select_columns = ['susceptible',
-                      'vaccinated no imm']
-    # Selecting the columns to use
-    epidemic_zero = epidemic_zero[select_columns]
-    # Converting to numpy
-    epidemic_npy = epidemic_zero.values
-    # Reshaping to 3d array
-    epidemic_npy = epidemic_npy.reshape(num_ervas, number_age_groups, len(select_columns))
-    epidemic_npy = epidemic_npy.astype(np.float64)
-    epidemic_sus = epidemic_npy.sum(axis=2)
+    return age_er
 
-    epidemic_sus = epidemic_sus.reshape(num_ervas, number_age_groups)
-
-    # Rearranging the order of the matrix with correct order
-    epidemic_sus = epidemic_sus[ervas_pd_order, :]
-    # age_er = epidemic_sus
 
+def compute_mobility_parameters(age_er, tau):
+    num_ervas, number_age_groups = age_er.shape
     pop_erva = age_er.sum(axis=1)
 
     # Contact matrix
@@ -384,73 +727,137 @@ def get_model_parameters(number_age_groups, num_ervas, init_vacc, t0, tau):
     m_av = m_av/pop_erva[:, np.newaxis]
 
     # theta_km
-    N_p = num_ervas
-    N_g = number_age_groups
-    mob_av = np.zeros((N_p, N_p))
-    for k in range(N_p):
-        for m in range(N_p):
-            if k == m:
-                mob_av[k, m] = (1-tau) + tau*m_av[k, m]
-            else:
-                mob_av[k, m] = tau*m_av[k, m]
+    mob_av = tau*m_av
+    np.fill_diagonal(mob_av, (1-tau) + tau*np.diag(m_av))
 
     # Change in population size because of mobility
     # N_hat_{lg}, N_hat_{l}
-    pop_erva_hat = np.zeros(N_p)
-    age_er_hat = np.zeros((N_g, N_p))
-
-    for m in range(N_p):
-        m_k = 0.0
-        for k in range(N_p):
-            m_k = m_k + pop_erva[k]*mob_av[k, m]
-            for g in range(N_g):
-                age_er_hat[g, m] = sum(age_er[:, g]*mob_av[:, m])
-
-        pop_erva_hat[m] = m_k
+    pop_erva_hat = (pop_erva[:, np.newaxis]*mob_av).sum(axis=0)
+    age_er_hat = (age_er[:, :, np.newaxis]*mob_av[:, np.newaxis, :]).sum(axis=0)
 
     # Population size per age group in all ervas
-    age_pop = sum(age_er)
+    age_pop = age_er.sum(axis=0)
 
     # Computing beta_gh for force of infection
-    beta_gh = np.zeros((N_g, N_g))
-
-    for g in range(N_g):
-        for h in range(N_g):
-            if g == h:
-                for m in range(N_p):
-                    sum_kg2 = 0.0
-                    for k in range(N_p):
-                        sum_kg2 = sum_kg2 + age_er[k, g]*mob_av[k, m]*mob_av[k, m]/pop_erva_hat[m]
-                sum_kg = sum(age_er_hat[g, :]*age_er_hat[h, :]/pop_erva_hat)
-                beta_gh[g, h] = age_pop[g]*c_gh_3[g, h]/(sum_kg-sum_kg2)
-            else:
-                sum_kg = age_er_hat[g, :]*age_er_hat[h, :]
-                beta_gh[g, h] = age_pop[g]*c_gh_3[g, h]/(sum(sum_kg/pop_erva_hat))
-
-    # Computing NGM and rho
-    T_I = EPIDEMIC['T_I']**(-1)
-    ks = num_ervas
-    gs = number_age_groups
-    kg = ks*gs
-    next_gen_matrix = np.zeros((kg, kg))
+    # sum_m N_hat_gm*N_hat_hm/N_hat_m
+    sum_kg = (age_er_hat[:, np.newaxis, :]*age_er_hat[np.newaxis, :, :]/pop_erva_hat).sum(axis=-1)
+    # NOTE: the original loop over m overwrote sum_kg2 in every iteration,
+    # so only the last erva m is subtracted in the diagonal. Kept as is
+    m = num_ervas - 1
+    sum_kg2 = (age_er*mob_av[:, m, np.newaxis]*mob_av[:, m, np.newaxis]/pop_erva_hat[m]).sum(axis=0)
+    sum_kg[np.diag_indices(number_age_groups)] -= sum_kg2
+    beta_gh = age_pop[:, np.newaxis]*c_gh_3/sum_kg
+
+    return mob_av, beta_gh, pop_erva_hat
+
+
+def mobility_digest(number_age_groups, num_ervas, tau):
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    erva_pop_file = os.path.join(dir_path, 'stats', 'erva_population_age_2020.csv')
+    return parameters_digest(number_age_groups, num_ervas, tau,
+                             file_digest(erva_pop_file),
+                             EPIDEMIC['ervas_order'],
+                             EPIDEMIC['contact_matrix'][number_age_groups],
+                             EPIDEMIC['mobility_matrix'][num_ervas])
+
+
+def get_mobility_parameters(number_age_groups, num_ervas, tau, use_cache=True):
+    # Parameters of the model that only depend on the population, mobility
+    # and contacts. Returns mob_av, beta_gh, pop_erva_hat and age_er
+    digest = mobility_digest(number_age_groups, num_ervas, tau)
+
+    def compute():
+        age_er = get_population_erva_age(number_age_groups, num_ervas)
+        mob_av, beta_gh, pop_erva_hat = compute_mobility_parameters(age_er, tau)
+        return mob_av, beta_gh, pop_erva_hat, age_er
 
-    # beta_ti_n = age_er*T_I
+    return cached_parameters('mobility', digest, compute, use_cache=use_cache)
+
+
+def next_generation_factors(epidemic_sus, beta_gh, mob_av, pop_erva_hat):
+    # The NGM is diag(beta_ti_n)(mobility_term kron beta_gh) with
+    # beta_ti_n (N_p, N_g) and mobility_term (N_p, N_p)
+    T_I = EPIDEMIC['T_I']**(-1)
     beta_ti_n = epidemic_sus*T_I
-    for k in range(ks):
-        for g in range(gs):
-            kg_idx = k*gs + g
-            beta_ti_n_kg = beta_ti_n[k, g]
-            for l in range(ks):
-                for h in range(gs):
-                    lh_idx = l*gs + h
-
-                    interaction_term = beta_ti_n_kg*beta_gh[g, h]
-                    mobility_term = 0
-                    for m in range(ks):
-                        mobility_term += mob_av[k, m]*mob_av[l, m]/pop_erva_hat[m]
-                    next_gen_matrix[kg_idx, lh_idx] = interaction_term*mobility_term
-
-    eig_vals = eigvals(next_gen_matrix)
-    rho = np.abs(np.amax(eig_vals))
-
-    return mob_av, beta_gh, pop_erva_hat, age_er, rho
+    # sum_m mob_av[k, m]*mob_av[l, m]/pop_erva_hat[m]
+    mobility_term = (mob_av[:, np.newaxis, :]*mob_av[np.newaxis, :, :]/pop_erva_hat).sum(axis=-1)
+
+    return beta_ti_n, mobility_term
+
+
+def next_generation_matrix(epidemic_sus, beta_gh, mob_av, pop_erva_hat):
+    # NGM with rows and columns indexed by k*N_g + g
+    num_ervas, number_age_groups = epidemic_sus.shape
+    kg = num_ervas*number_age_groups
+    beta_ti_n, mobility_term = next_generation_factors(epidemic_sus, beta_gh,
+                                                       mob_av, pop_erva_hat)
+
+    # (k, g, l, h) = beta_ti_n[k, g]*beta_gh[g, h]*mobility_term[k, l]
+    interaction_term = beta_ti_n[:, :, np.newaxis, np.newaxis]*beta_gh[np.newaxis, :, np.newaxis, :]
+    next_gen_matrix = interaction_term*mobility_term[:, np.newaxis, :, np.newaxis]
+
+    return next_gen_matrix.reshape(kg, kg)
+
+
+def spectral_radius(epidemic_sus, beta_gh, mob_av, pop_erva_hat):
+    # Spectral radius of the NGM without building it. The product of the NGM
+    # with x (reshaped to X of shape (N_p, N_g)) is
+    # beta_ti_n*(mobility_term @ X @ beta_gh.T), and the largest eigenvalue
+    # in magnitude is found with Arnoldi iteration (ARPACK)
+    num_ervas, number_age_groups = epidemic_sus.shape
+    kg = num_ervas*number_age_groups
+
+    # ARPACK needs at least 3 rows
+    if kg < 3:
+        next_gen_matrix = next_generation_matrix(epidemic_sus, beta_gh, mob_av, pop_erva_hat)
+        return np.abs(np.amax(eigvals(next_gen_matrix)))
+
+    beta_ti_n, mobility_term = next_generation_factors(epidemic_sus, beta_gh,
+                                                       mob_av, pop_erva_hat)
+
+    def matvec(x):
+        x = x.reshape(num_ervas, number_age_groups)
+        return (beta_ti_n*(mobility_term @ x @ beta_gh.T)).ravel()
+
+    next_gen_operator = LinearOperator((kg, kg), matvec=matvec, dtype=np.float64)
+    # The NGM is nonnegative so its largest eigenvalue in magnitude is real
+    # and equal to the spectral radius
+    eig_vals = eigs(next_gen_operator, k=1, which='LM', v0=np.ones(kg),
+                    return_eigenvectors=False)
+
+    return np.abs(eig_vals[0])
+
+
+def get_model_parameters(number_age_groups, num_ervas, init_vacc, t0, tau,
+                         use_cache=True):
+    # Results are cached on disk by the content of the input files and the
+    # parameters. Returns mob_av, beta_gh, pop_erva_hat, age_er and rho
+    if init_vacc:
+        csv_name = 'out/epidemic_finland_%d.csv' % (number_age_groups, )
+    else:
+        csv_name = 'out/epidemic_finland_%d_no_vacc.csv' % (number_age_groups, )
+
+    select_columns = ['susceptible',
+                      'vaccinated no imm']
+    # Values of the date t0 with shape (N_p, N_g, len(select_columns)). Only
+    # this block of the epidemic store is used, so it is part of the digest
+    # instead of the whole CSV (the cache is still valid when new dates are
+    # added)
+    epidemic_npy = read_epidemic_state(csv_name, t0, select_columns)
+
+    digest = parameters_digest(mobility_digest(number_age_groups, num_ervas, tau),
+                               init_vacc, t0, epidemic_npy, EPIDEMIC['T_I'])
+
+    def compute():
+        mob_av, beta_gh, pop_erva_hat, age_er = get_mobility_parameters(number_age_groups,
+                                                                        num_ervas,
+                                                                        tau,
+                                                                        use_cache=use_cache)
+        epidemic_sus = epidemic_npy.sum(axis=2)
+
+        # Spectral radius of the NGM
+        rho = spectral_radius(epidemic_sus, beta_gh, mob_av, pop_erva_hat)
+
+        return mob_av, beta_gh, pop_erva_hat, age_er, rho
+
+    return cached_parameters('model', digest, compute, use_cache=use_cache)
@@ -0,0 +1,211 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import requests
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from env_var import HTTP_CACHE
+
+
+# Responses of the API calls of fetch_data.py. Every URL has an entry
+# (sha1 of the URL).json with its ETag, Last-Modified and the sha1 of the
+# content, stored in (sha1 of the content).body so that equal responses
+# share the file
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                               'out', 'http_cache')
+CACHE_MODES = ['revalidate', 'offline', 'disabled']
+
+# Requests started by prefetched while its block runs, by URL and headers
+# (request_key). Overlapping blocks add their own requests for the same key
+PENDING = {}
+PENDING_LOCK = threading.Lock()
+# Connection pool (requests.Session) of every thread
+SESSIONS = threading.local()
+
+
+class CachedResponse:
+    # Response read from the cache, with the attributes of requests.Response
+    # used by fetch_data.py
+    def __init__(self, url, content, apparent_encoding):
+        self.url = url
+        self.status_code = 200
+        self.content = content
+        self.apparent_encoding = apparent_encoding
+        self.encoding = apparent_encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def cache_directory():
+    if HTTP_CACHE['directory'] is None:
+        return CACHE_DIRECTORY
+    return HTTP_CACHE['directory']
+
+
+def entry_path(url):
+    return os.path.join(cache_directory(),
+                        hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+
+def body_path(content_hash):
+    return os.path.join(cache_directory(), content_hash + '.body')
+
+
+def write_atomic(filename, data):
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(filename))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_name, filename)
+
+
+def read_entry(url):
+    # Entry of the URL or None if it is not cached (or its body is missing)
+    try:
+        with open(entry_path(url)) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get('url') != url or not os.path.isfile(body_path(entry['content'])):
+        return None
+    return entry
+
+
+def write_entry(entry):
+    os.makedirs(cache_directory(), exist_ok=True)
+    write_atomic(entry_path(entry['url']), json.dumps(entry, indent=1).encode('utf-8'))
+
+
+def cached_response(entry):
+    with open(body_path(entry['content']), 'rb') as f:
+        content = f.read()
+    return CachedResponse(entry['url'], content, entry['apparent_encoding'])
+
+
+def store_response(url, response):
+    content_hash = hashlib.sha1(response.content).hexdigest()
+    os.makedirs(cache_directory(), exist_ok=True)
+    if not os.path.isfile(body_path(content_hash)):
+        write_atomic(body_path(content_hash), response.content)
+    write_entry({
+        'url': url,
+        'content': content_hash,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'apparent_encoding': response.apparent_encoding,
+        'fetched': time.time(),
+    })
+
+
+def session():
+    # Session of the current thread, with timeouts and retries
+    if not hasattr(SESSIONS, 'session'):
+        retries = Retry(total=HTTP_CACHE['retries'], backoff_factor=1,
+                        status_forcelist=[502, 503, 504])
+        SESSIONS.session = requests.Session()
+        SESSIONS.session.mount('https://', HTTPAdapter(max_retries=retries))
+        SESSIONS.session.mount('http://', HTTPAdapter(max_retries=retries))
+    return SESSIONS.session
+
+
+def http_get(url, headers=None):
+    return session().get(url, headers=headers, timeout=HTTP_CACHE['timeout'])
+
+
+def request_key(url, headers=None):
+    # Key of PENDING: a response is only used for the same URL and headers
+    return url, tuple(sorted((headers or {}).items()))
+
+
+@contextlib.contextmanager
+def prefetched(logger, urls, headers=None):
+    # Sends the requests of urls at the same time in background threads. In
+    # the with block, the next cached_get of each of them (with the same
+    # headers) waits for its response instead of sending the request again,
+    # so the downloads overlap with the parsing of the responses that are
+    # already there. The responses not used in the block are dropped (they
+    # are still in the cache) and the threads finish with it
+    logger.debug('Prefetching %d responses' % (len(urls), ))
+    if len(urls) == 0:
+        yield
+        return
+    pool = ThreadPool(len(urls))
+    pending = []
+    try:
+        for url in urls:
+            key = request_key(url, headers)
+            result = pool.apply_async(fetch_url, (logger, url, headers))
+            pending.append((key, result))
+            with PENDING_LOCK:
+                PENDING.setdefault(key, []).append(result)
+        yield
+    finally:
+        with PENDING_LOCK:
+            for key, result in pending:
+                results = PENDING.get(key, [])
+                if result in results:
+                    results.remove(result)
+                if len(results) == 0:
+                    PENDING.pop(key, None)
+        pool.close()
+        pool.join()
+
+
+def cached_get(logger, url, headers=None):
+    # requests.get through the cache, following HTTP_CACHE['mode']
+    key = request_key(url, headers)
+    pending = None
+    with PENDING_LOCK:
+        if key in PENDING:
+            pending = PENDING[key].pop(0)
+            if len(PENDING[key]) == 0:
+                del PENDING[key]
+    if pending is not None:
+        return pending.get()
+    return fetch_url(logger, url, headers=headers)
+
+
+def fetch_url(logger, url, headers=None):
+    mode = HTTP_CACHE['mode']
+    if mode not in CACHE_MODES:
+        raise ValueError('Unknown cache mode %s, expected one of %s' % (mode, CACHE_MODES))
+    if mode == 'disabled':
+        return http_get(url, headers=headers)
+
+    entry = read_entry(url)
+    if mode == 'offline':
+        if entry is None:
+            raise RuntimeError('No cached response for %s (offline mode)' % (url, ))
+        logger.debug('Replaying cached response of %s' % (url, ))
+        return cached_response(entry)
+
+    if entry is not None and time.time() - entry['fetched'] < HTTP_CACHE['max_age']:
+        logger.debug('Using cached response of %s' % (url, ))
+        return cached_response(entry)
+
+    # Conditional request: the API answers 304 if the cached response is
+    # still valid
+    request_headers = dict(headers or {})
+    if entry is not None and entry['etag'] is not None:
+        request_headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry['last_modified'] is not None:
+        request_headers['If-Modified-Since'] = entry['last_modified']
+    response = http_get(url, headers=request_headers)
+
+    if response.status_code == 304 and entry is not None:
+        logger.debug('Cached response of %s not modified' % (url, ))
+        entry['fetched'] = time.time()
+        write_entry(entry)
+        return cached_response(entry)
+    if response.status_code == 200:
+        store_response(url, response)
+    return response
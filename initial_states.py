@@ -1,20 +1,60 @@
 import os
+import sys
+import datetime
 import logging
 from logging import handlers
 import pandas as pd
 import numpy as np
-from env_var import EPIDEMIC
+from env_var import EPIDEMIC, HTTP_CACHE, REQUESTS
+from epidemic_store import (
+    append_epidemic_state, read_cases_state, read_csv_rows, store_paths,
+    write_epidemic_state
+)
+from http_cache import prefetched
 from fetch_data import (
-    construct_cases_age_erva_daily, static_population_erva_age,
-    construct_thl_vaccines_erva_daily, construct_hs_hosp_age_erva
+    construct_cases_age_erva_array, static_population_erva_age,
+    construct_thl_vaccines_erva_daily, construct_hs_hosp_age_erva,
+    erva_age_categoricals
 )
 
 
+def daily_detected_cases(logger, number_age_groups=9, start_date=None):
+    # Detected cases by day, erva and age group from start_date (all the days
+    # if None). Returns the dates, ervas, age groups and the cases with shape
+    # (dates, ervas, age groups)
+    dates, ervas, ages_names, cases_erva_age_npy = construct_cases_age_erva_array(
+        logger, number_age_groups=number_age_groups, start_date=start_date
+    )
+    logger.debug(ervas)
+
+    return dates, ervas, ages_names, cases_erva_age_npy
+
+
+def window_sums(values, window, first_day=0):
+    # Sums over the first axis of values for the days from first_day: the sum
+    # of the last window days (including the day) and the sum of all the
+    # days before them. Both are differences of a single cumulative sum
+    cumulative = np.zeros((len(values) + 1, ) + values.shape[1:])
+    np.cumsum(values, axis=0, out=cumulative[1:])
+    days = np.arange(first_day, len(values))
+    window_start = np.maximum(days - window + 1, 0)
+    in_window = cumulative[days + 1] - cumulative[window_start]
+    before_window = cumulative[window_start]
+    return in_window, before_window
+
+
 def compartment_values_daily(logger, erva_pop_file, filename=None,
-                             number_age_groups=9):
+                             number_age_groups=9, daily_cases=None,
+                             previous_cases=None):
+    # daily_cases is the result of daily_detected_cases, constructed for all
+    # the days if None. previous_cases are the detected cases of the days
+    # before the first day of daily_cases, with shape (days, ervas, ages), when
+    # only the last days are constructed
     logger.info('Calculating epidemic compartments')
-    cases_by_age_erva = construct_cases_age_erva_daily(logger,
-                                                       number_age_groups=number_age_groups)
+    if daily_cases is None:
+        daily_cases = daily_detected_cases(logger, number_age_groups=number_age_groups)
+    dates, ervas, ages_names, cases_erva_age_npy = daily_cases
+    days, num_ervas, ages = cases_erva_age_npy.shape
 
     inf_period = (EPIDEMIC['T_I'])**(-1)
     inf_period = int(inf_period)
@@ -24,36 +64,15 @@ def compartment_values_daily(logger, erva_pop_file, filename=None,
                                                               lat_period))
     a = EPIDEMIC['unreported_exponent']
 
-    cases_by_age_erva.sort_values(['Time', 'erva'])
-    dates = pd.unique(cases_by_age_erva['Time'])
-    ervas = pd.unique(cases_by_age_erva['erva'])
-    num_ervas = len(ervas)
-    logger.debug(ervas)
-    ages_names = cases_by_age_erva.columns[2:]
-
-    cases_erva_age_npy = cases_by_age_erva.values
-    cases_erva_age_npy = cases_erva_age_npy[:, 2:]
-    dates_ervas, ages = cases_erva_age_npy.shape
-    assert dates_ervas % num_ervas == 0
-    days = int(dates_ervas/num_ervas)
-    cases_erva_age_npy = cases_erva_age_npy.reshape(days, num_ervas, ages)
-
-    assert len(ages_names) == ages
-    assert len(dates) == days
-
-    infectious_detected = np.zeros_like(cases_erva_age_npy)
-    recovered_detected = np.zeros_like(cases_erva_age_npy)
     lookback_period = inf_period + lat_period
-    for day_t in range(days):
-        omega = day_t - lookback_period + 1
-        if omega < 0:
-            omega = 0
-        cases_in_period = cases_erva_age_npy[omega:day_t+1, ]
-        # Get the total infected in the period and assign to time t
-        infectious_detected[day_t, ] = cases_in_period.sum(axis=0)
+    if previous_cases is None:
+        previous_cases = np.zeros((0, num_ervas, ages))
+    # The sums start on the first stored day, so that the days constructed
+    # again get the same values as when all the days are constructed
+    all_cases = np.concatenate((previous_cases, cases_erva_age_npy))
 
-        recovered_period = cases_erva_age_npy[:omega, ]
-        recovered_detected[day_t, ] = recovered_period.sum(axis=0)
+    infectious_detected, recovered_detected = window_sums(all_cases, lookback_period,
+                                                          first_day=len(previous_cases))
 
     k = np.arange(ages) + 1
     upscale_factor = 1 + 9*k**(-a)
@@ -85,22 +104,27 @@ def compartment_values_daily(logger, erva_pop_file, filename=None,
     susceptible = np.zeros_like(cases_erva_age_npy)
     susceptible = pop_ervas_npy - exposed_real - infected_real - recovered_total
 
-    complete_dataframe = pd.DataFrame()
-    for erva_i, erva_name in enumerate(ervas):
-        for age_i, age_name in enumerate(ages_names):
-            dataframe_data = {
-                'date': dates,
-                'erva': [erva_name]*days,
-                'age': [age_name]*days,
-                'susceptible': susceptible[:, erva_i, age_i],
-                'infected detected': infectious_detected[:, erva_i, age_i],
-                'infected undetected': infectious_undetected[:, erva_i, age_i],
-                'infected': infected_real[:, erva_i, age_i],
-                'exposed': exposed_real[:, erva_i, age_i],
-                'recovered': recovered_total[:, erva_i, age_i],
-            }
-            erva_age_dataframe = pd.DataFrame(data=dataframe_data)
-            complete_dataframe = complete_dataframe.append(erva_age_dataframe)
+    # Long format with the rows by date, erva and age (the order of the
+    # arrays), so that the updates only add rows at the end of the CSV. The
+    # rows of a date have the erva and age order of the original CSV, which
+    # had all the dates of an erva and age group together
+    def long_format(values):
+        return values.ravel()
+
+    dataframe_data = {
+        'date': np.repeat(dates, num_ervas*ages),
+        'erva': np.tile(np.repeat(ervas, ages), days),
+        'age': np.tile(ages_names, days*num_ervas),
+        'susceptible': long_format(susceptible),
+        'infected detected': long_format(infectious_detected),
+        'infected undetected': long_format(infectious_undetected),
+        'infected': long_format(infected_real),
+        'exposed': long_format(exposed_real),
+        'recovered': long_format(recovered_total),
+    }
+    complete_dataframe = pd.DataFrame(data=dataframe_data)
+    complete_dataframe = erva_age_categoricals(complete_dataframe,
+                                               number_age_groups=number_age_groups)
 
     if filename is not None:
         complete_dataframe.to_csv(filename, index=False)
@@ -109,20 +133,56 @@ def compartment_values_daily(logger, erva_pop_file, filename=None,
     return complete_dataframe
 
 
+def cumulative_doses(epidemic_state, column, previous_state=None):
+    # Cumulative sum of the column by erva and age, continuing the cumulative
+    # values of the last day of previous_state. The rows of every date have
+    # the ervas and ages in the same order (see compartment_values_daily). The
+    # days are added one at a time (groupby cumsum compensates the rounding),
+    # so that an update continues the sums with the same values as when all
+    # the days are constructed
+    num_dates = epidemic_state['date'].nunique()
+    doses = epidemic_state[column].values.astype(np.float64).reshape(num_dates, -1)
+    if previous_state is not None and len(previous_state) > 0:
+        last_day = previous_state[previous_state['date'] == previous_state['date'].max()]
+        first_day = epidemic_state.iloc[:doses.shape[1]]
+        for labels in ['erva', 'age']:
+            if list(last_day[labels].astype(str)) != list(first_day[labels].astype(str)):
+                raise ValueError('The previous state has other %s rows' % (labels, ))
+        doses = np.concatenate((last_day[[column + ' cumulative']].values.T, doses))
+    return np.cumsum(doses, axis=0)[len(doses) - num_dates:].ravel()
+
+
 def full_epidemic_state_finland(logger, erva_pop_file, filename=None,
                                 number_age_groups=9, init_vacc=True,
-                                e=EPIDEMIC['e']):
+                                e=EPIDEMIC['e'], start_date=None,
+                                previous_cases=None, previous_state=None):
+    # With start_date only the days from start_date are constructed and they
+    # replace the ones in filename. previous_state has (at least) the rows of
+    # the day before start_date and previous_cases the detected cases of the
+    # days before it (see update_epidemic_state_finland). Returns the state of
+    # the constructed days
     logger.info('Getting complete state of epidemic with '
                 'epidemic compartments, vaccines and hospitalizations')
     logger.info('Number of age groups: %d' % (number_age_groups))
-    compart_df = compartment_values_daily(logger, erva_pop_file,
-                                          number_age_groups=number_age_groups)
-    logger.info('Epidemic compartments gotten.')
-    vacc_df = construct_thl_vaccines_erva_daily(logger,
-                                                number_age_groups=number_age_groups)
-    logger.info('Number of vaccinated gotten.')
-    hosp_df = construct_hs_hosp_age_erva(logger, number_age_groups=number_age_groups)
-    logger.info('Number of hospitalizations gotten.')
+    # All the sources are downloaded at the same time while the first ones
+    # are parsed
+    sources = [REQUESTS[source] for source in ['cases_by_age', 'cases_by_day',
+                                               'vaccination', 'hospitalizations']]
+    with prefetched(logger, sources, headers={'User-Agent': 'Me'}):
+        daily_cases = daily_detected_cases(logger, number_age_groups=number_age_groups,
+                                           start_date=start_date)
+        compart_df = compartment_values_daily(logger, erva_pop_file,
+                                              number_age_groups=number_age_groups,
+                                              daily_cases=daily_cases,
+                                              previous_cases=previous_cases)
+        logger.info('Epidemic compartments gotten.')
+        vacc_df = construct_thl_vaccines_erva_daily(logger,
+                                                    number_age_groups=number_age_groups,
+                                                    start_date=start_date)
+        logger.info('Number of vaccinated gotten.')
+        hosp_df = construct_hs_hosp_age_erva(logger, number_age_groups=number_age_groups,
+                                             start_date=start_date)
+        logger.info('Number of hospitalizations gotten.')
     epidemic_state = pd.merge(compart_df, vacc_df,
                               on=['date', 'erva', 'age'],
                               how='left')
@@ -133,10 +193,12 @@ def full_epidemic_state_finland(logger, erva_pop_file, filename=None,
     epidemic_state = epidemic_state.fillna(0)
 
     if init_vacc:
-        epidemic_state['First dose cumulative'] = epidemic_state.groupby(['erva', 'age'])['First dose'].cumsum()
+        epidemic_state['First dose cumulative'] = cumulative_doses(epidemic_state, 'First dose',
+                                                                   previous_state)
         epidemic_state['vaccinated'] = e*epidemic_state['First dose cumulative']
         epidemic_state['vaccinated no imm'] = (1-e)*epidemic_state['First dose cumulative']
-        epidemic_state['Second dose cumulative'] = epidemic_state.groupby(['erva', 'age'])['Second dose'].cumsum()
+        epidemic_state['Second dose cumulative'] = cumulative_doses(epidemic_state, 'Second dose',
+                                                                    previous_state)
     else:
         epidemic_state['First dose cumulative'] = 0
         epidemic_state['Second dose cumulative'] = 0
@@ -151,13 +213,66 @@ def full_epidemic_state_finland(logger, erva_pop_file, filename=None,
     epidemic_state['susceptible'] = epidemic_state['susceptible'] - epidemic_state['ward']
     epidemic_state['susceptible'] = epidemic_state['susceptible'] - epidemic_state['icu']
 
+    _, ervas, ages_names, cases = daily_cases
     if filename is not None:
-        epidemic_state.to_csv(filename, index=False)
-        logger.info('Results written to: %s' % (filename, ))
+        # The CSV comes with a date indexed copy used to read the initial
+        # values of a date and the detected cases for the next update
+        if start_date is None:
+            write_epidemic_state(epidemic_state, filename, (ervas, ages_names, cases))
+            logger.info('Results written to: %s' % (filename, ))
+        else:
+            epidemic_state = epidemic_state[previous_state.columns]
+            append_epidemic_state(epidemic_state, filename, (ervas, ages_names, cases),
+                                  start_date)
+            logger.info('Results from %s written to: %s' % (start_date, filename))
+        logger.info('Store written to: %s' % (store_paths(filename), ))
 
     return epidemic_state
 
 
+def update_epidemic_state_finland(logger, erva_pop_file, filename,
+                                  number_age_groups=9, init_vacc=True,
+                                  e=EPIDEMIC['e'], revision_days=14):
+    # Updates the epidemic state written to filename by a previous run. The
+    # last revision_days stored days (revised by THL in the latest weeks) and
+    # the new ones are constructed, the days before them are kept and only
+    # the rows of the day before them are read. Without a previous state, it
+    # constructs the full state. The APIs have no date filters, so the whole
+    # history is still downloaded (see http_cache); only the parsing (but
+    # the hospitalizations), the computation and the writing are limited to
+    # the constructed days, which get the same values as when all the days
+    # are constructed. Returns the state of the constructed days
+    cases_state = read_cases_state(filename)
+    if cases_state is None:
+        logger.info('No previous state for %s. Constructing all the days' % (filename, ))
+        return full_epidemic_state_finland(logger, erva_pop_file, filename,
+                                           number_age_groups=number_age_groups,
+                                           init_vacc=init_vacc, e=e)
+
+    stored_dates = cases_state['dates']
+    last_date = datetime.datetime.strptime(stored_dates[-1], '%Y-%m-%d')
+    start_date = last_date - datetime.timedelta(days=revision_days-1)
+    start_date = max(start_date.strftime('%Y-%m-%d'), stored_dates[0])
+    if start_date not in stored_dates:
+        # The stored days are not consecutive
+        logger.warning('Day %s is missing in %s. Constructing all the days' % (start_date,
+                                                                               filename))
+        return full_epidemic_state_finland(logger, erva_pop_file, filename,
+                                           number_age_groups=number_age_groups,
+                                           init_vacc=init_vacc, e=e)
+    start_i = stored_dates.index(start_date)
+    logger.info('Updating %s from %s' % (filename, start_date))
+
+    previous_state = read_csv_rows(filename, cases_state['index'], max(start_i - 1, 0), start_i)
+
+    return full_epidemic_state_finland(logger, erva_pop_file, filename,
+                                       number_age_groups=number_age_groups,
+                                       init_vacc=init_vacc, e=e,
+                                       start_date=start_date,
+                                       previous_cases=cases_state['cases'][:start_i],
+                                       previous_state=previous_state)
+
+
 if __name__ == "__main__":
     # Select data directory
     curr_dir = os.path.dirname(os.path.realpath(__file__))
@@ -188,12 +303,22 @@ if __name__ == "__main__":
 
         erva_pop_file = os.path.join(stats_dir, 'erva_population_age_2020.csv')
 
+        # Only the cached API responses are used with --offline
+        if '--offline' in sys.argv:
+            HTTP_CACHE['mode'] = 'offline'
+
+        # Only the last days are constructed again unless --full is given
+        if '--full' in sys.argv:
+            construct_state = full_epidemic_state_finland
+        else:
+            construct_state = update_epidemic_state_finland
+
         out_csv_filename = os.path.join(out_dir, 'epidemic_finland_9.csv')
-        full_epidemic_state_finland(logger, erva_pop_file, out_csv_filename,
-                                    number_age_groups=9)
+        construct_state(logger, erva_pop_file, out_csv_filename,
+                        number_age_groups=9)
 
         out_csv_filename = os.path.join(out_dir, 'epidemic_finland_9_no_vacc.csv')
-        full_epidemic_state_finland(logger, erva_pop_file, out_csv_filename,
-                                    number_age_groups=9, init_vacc=False)
+        construct_state(logger, erva_pop_file, out_csv_filename,
+                        number_age_groups=9, init_vacc=False)
     except Exception:
         logger.exception("Fatal error in main loop")
@@ -0,0 +1,229 @@
+import numpy as np
+
+# Numba is an optional dependency. Without it the kernels below are plain
+# Python functions and backend='numba' is refused by the callers
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+def jit(func):
+    # The kernels release the GIL, so the optimizations of
+    # run_parallel_optimizations(use_threads=True) run them at the same time
+    if NUMBA_AVAILABLE:
+        return njit(cache=True, nogil=True)(func)
+    return func
+
+
+def check_numba():
+    if not NUMBA_AVAILABLE:
+        raise ImportError("backend='numba' requires the numba package")
+
+
+def epidemic_rates(epidemic):
+    # Transition rates in the order expected by the kernels
+    return np.array([epidemic['T_E'],
+                     epidemic['T_V'],
+                     epidemic['T_I'],
+                     epidemic['T_q0'],
+                     epidemic['T_q1'],
+                     epidemic['T_hw'],
+                     epidemic['T_hc'],
+                     epidemic['T_hr']])
+
+
+def age_parameters(epidemic, num_age_groups):
+    # Per age group parameters in the order expected by the kernels
+    return np.array([epidemic['mu_q'][num_age_groups],
+                     epidemic['mu_w'][num_age_groups],
+                     epidemic['mu_c'][num_age_groups],
+                     epidemic['p_H'][num_age_groups],
+                     epidemic['p_c'][num_age_groups]], dtype=np.float64)
+
+
+@jit
+def forward_step(j, beta, lambda_j, e, omega, pi, rates, age_params, u,
+                 S_g, S_xg, S_vg, S_pg, V_g, E_g, E2_g, I_g, I2_g, Q_0g, Q_1g,
+                 H_wg, H_cg, H_rg, R_g, D_g, hospitalized_incidence,
+                 infections_incidence):
+    # One timestep of forward_integration_batch for all the scenarios.
+    # Arrays have shape (N_s, N_g, N_p, N_t) and are updated in place
+    T_E = rates[0]
+    T_V = rates[1]
+    T_I = rates[2]
+    T_q0 = rates[3]
+    T_q1 = rates[4]
+    T_hw = rates[5]
+    T_hc = rates[6]
+    T_hr = rates[7]
+    mu_q = age_params[0]
+    mu_w = age_params[1]
+    mu_c = age_params[2]
+    p_H = age_params[3]
+    p_c = age_params[4]
+
+    N_s, N_g, N_p, _ = S_g.shape
+    for s in range(N_s):
+        for n in range(N_p):
+            for g in range(N_g-1, -1, -1):
+                L = beta[s]*lambda_j[s, g, n]
+
+                # Ensures that we do not keep vaccinating after there are no susceptibles left
+                u[s, g, n, j] = min(u[s, g, n, j], max(0.0, S_g[s, g, n, j] - L*S_g[s, g, n, j]))
+
+                S_g[s, g, n, j+1] = S_g[s, g, n, j] - L*S_g[s, g, n, j] - u[s, g, n, j]
+                S_xg[s, g, n, j+1] = S_xg[s, g, n, j] - L*S_xg[s, g, n, j]
+                S_vg[s, g, n, j+1] = S_vg[s, g, n, j] - L*S_vg[s, g, n, j] + u[s, g, n, j] - T_V*S_vg[s, g, n, j]
+                S_pg[s, g, n, j+1] = S_pg[s, g, n, j] - omega*beta[s]*lambda_j[s, g, n]*S_pg[s, g, n, j] + (1.-e)*T_V*S_vg[s, g, n, j]
+                V_g[s, g, n, j+1] = V_g[s, g, n, j] + e*T_V*S_vg[s, g, n, j]
+                E_g[s, g, n, j+1] = E_g[s, g, n, j] + L*(S_g[s, g, n, j]+S_vg[s, g, n, j] +S_xg[s, g, n, j] )  - T_E*E_g[s, g, n, j]
+                E2_g[s, g, n, j+1] = E2_g[s, g, n, j] + omega*beta[s]*lambda_j[s, g, n]*S_pg[s, g, n, j]  - T_E*E2_g[s, g, n, j]
+                I_g[s, g, n, j+1] = I_g[s, g, n, j] + T_E*E_g[s, g, n, j] - T_I*I_g[s, g, n, j]
+                I2_g[s, g, n, j+1] = I2_g[s, g, n, j] + T_E*E2_g[s, g, n, j] - T_I*I2_g[s, g, n, j]
+                Q_0g[s, g, n, j+1] = Q_0g[s, g, n, j] + (1.-p_H[g])*T_I*I_g[s, g, n, j] - T_q0*Q_0g[s, g, n, j] + (1.-pi*p_H[g])*T_I*I2_g[s, g, n, j]
+                Q_1g[s, g, n, j+1] = Q_1g[s, g, n, j] + p_H[g]*T_I*I_g[s, g, n, j] + pi*p_H[g]*T_I*I2_g[s, g, n, j] - T_q1*Q_1g[s, g, n, j]
+                H_wg[s, g, n, j+1] = H_wg[s, g, n, j] + T_q1*Q_1g[s, g, n, j] - T_hw*H_wg[s, g, n, j]
+                H_cg[s, g, n, j+1] = H_cg[s, g, n, j] + p_c[g]*T_hw*H_wg[s, g, n, j] - T_hc*H_cg[s, g, n, j]
+                H_rg[s, g, n, j+1] = H_rg[s, g, n, j] + (1.-mu_c[g])*T_hc*H_cg[s, g, n, j] - T_hr*H_rg[s, g, n, j]
+                R_g[s, g, n, j+1] = R_g[s, g, n, j] + T_hr*H_rg[s, g, n, j] + (1.-mu_w[g])*(1.-p_c[g])*T_hw*H_wg[s, g, n, j] + (1.-mu_q[g])*T_q0*Q_0g[s, g, n, j]
+                D_g[s, g, n, j+1] = D_g[s, g, n, j] + mu_q[g]*T_q0*Q_0g[s, g, n, j]+mu_w[g]*(1.-p_c[g])*T_hw*H_wg[s, g, n, j] + mu_c[g]*T_hc*H_cg[s, g, n, j]
+
+                hospitalized_incidence[s, g, n, j] = T_q1*Q_1g[s, g, n, j]
+                infections_incidence[s, g, n, j] = T_E*E_g[s, g, n, j]
+
+
+@jit
+def sol_loop(u_con, kernel, beta, c_gh, age_er, alpha, e, rates, age_params,
+             death_optim, S_g, S_vg, S_xg, V_g, E_g, I_g, Q_0g, Q_1g, H_wg,
+             H_cg, H_rg, R_g, D_g, L_g, D_d, V_d, u):
+    # Time loop of optimized_vaccination.sol. Arrays have shape
+    # (N_g, N_p, N_t), are initialized in timestep 0 and updated in place
+    T_E = rates[0]
+    T_V = rates[1]
+    T_I = rates[2]
+    T_q0 = rates[3]
+    T_q1 = rates[4]
+    T_hw = rates[5]
+    T_hc = rates[6]
+    T_hr = rates[7]
+    mu_q = age_params[0]
+    mu_w = age_params[1]
+    mu_c = age_params[2]
+    p_H = age_params[3]
+    p_c = age_params[4]
+
+    N_g, N_p, N_t = S_g.shape
+    for j in range(N_t-1):
+        # Force of infection for all age groups and ervas in timestep j
+        infectious = np.zeros((N_g, N_p))
+        for h in range(N_g):
+            for k in range(N_p):
+                for l in range(N_p):
+                    infectious[h, k] += kernel[k, l]*I_g[h, l, j]*age_er[l, h]
+
+        d_hos = 0.0
+        v_0 = 0.0
+        for g in range(N_g-1, -1, -1):
+            for n in range(N_p):
+                lambda_g = 0.0
+                for h in range(N_g):
+                    lambda_g += c_gh[h, g]*infectious[h, n]
+                L_g[g, n, j] = beta*lambda_g
+
+                u[g, n, j] = min(u_con[g, n, j], max(0.0, S_g[g, n, j] - beta*lambda_g*S_g[g, n, j]))
+                v_0 = v_0 + u[g, n, j]*age_er[n, g]
+                S_g[g, n, j+1] = S_g[g, n, j] - beta*lambda_g*S_g[g, n, j] - u[g, n, j]
+                S_vg[g, n, j+1] = S_vg[g, n, j] - beta*lambda_g*S_vg[g, n, j] + u[g, n, j] - T_V*S_vg[g, n, j]
+                S_xg[g, n, j+1] = S_xg[g, n, j] - beta*lambda_g*S_xg[g, n, j] + (1.-alpha*e)*T_V*S_vg[g, n, j]
+                V_g[g, n, j+1] = V_g[g, n, j] + alpha*e*T_V*S_vg[g, n, j]
+                E_g[g, n, j+1] = E_g[g, n, j] + beta*lambda_g*(S_g[g, n, j]+S_vg[g, n, j] + S_xg[g, n, j]) - T_E*E_g[g, n, j]
+                I_g[g, n, j+1] = I_g[g, n, j] + T_E*E_g[g, n, j] - T_I*I_g[g, n, j]
+                Q_0g[g, n, j+1] = Q_0g[g, n, j] + (1.-p_H[g])*T_I*I_g[g, n, j] - T_q0*Q_0g[g, n, j]
+                Q_1g[g, n, j+1] = Q_1g[g, n, j] + p_H[g]*T_I*I_g[g, n, j] - T_q1*Q_1g[g, n, j]
+                H_wg[g, n, j+1] = H_wg[g, n, j] + T_q1*Q_1g[g, n, j] - T_hw*H_wg[g, n, j]
+                H_cg[g, n, j+1] = H_cg[g, n, j] + p_c[g]*T_hw*H_wg[g, n, j] - T_hc*H_cg[g, n, j]
+                H_rg[g, n, j+1] = H_rg[g, n, j] + (1.-mu_c[g])*T_hc*H_cg[g, n, j] - T_hr*H_rg[g, n, j]
+                R_g[g, n, j+1] = R_g[g, n, j] + T_hr*H_rg[g, n, j] + (1.-mu_w[g])*(1.-p_c[g])*T_hw*H_wg[g, n, j] + (1.-mu_q[g])*T_q0*Q_0g[g, n, j]
+                D_g[g, n, j+1] = D_g[g, n, j] + mu_q[g]*T_q0*Q_0g[g, n, j]+mu_w[g]*(1.-p_c[g])*T_hw*H_wg[g, n, j] + mu_c[g]*T_hc*H_cg[g, n, j]
+
+                if death_optim:
+                    d_hos = d_hos + D_g[g, n, j+1]*age_er[n, g]
+                else:
+                    d_hos = d_hos + T_q1*Q_1g[g, n, j]*age_er[n, g]
+
+        if death_optim:
+            D_d[j+1] = d_hos
+        else:
+            D_d[j] = d_hos
+        V_d[j] = v_0
+
+    if not death_optim:
+        Df = 0.0
+        for h in range(N_g):
+            for k in range(N_p):
+                Df = Df + T_q1*Q_1g[h, k, N_t-1]*age_er[k, h]
+        D_d[N_t-1] = Df
+
+
+@jit
+def back_int_loop(Sg, Sv, Sx, Lg, c_hg, beta, age_er, mob, pop_erva, ind,
+                  alpha, e, rates, age_params, death_optim, lS, lSv, lSx, lE,
+                  lI, lQ_0, lQ_1, lHw, lHc, lHr, lD, dH):
+    # Backward sweep of optimized_vaccination.back_int. The adjoint arrays
+    # have shape (N_g, N_p, N_t), start at zero and are updated in place
+    T_E = rates[0]
+    T_V = rates[1]
+    T_I = rates[2]
+    T_q0 = rates[3]
+    T_q1 = rates[4]
+    T_hw = rates[5]
+    T_hc = rates[6]
+    T_hr = rates[7]
+    mu_q = age_params[0]
+    mu_w = age_params[1]
+    mu_c = age_params[2]
+    p_H = age_params[3]
+    p_c = age_params[4]
+
+    N_g, N_p, N_t = lS.shape
+    for i in range(N_t-1, -1, -1):
+        for g in range(N_g):
+            for n in range(N_p):
+                lS[g, n, i-1] = lS[g, n, i] - lS[g, n, i]*Lg[g+ind, n, i] + lE[g, n, i]*Lg[g+ind, n, i]
+                lSv[g, n, i-1] = lSv[g, n, i] - lSv[g, n, i]*(Lg[g+ind, n, i] + T_V) + lE[g, n, i]*Lg[g+ind, n, i]
+                lSx[g, n, i-1] = lSx[g, n, i] - lSx[g, n, i]*Lg[g+ind, n, i] + lE[g, n, i]*Lg[g+ind, n, i]\
+                    + lSv[g, n, i]*(1.-alpha*e)*T_V
+
+                lE[g, n, i-1] = lE[g, n, i] - (lE[g, n, i]-lI[g, n, i])*T_E
+                sumh = 0.0
+                sumh2 = 0.0
+                sumh3 = 0.0
+                for h in range(N_g):
+                    for k in range(N_p):
+                        for m in range(N_p):
+                            mob_k = mob[k, m]*mob[n, m]/pop_erva[m]
+                            sumh = sumh + beta*c_hg[g+ind, h+ind]*Sg[h+ind, k, i]*mob_k*(lE[h, k, i] - lS[h, k, i])/age_er[k, h+ind]
+                            sumh2 = sumh2 + beta*c_hg[g+ind, h+ind]*Sv[h+ind, k, i]*mob_k*(lE[h, k, i] - lSv[h, k, i])/age_er[k, h+ind]
+                            sumh3 = sumh + beta*c_hg[g+ind, h+ind]*Sx[h+ind, k, i]*mob_k*(lE[h, k, i] - lSx[h, k, i])/age_er[k, h+ind]
+
+                lI[g, n, i-1] = lI[g, n, i] - T_I*lI[g, n, i] + sumh + sumh2 + sumh3 + lQ_0[g, n, i]*(1.-p_H[g+ind])*T_I \
+                    + lQ_1[g, n, i]*p_H[g+ind]*T_I
+                lQ_0[g, n, i-1] = lQ_0[g, n, i]*(1. - T_q0) + lD[g, n, i]*mu_q[g+ind]*T_q0
+
+                if death_optim:
+                    lQ_1[g, n, i-1] = lQ_1[g, n, i]*(1. - T_q1) + lHw[g, n, i]*T_q1
+                else:
+                    lQ_1[g, n, i-1] = lQ_1[g, n, i]*(1. - T_q1) + lHw[g, n, i]*T_q1 + T_q1
+
+                lHw[g, n, i-1] = lHw[g, n, i]*(1.-T_hw) + lHc[g, n, i]*p_c[g+ind]*T_hw \
+                    + lD[g, n, i]*mu_w[g+ind]*(1.-p_c[g+ind])*T_hw
+                lHc[g, n, i-1] = lHc[g, n, i]*(1.-T_hc) + lHr[g, n, i]*(1.-mu_c[g+ind])*T_hc \
+                    + lD[g, n, i]*mu_c[g+ind]*T_hc
+                lHr[g, n, i-1] = lHr[g, n, i]*(1.-T_hr)
+
+                if death_optim:
+                    lD[g, n, i-1] = lD[g, n, i] + 1.
+
+                dH[g, n, i] = -lS[g, n, i] + lSv[g, n, i]
@@ -1,19 +1,83 @@
 import numpy as np
-from scipy.optimize import Bounds
+from scipy import sparse
+from scipy.optimize import Bounds, LinearConstraint
 from scipy.optimize import minimize
 from datetime import datetime
-import pandas as pd
 from env_var import EPIDEMIC, EXPERIMENTS
+import collections
+import hashlib
+import json
 import logging
-from fetch_data import static_population_erva_age
+from epidemic_store import STATE_COLUMNS, csv_signature, read_epidemic_state
+from forward_integration import (
+    get_mobility_parameters, get_model_parameters, mobility_kernel, parameters_digest
+)
+from strategy_library import STRATEGY_LIBRARY, update_strategy_library
+from numba_kernels import (
+    NUMBA_AVAILABLE, age_parameters, back_int_loop, check_numba, epidemic_rates, sol_loop
+)
 import os
+import tempfile
+import threading
 import time
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import datetime as dt
 
 
+# Warm-up states of get_vac by their inputs, least recently used first
+# (see clear_warm_up_cache). Shared by the threads of run_parallel_optimizations
+warm_up_cache = collections.OrderedDict()
+warm_up_lock = threading.Lock()
+# Number of warm-up states kept (a sweep uses one per R and tau)
+WARM_UP_CACHE_SIZE = 64
+
+
+def clear_warm_up_cache():
+    # Needed if EPIDEMIC changes in the same process (changes of the epidemic
+    # state file are detected by its signature)
+    with warm_up_lock:
+        warm_up_cache.clear()
+
+
+def warm_up_csv_path(num_age_groups):
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    csv_name = 'epidemic_finland_%d.csv' % (num_age_groups, )
+    return os.path.join(dir_path, 'out', csv_name)
+
+
 def get_vac(u_con, c1, beta, c_gh, T, pop_hat, age_er):
+    # The warm-up period does not depend on the optimization variables
+    # (u_con and T are not used), so it is simulated once for each t0, beta
+    # and model parameters (tau), as long as the epidemic state file does not
+    # change. The returned arrays are read only
+    t0 = EXPERIMENTS['t0']
+    _, num_age_groups = age_er.shape
+    key = (t0, float(beta), c1.tobytes(), c_gh.tobytes(), pop_hat.tobytes(),
+           age_er.tobytes(), tuple(csv_signature(warm_up_csv_path(num_age_groups))))
+    # The threads wait for a warm-up being simulated instead of simulating it
+    # again (the simulation holds the GIL anyway)
+    with warm_up_lock:
+        if key in warm_up_cache:
+            warm_up_cache.move_to_end(key)
+            return warm_up_cache[key]
+
+        warm_up = simulate_warm_up(c1, beta, c_gh, pop_hat, age_er, t0)
+        for value in warm_up:
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+        warm_up_cache[key] = warm_up
+        if len(warm_up_cache) > WARM_UP_CACHE_SIZE:
+            warm_up_cache.popitem(last=False)
+
+    return warm_up
+
+
+def simulate_warm_up(c1, beta, c_gh, pop_hat, age_er, t0):
+    # Simulates the first days from t0 vaccinating 30000 people per day
+    # proportionally to the population of the ervas
     num_ervas, num_age_groups = age_er.shape
+    pop_erva = age_er.sum(axis=1)
     # Time periods for epidemic
     T_E = EPIDEMIC['T_E']
     T_V = EPIDEMIC['T_V']
@@ -42,41 +106,9 @@ def get_vac(u_con, c1, beta, c_gh, T, pop_hat, age_er):
     N_t = 6
 
     # Reading CSV
-    t0 = EXPERIMENTS['t0']
-
-    # Reading CSV
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    csv_name = 'epidemic_finland_%d.csv' % (num_age_groups, )
-    csv_path = os.path.join(dir_path, 'out', csv_name)
-    # Reading CSV
-    epidemic_csv = pd.read_csv(csv_path)
-    # Getting only date t0
-    epidemic_zero = epidemic_csv.loc[epidemic_csv['date'] == t0, :]
-    # Removing Ahvenanmaa or Aland
-    epidemic_zero = epidemic_zero[~epidemic_zero['erva'].str.contains('land')]
-
-    # Getting the order the ervas have inside the dataframe
-    ervas_order = EPIDEMIC['ervas_order']
-    ervas_df = list(pd.unique(epidemic_zero['erva']))
-    ervas_pd_order = [ervas_df.index(erva) for erva in ervas_order]
-
-    select_columns = ['susceptible',
-                      'infected',
-                      'exposed',
-                      'recovered',
-                      'vaccinated',
-                      'vaccinated no imm',
-                      'ward',
-                      'icu']
-    # Selecting the columns to use
-    epidemic_zero = epidemic_zero[select_columns]
-    # Converting to numpy
-    epidemic_npy = epidemic_zero.values
-    # Reshaping to 3d array
-    epidemic_npy = epidemic_npy.reshape(N_p, N_g, len(select_columns))
-
-    # Rearranging the order of the matrix with correct order
-    epidemic_npy = epidemic_npy[ervas_pd_order, :]
+    csv_path = warm_up_csv_path(num_age_groups)
+    # Values of the date t0 with shape (N_p, N_g, compartments)
+    epidemic_npy = read_epidemic_state(csv_path, t0, STATE_COLUMNS)
 
     # Allocating space for compartments
     S_g = np.zeros((N_g, N_p, N_t))
@@ -127,8 +159,6 @@ def get_vac(u_con, c1, beta, c_gh, T, pop_hat, age_er):
     L_g = np.zeros((N_g, N_p, N_t))
     # cummulative number for all age groups and all ervas
     D_d = np.zeros(N_t)
-    V_d = np.zeros(N_t)
-    hos = np.zeros((N_g, N_p, N_t))
     u = np.zeros((N_g, N_p, N_t))
 
     remain_last = 0
@@ -234,7 +264,14 @@ def get_vac(u_con, c1, beta, c_gh, T, pop_hat, age_er):
     return S0, Sv0, Sx0, V0, E0, I0, Q00, Q01, Hw0, Hc0, Hr0, Rg0, D0, sum(D_d)
 
 
-def sol(u_con, c1, beta, c_gh, T, pop_hat, age_er):
+def sol(u_con, c1, beta, c_gh, T, pop_hat, age_er, backend='python', death_optim=False):
+    # backend='python' is the reference implementation and
+    # backend='numba' runs the same time loop compiled with numba
+    if backend not in ('python', 'numba'):
+        raise ValueError('Unknown backend: %s' % (backend, ))
+    if backend == 'numba':
+        check_numba()
+
     num_ervas, num_age_groups = age_er.shape
     N_g = num_age_groups
     N_p = num_ervas
@@ -293,16 +330,6 @@ def sol(u_con, c1, beta, c_gh, T, pop_hat, age_er):
     V_g[:, :, 0] = vg0
     D_g[:, :, 0] = dg0
 
-    # force of infection in equation (4)
-    def force_of_inf(I_h, c_gh, k, N_g, N_p, mob, pop_hat):
-        fi = 0.0
-        for h in range(N_g):
-            for m in range(N_p):
-                for l in range(N_p):
-                    fi = fi + (mob[k, m]*mob[l, m]*I_h[h, l]*c_gh[h]*age_er[l, h])/pop_hat[m]
-
-        return fi
-
     # I store the values for the force of infection (needed for the adjoint equations)
     L_g = np.zeros((N_g, N_p, N_t))
     # cummulative number for all age groups and all ervas
@@ -311,55 +338,84 @@ def sol(u_con, c1, beta, c_gh, T, pop_hat, age_er):
 
     u = np.zeros((N_g, N_p, N_t))
 
-    for j in range(N_t-1):
-        d_hos = 0.0
-        v_0 = 0.0
-        for g in range(N_g-1, -1, -1):
-            for n in range(N_p):
-                lambda_c = force_of_inf(I_g[:, :, j], c_gh[:, g], n, N_g, N_p, c1, pop_hat)
-                L_g[g, n, j] = beta*lambda_c
-                lambda_g = lambda_c
-
-                u[g, n, j] = min(u_con[g, n, j], max(0.0, S_g[g, n, j] - beta*lambda_g*S_g[g, n, j]))
-                v_0 = v_0 + u[g, n, j]*age_er[n, g]
-                S_g[g, n, j+1] = S_g[g, n, j] - beta*lambda_g*S_g[g, n, j] - u[g, n, j]
-                S_vg[g, n, j+1] = S_vg[g, n, j] - beta*lambda_g*S_vg[g, n, j] + u[g, n, j] - T_V*S_vg[g, n, j]
-                S_xg[g, n, j+1] = S_xg[g, n, j] - beta*lambda_g*S_xg[g, n, j] + (1.-alpha*e)*T_V*S_vg[g, n, j]
-                V_g[g, n, j+1] = V_g[g, n, j] + alpha*e*T_V*S_vg[g, n, j]
-                E_g[g, n, j+1] = E_g[g, n, j] + beta*lambda_g*(S_g[g, n, j]+S_vg[g, n, j] + S_xg[g, n, j]) - T_E*E_g[g, n, j]
-                I_g[g, n, j+1] = I_g[g, n, j] + T_E*E_g[g, n, j] - T_I*I_g[g, n, j]
-                Q_0g[g, n, j+1] = Q_0g[g, n, j] + (1.-p_H[g])*T_I*I_g[g, n, j] - T_q0*Q_0g[g, n, j]
-                Q_1g[g, n, j+1] = Q_1g[g, n, j] + p_H[g]*T_I*I_g[g, n, j] - T_q1*Q_1g[g, n, j]
-                H_wg[g, n, j+1] = H_wg[g, n, j] + T_q1*Q_1g[g, n, j] - T_hw*H_wg[g, n, j]
-                H_cg[g, n, j+1] = H_cg[g, n, j] + p_c[g]*T_hw*H_wg[g, n, j] - T_hc*H_cg[g, n, j]
-                H_rg[g, n, j+1] = H_rg[g, n, j] + (1.-mu_c[g])*T_hc*H_cg[g, n, j] - T_hr*H_rg[g, n, j]
-                R_g[g, n, j+1] = R_g[g, n, j] + T_hr*H_rg[g, n, j] + (1.-mu_w[g])*(1.-p_c[g])*T_hw*H_wg[g, n, j] + (1.-mu_q[g])*T_q0*Q_0g[g, n, j]
-                D_g[g, n, j+1] = D_g[g, n, j] + mu_q[g]*T_q0*Q_0g[g, n, j]+mu_w[g]*(1.-p_c[g])*T_hw*H_wg[g, n, j] + mu_c[g]*T_hc*H_cg[g, n, j]
-
-                if death_optim:
-                    d_hos = d_hos + D_g[g, n, j+1]*age_er[n, g] # T_q1*Q_1g[g, n, j]*age_er[n,g]
-                else:
-                    d_hos = d_hos + T_q1*Q_1g[g, n, j]*age_er[n, g]
+    if backend == 'numba':
+        kernel = mobility_kernel(c1, pop_hat)
+        sol_loop(u_con, kernel, beta, c_gh, age_er, alpha, e,
+                 epidemic_rates(EPIDEMIC), age_parameters(EPIDEMIC, num_age_groups),
+                 death_optim, S_g, S_vg, S_xg, V_g, E_g, I_g, Q_0g, Q_1g, H_wg,
+                 H_cg, H_rg, R_g, D_g, L_g, D_d, V_d, u)
+    else:
+        # force of infection in equation (4)
+        def force_of_inf(I_h, c_gh, k, N_g, N_p, mob, pop_hat):
+            fi = 0.0
+            for h in range(N_g):
+                for m in range(N_p):
+                    for l in range(N_p):
+                        fi = fi + (mob[k, m]*mob[l, m]*I_h[h, l]*c_gh[h]*age_er[l, h])/pop_hat[m]
+
+            return fi
+
+        for j in range(N_t-1):
+            d_hos = 0.0
+            v_0 = 0.0
+            for g in range(N_g-1, -1, -1):
+                for n in range(N_p):
+                    lambda_c = force_of_inf(I_g[:, :, j], c_gh[:, g], n, N_g, N_p, c1, pop_hat)
+                    L_g[g, n, j] = beta*lambda_c
+                    lambda_g = lambda_c
+
+                    u[g, n, j] = min(u_con[g, n, j], max(0.0, S_g[g, n, j] - beta*lambda_g*S_g[g, n, j]))
+                    v_0 = v_0 + u[g, n, j]*age_er[n, g]
+                    S_g[g, n, j+1] = S_g[g, n, j] - beta*lambda_g*S_g[g, n, j] - u[g, n, j]
+                    S_vg[g, n, j+1] = S_vg[g, n, j] - beta*lambda_g*S_vg[g, n, j] + u[g, n, j] - T_V*S_vg[g, n, j]
+                    S_xg[g, n, j+1] = S_xg[g, n, j] - beta*lambda_g*S_xg[g, n, j] + (1.-alpha*e)*T_V*S_vg[g, n, j]
+                    V_g[g, n, j+1] = V_g[g, n, j] + alpha*e*T_V*S_vg[g, n, j]
+                    E_g[g, n, j+1] = E_g[g, n, j] + beta*lambda_g*(S_g[g, n, j]+S_vg[g, n, j] + S_xg[g, n, j]) - T_E*E_g[g, n, j]
+                    I_g[g, n, j+1] = I_g[g, n, j] + T_E*E_g[g, n, j] - T_I*I_g[g, n, j]
+                    Q_0g[g, n, j+1] = Q_0g[g, n, j] + (1.-p_H[g])*T_I*I_g[g, n, j] - T_q0*Q_0g[g, n, j]
+                    Q_1g[g, n, j+1] = Q_1g[g, n, j] + p_H[g]*T_I*I_g[g, n, j] - T_q1*Q_1g[g, n, j]
+                    H_wg[g, n, j+1] = H_wg[g, n, j] + T_q1*Q_1g[g, n, j] - T_hw*H_wg[g, n, j]
+                    H_cg[g, n, j+1] = H_cg[g, n, j] + p_c[g]*T_hw*H_wg[g, n, j] - T_hc*H_cg[g, n, j]
+                    H_rg[g, n, j+1] = H_rg[g, n, j] + (1.-mu_c[g])*T_hc*H_cg[g, n, j] - T_hr*H_rg[g, n, j]
+                    R_g[g, n, j+1] = R_g[g, n, j] + T_hr*H_rg[g, n, j] + (1.-mu_w[g])*(1.-p_c[g])*T_hw*H_wg[g, n, j] + (1.-mu_q[g])*T_q0*Q_0g[g, n, j]
+                    D_g[g, n, j+1] = D_g[g, n, j] + mu_q[g]*T_q0*Q_0g[g, n, j]+mu_w[g]*(1.-p_c[g])*T_hw*H_wg[g, n, j] + mu_c[g]*T_hc*H_cg[g, n, j]
+
+                    if death_optim:
+                        d_hos = d_hos + D_g[g, n, j+1]*age_er[n, g] # T_q1*Q_1g[g, n, j]*age_er[n,g]
+                    else:
+                        d_hos = d_hos + T_q1*Q_1g[g, n, j]*age_er[n, g]
+
+            if death_optim:
+                D_d[j+1] = d_hos
+            else:
+                D_d[j] = d_hos
+            V_d[j] = v_0
 
-        if death_optim:
-            D_d[j+1] = d_hos
-        else:
-            D_d[j] = d_hos
-        V_d[j] = v_0
+        if not death_optim:
+            Df = 0.0
+            for h in range(N_g):
+                for k in range(N_p):
+                    Df = Df + T_q1*Q_1g[h, k, N_t-1]*age_er[k, h]
+            D_d[N_t-1] = Df
 
     if death_optim:
         return S_g, S_vg, S_xg, L_g, D_d.max(), V_d, u
     else:
-        Df = 0.0
-        for h in range(N_g):
-            for k in range(N_p):
-                Df = Df + T_q1*Q_1g[h, k, N_t-1]*age_er[k, h]
-        D_d[N_t-1] = Df
         # np.save("u0.npy", u)
         return S_g, S_vg, S_xg, L_g, sum(D_d), V_d, u
 
 
-def back_int(Sg, Sv, Sx, Lg, nu, c_hg, beta, T, age_er, mob, pop_erva, ind):
+def back_int(Sg, Sv, Sx, Lg, nu, c_hg, beta, T, age_er, mob, pop_erva, ind,
+             backend='numpy', death_optim=False, num_groups=5):
+    # Gradient for the num_groups age groups starting from ind.
+    # backend='numpy' contracts the mobility kernel with all age groups and
+    # ervas at once, backend='python' is the reference implementation and
+    # backend='numba' runs the reference backward sweep compiled with numba
+    if backend not in ('numpy', 'python', 'numba'):
+        raise ValueError('Unknown backend: %s' % (backend, ))
+    if backend == 'numba':
+        check_numba()
+
     num_ervas, num_age_groups = age_er.shape
 
     T_E = EPIDEMIC['T_E']
@@ -384,7 +440,7 @@ def back_int(Sg, Sv, Sx, Lg, nu, c_hg, beta, T, age_er, mob, pop_erva, ind):
     alpha = EPIDEMIC['alpha']
     e = EPIDEMIC['e']
 
-    N_g = 5
+    N_g = num_groups
     N_p = num_ervas
     N_t = T
 
@@ -402,367 +458,570 @@ def back_int(Sg, Sv, Sx, Lg, nu, c_hg, beta, T, age_er, mob, pop_erva, ind):
     lD = np.zeros((N_g, N_p, N_t))
 
     dH = np.zeros((N_g, N_p, N_t))
-    for i in range(N_t-1, -1, -1):
-        for g in range(N_g):
-            for n in range(N_p):
-                lS[g, n, i-1] = lS[g, n, i] - lS[g, n, i]*Lg[g+ind, n, i] + lE[g, n, i]*Lg[g+ind, n, i]
-                lSv[g, n, i-1] = lSv[g, n, i] - lSv[g, n, i]*(Lg[g+ind, n, i] + T_V) + lE[g, n, i]*Lg[g+ind, n, i]
-                lSx[g, n, i-1] = lSx[g, n, i] - lSx[g, n, i]*Lg[g+ind, n, i] + lE[g, n, i]*Lg[g+ind, n, i]\
-                    + lSv[g, n, i]*(1.-alpha*e)*T_V
-
-                lE[g, n, i-1] = lE[g, n, i] - (lE[g, n, i]-lI[g, n, i])*T_E
-                sumh = 0.0
-                sumh2 = 0.0
-                sumh3 = 0.0
-                for h in range(N_g):
-                    for k in range(N_p):
-                        for m in range(N_p):
-                            mob_k = mob[k, m]*mob[n, m]/pop_erva[m]
-                            sumh = sumh + beta*c_hg[g+ind, h+ind]*Sg[h+ind, k, i]*mob_k*(lE[h, k, i] - lS[h, k, i])/age_er[k, h+ind]
-                            sumh2 = sumh2 + beta*c_hg[g+ind, h+ind]*Sv[h+ind, k, i]*mob_k*(lE[h, k, i] - lSv[h, k, i])/age_er[k, h+ind]
-                            sumh3 = sumh + beta*c_hg[g+ind, h+ind]*Sx[h+ind, k, i]*mob_k*(lE[h, k, i] - lSx[h, k, i])/age_er[k, h+ind]
-
-                lI[g, n, i-1] = lI[g, n, i] - T_I*lI[g, n, i] + sumh + sumh2 + sumh3 + lQ_0[g, n, i]*(1.-p_H[g+ind])*T_I \
-                    + lQ_1[g, n, i]*p_H[g+ind]*T_I
-                lQ_0[g, n, i-1] = lQ_0[g, n, i]*(1. - T_q0) + lD[g, n, i]*mu_q[g+ind]*T_q0
-
-                if death_optim:
-                    lQ_1[g, n, i-1] = lQ_1[g, n, i]*(1. - T_q1) + lHw[g, n, i]*T_q1  #+ T_q1
-                else:
-                    lQ_1[g, n, i-1] = lQ_1[g, n, i]*(1. - T_q1) + lHw[g, n, i]*T_q1 + T_q1
-
-                lHw[g, n, i-1] = lHw[g, n, i]*(1.-T_hw) + lHc[g, n, i]*p_c[g+ind]*T_hw \
-                    + lD[g, n, i]*mu_w[g+ind]*(1.-p_c[g+ind])*T_hw
-                lHc[g, n, i-1] = lHc[g, n, i]*(1.-T_hc) + lHr[g, n, i]*(1.-mu_c[g+ind])*T_hc \
-                    + lD[g, n, i]*mu_c[g+ind]*T_hc
-                lHr[g, n, i-1] = lHr[g, n, i]*(1.-T_hr)
-
-                if death_optim:
-                    lD[g, n, i-1] = lD[g, n, i] + 1.
-
-                # if lS[g,n,i]>lSv[g,n,i]:
-                dH[g, n, i] = -lS[g, n, i] + lSv[g, n, i]
-            # else:
-            #   dH[g,n,i] = 0.0
+    if backend == 'numba':
+        back_int_loop(Sg, Sv, Sx, Lg, c_hg, beta, age_er, mob, pop_erva, ind,
+                      alpha, e, epidemic_rates(EPIDEMIC),
+                      age_parameters(EPIDEMIC, num_age_groups), death_optim,
+                      lS, lSv, lSx, lE, lI, lQ_0, lQ_1, lHw, lHc, lHr, lD, dH)
+    elif backend == 'numpy':
+        # sum_m mob[k, m]*mob[n, m]/pop_erva[m], computed once for all timesteps
+        kernel = mobility_kernel(mob, pop_erva)
+        # Parameters of the age groups in the optimization (from ind)
+        ages = slice(ind, ind+N_g)
+        beta_c_hg = beta*c_hg[ages, ages]
+        age_er_hk = age_er[:, ages].T
+        p_H_g = p_H[ages, np.newaxis]
+        p_c_g = p_c[ages, np.newaxis]
+        mu_q_g = mu_q[ages, np.newaxis]
+        mu_w_g = mu_w[ages, np.newaxis]
+        mu_c_g = mu_c[ages, np.newaxis]
+        # Mobility weights of the last visited erva m = N_p-1 (see sumh3)
+        mob_last = mob[N_p-1, N_p-1]*mob[:, N_p-1]/pop_erva[N_p-1]
+        for i in range(N_t-1, -1, -1):
+            Lg_i = Lg[ages, :, i]
+            lS[:, :, i-1] = lS[:, :, i] - lS[:, :, i]*Lg_i + lE[:, :, i]*Lg_i
+            lSv[:, :, i-1] = lSv[:, :, i] - lSv[:, :, i]*(Lg_i + T_V) + lE[:, :, i]*Lg_i
+            lSx[:, :, i-1] = lSx[:, :, i] - lSx[:, :, i]*Lg_i + lE[:, :, i]*Lg_i\
+                + lSv[:, :, i]*(1.-alpha*e)*T_V
+
+            lE[:, :, i-1] = lE[:, :, i] - (lE[:, :, i]-lI[:, :, i])*T_E
+
+            # Sums over age groups h and ervas k of the reference implementation
+            sumh = beta_c_hg @ (Sg[ages, :, i]*(lE[:, :, i] - lS[:, :, i])/age_er_hk) @ kernel
+            sumh2 = beta_c_hg @ (Sv[ages, :, i]*(lE[:, :, i] - lSv[:, :, i])/age_er_hk) @ kernel
+            # The reference implementation keeps in sumh3 only sumh plus the
+            # last (h, k, m) term of the Sx sum, reproduced here as is
+            Sx_last = Sx[ind+N_g-1, N_p-1, i]*(lE[N_g-1, N_p-1, i] - lSx[N_g-1, N_p-1, i])/age_er[N_p-1, ind+N_g-1]
+            sumh3 = sumh + beta_c_hg[:, N_g-1, np.newaxis]*Sx_last*mob_last[np.newaxis, :]
+
+            lI[:, :, i-1] = lI[:, :, i] - T_I*lI[:, :, i] + sumh + sumh2 + sumh3 + lQ_0[:, :, i]*(1.-p_H_g)*T_I \
+                + lQ_1[:, :, i]*p_H_g*T_I
+            lQ_0[:, :, i-1] = lQ_0[:, :, i]*(1. - T_q0) + lD[:, :, i]*mu_q_g*T_q0
+
+            if death_optim:
+                lQ_1[:, :, i-1] = lQ_1[:, :, i]*(1. - T_q1) + lHw[:, :, i]*T_q1
+            else:
+                lQ_1[:, :, i-1] = lQ_1[:, :, i]*(1. - T_q1) + lHw[:, :, i]*T_q1 + T_q1
 
-    return dH
+            lHw[:, :, i-1] = lHw[:, :, i]*(1.-T_hw) + lHc[:, :, i]*p_c_g*T_hw \
+                + lD[:, :, i]*mu_w_g*(1.-p_c_g)*T_hw
+            lHc[:, :, i-1] = lHc[:, :, i]*(1.-T_hc) + lHr[:, :, i]*(1.-mu_c_g)*T_hc \
+                + lD[:, :, i]*mu_c_g*T_hc
+            lHr[:, :, i-1] = lHr[:, :, i]*(1.-T_hr)
 
+            if death_optim:
+                lD[:, :, i-1] = lD[:, :, i] + 1.
 
-def ob_fun(x):
-    Ng = 5
-    N_p = 5
-    Nt = 110
-    nuc = np.reshape(x, (Ng, N_p, Nt))
-    nu2 = np.zeros((2, N_p, Nt))
-    nu3 = np.zeros((2, N_p, Nt))
-    nuf = np.concatenate((nu2, nuc, nu3))
-    Sg, Svg, Sxg, Lg, Dg, Vd, vac = sol(nuf, mob_av, beta, beta_gh, T, pop_erva_hat, age_er)
-
-    l = (Dg)
-    print(l)
-
-    J = l
-    return J
-
-
-def der(x):
-    Ng = 5
-    N_p = 5
-    Nt = 110
-
-    nuc = np.reshape(x, (Ng, N_p, Nt))
-    nu2 = np.zeros((2, N_p, Nt))
-    nu3 = np.zeros((2, N_p, Nt))
-    nuf = np.concatenate((nu2, nuc, nu3))
-    Sg, Svg, Sxg, Lg, Dg, Vd, vac = sol(nuf, mob_av, beta, beta_gh, T, pop_erva_hat, age_er)
-    # calculation of the gradient
-    dH = back_int(Sg, Svg, Sxg, Lg, u, beta_gh, beta, T, age_er, mob_av, pop_erva_hat, 2)
-
-    dH2 = np.reshape(dH, (Ng*N_p*Nt))
-
-    return dH2
-
-
-def bound_f(bound_full, T_i, u_op, kg_pairs):
-    Ng = 5
-    N_p = 5
-    T = 110
-    T_old = T_i
-    T_temp = T_i
-    bound_r = np.reshape(bound_full, (Ng, N_p, T))
-    Sg, Svg, Sxg, Lg, Dg, Vd, vac = sol(u_op, mob_av, beta, beta_gh, T, pop_erva_hat, age_er)
-    Var = False
-    for i in range(T_i+1, T):
-        for g in range(Ng-1, -1, -1):
-            for k in range(N_p):
-                if Sg[g+2, k, i] == 0:
-                    if (g, k) not in kg_pairs:
-                        T_i = i
-                        print(T_i, g, k)
-                        bound_r[g, k, i-1] = Sg[g+2, k, i-1] - Lg[g+2, k, i-1]*Sg[g+2, k, i-1]
-                        bound_r[g, k, i:T] = 0.0
-                        T_temp = i
-                        kg_pairs.append((g, k))
-                        Var = True
-        if Var:
-            break
-
-    bound_rf = np.reshape(bound_r, Ng*N_p*T)
-
-    return bound_rf, T_i, kg_pairs
-
-
-def optimize(filename, beta_sim=0.03559801015581483, r=1.0, death_optim_in=False):
-    global beta
-    beta = beta_sim
-
-    global death_optim
-    death_optim = death_optim_in
-    r = r
-
-    # contact matrix
-    num_ervas = EXPERIMENTS['num_ervas']
-    number_age_groups = EXPERIMENTS['num_age_groups']
-
-    c_gh_3 = EPIDEMIC['contact_matrix'][number_age_groups]
-
-    logger = logging.getLogger()
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    csv_name = 'erva_population_age_2020.csv'
-    erva_pop_file = os.path.join(dir_path, 'stats', csv_name)
-    pop_ervas_age, _ = static_population_erva_age(logger, erva_pop_file,
-                                                  number_age_groups=number_age_groups)
-    pop_ervas_age = pop_ervas_age[~pop_ervas_age['erva'].str.contains('All')]
-    pop_ervas_age = pop_ervas_age[~pop_ervas_age['erva'].str.contains('land')]
-    pop_ervas_age = pop_ervas_age.sort_values(['erva', 'age_group'])
-    pop_ervas_npy = pop_ervas_age['Total'].values
-    pop_ervas_npy = pop_ervas_npy.reshape(num_ervas, number_age_groups)
-
-    ervas_order = EPIDEMIC['ervas_order']
-
-    ervas_df = list(pd.unique(pop_ervas_age['erva']))
-    ervas_pd_order = [ervas_df.index(erva) for erva in ervas_order]
-    # age structure in each erva
-    global age_er
-    age_er = pop_ervas_npy[ervas_pd_order, :]
-
-    global pop_erva
-    pop_erva = age_er.sum(axis=1)
+            dH[:, :, i] = -lS[:, :, i] + lSv[:, :, i]
+    else:
+        for i in range(N_t-1, -1, -1):
+            for g in range(N_g):
+                for n in range(N_p):
+                    lS[g, n, i-1] = lS[g, n, i] - lS[g, n, i]*Lg[g+ind, n, i] + lE[g, n, i]*Lg[g+ind, n, i]
+                    lSv[g, n, i-1] = lSv[g, n, i] - lSv[g, n, i]*(Lg[g+ind, n, i] + T_V) + lE[g, n, i]*Lg[g+ind, n, i]
+                    lSx[g, n, i-1] = lSx[g, n, i] - lSx[g, n, i]*Lg[g+ind, n, i] + lE[g, n, i]*Lg[g+ind, n, i]\
+                        + lSv[g, n, i]*(1.-alpha*e)*T_V
+
+                    lE[g, n, i-1] = lE[g, n, i] - (lE[g, n, i]-lI[g, n, i])*T_E
+                    sumh = 0.0
+                    sumh2 = 0.0
+                    sumh3 = 0.0
+                    for h in range(N_g):
+                        for k in range(N_p):
+                            for m in range(N_p):
+                                mob_k = mob[k, m]*mob[n, m]/pop_erva[m]
+                                sumh = sumh + beta*c_hg[g+ind, h+ind]*Sg[h+ind, k, i]*mob_k*(lE[h, k, i] - lS[h, k, i])/age_er[k, h+ind]
+                                sumh2 = sumh2 + beta*c_hg[g+ind, h+ind]*Sv[h+ind, k, i]*mob_k*(lE[h, k, i] - lSv[h, k, i])/age_er[k, h+ind]
+                                sumh3 = sumh + beta*c_hg[g+ind, h+ind]*Sx[h+ind, k, i]*mob_k*(lE[h, k, i] - lSx[h, k, i])/age_er[k, h+ind]
+
+                    lI[g, n, i-1] = lI[g, n, i] - T_I*lI[g, n, i] + sumh + sumh2 + sumh3 + lQ_0[g, n, i]*(1.-p_H[g+ind])*T_I \
+                        + lQ_1[g, n, i]*p_H[g+ind]*T_I
+                    lQ_0[g, n, i-1] = lQ_0[g, n, i]*(1. - T_q0) + lD[g, n, i]*mu_q[g+ind]*T_q0
+
+                    if death_optim:
+                        lQ_1[g, n, i-1] = lQ_1[g, n, i]*(1. - T_q1) + lHw[g, n, i]*T_q1  #+ T_q1
+                    else:
+                        lQ_1[g, n, i-1] = lQ_1[g, n, i]*(1. - T_q1) + lHw[g, n, i]*T_q1 + T_q1
+
+                    lHw[g, n, i-1] = lHw[g, n, i]*(1.-T_hw) + lHc[g, n, i]*p_c[g+ind]*T_hw \
+                        + lD[g, n, i]*mu_w[g+ind]*(1.-p_c[g+ind])*T_hw
+                    lHc[g, n, i-1] = lHc[g, n, i]*(1.-T_hc) + lHr[g, n, i]*(1.-mu_c[g+ind])*T_hc \
+                        + lD[g, n, i]*mu_c[g+ind]*T_hc
+                    lHr[g, n, i-1] = lHr[g, n, i]*(1.-T_hr)
+
+                    if death_optim:
+                        lD[g, n, i-1] = lD[g, n, i] + 1.
+
+                    # if lS[g,n,i]>lSv[g,n,i]:
+                    dH[g, n, i] = -lS[g, n, i] + lSv[g, n, i]
+                # else:
+                #   dH[g,n,i] = 0.0
 
-    # mobility matrix
-    m_av = EPIDEMIC['mobility_matrix'][num_ervas]
+    return dH
 
-    m_av = m_av/pop_erva[:, np.newaxis]
 
-    N_p = num_ervas
-    Ng = number_age_groups
+class ForwardEvaluator:
+    # Serves the objective and the gradient from the same forward simulation.
+    # SLSQP evaluates ob_fun and der with the same x, so the result of
+    # simulate for the last x (by the hash of its values) is kept
+    def __init__(self, simulate):
+        self.simulate = simulate
+        self.x_hash = None
+        self.trajectory = None
+
+    def forward(self, x):
+        x_hash = hashlib.sha1(np.ascontiguousarray(x, dtype=np.float64).tobytes()).hexdigest()
+        if x_hash != self.x_hash:
+            self.trajectory = self.simulate(x)
+            self.x_hash = x_hash
+
+        return self.trajectory
+
+
+def vaccination_constraints(age_er, T, n_max, first_group, num_groups):
+    # Daily vaccines: sum_{g, n} age_er[n, g]*x[g, n, t] = n_max for every t.
+    # The optimization variables x are ordered by age group (from
+    # first_group), erva and timestep. Af is a sparse (T, num_groups*N_p*T)
+    # matrix with the population of each age group and erva in the diagonal
+    # of its block
+    weights = age_er[:, first_group:first_group+num_groups].T.ravel().astype(np.float64)
+    Af = sparse.kron(weights[np.newaxis, :], sparse.identity(T), format='csr')
+    b = n_max*np.ones(T)
 
-    global mob_av
-    mob_av = np.zeros((N_p, N_p))
+    return Af, b
+
+
+def vaccination_upper_bounds(age_er, T, n_max, first_group, num_groups):
+    # At most all the vaccines of a day in each age group and erva
+    # (same order as the optimization variables)
+    ages_ervas = age_er[:, first_group:first_group+num_groups].T.ravel()
+
+    return np.repeat(n_max/ages_ervas, T)
+
+
+class LimitedMemoryHessian:
+    # Limited memory BFGS approximation of the Hessian for trust-constr,
+    # built from the last memory pairs of steps and gradient changes. The
+    # products with a vector use the compact representation
+    #   B = d*I - W @ inv(M) @ W.T, W = [d*S, Y], M = [[d*S.T@S, L], [L.T, -D]]
+    # with D and L the diagonal and strictly lower part of S.T@Y (Nocedal and
+    # Wright, section 7.2), so the dense (n, n) matrix is never formed
+    def __init__(self, memory=10):
+        self.memory = memory
+        self.steps = []
+        self.gradient_changes = []
+        self.x = None
+        self.gradient = None
+
+    def update(self, x, gradient):
+        if self.x is not None:
+            s = x - self.x
+            y = gradient - self.gradient
+            # Pairs without positive curvature would make B indefinite
+            if s @ y > 1e-10*np.linalg.norm(s)*np.linalg.norm(y):
+                self.steps.append(s)
+                self.gradient_changes.append(y)
+                del self.steps[:-self.memory]
+                del self.gradient_changes[:-self.memory]
+        self.x = np.array(x, dtype=np.float64)
+        self.gradient = np.array(gradient, dtype=np.float64)
+
+    def dot(self, p):
+        if not self.steps:
+            return np.array(p, dtype=np.float64)
+        S = np.column_stack(self.steps)
+        Y = np.column_stack(self.gradient_changes)
+        SY = S.T @ Y
+        delta = (Y[:, -1] @ Y[:, -1])/SY[-1, -1]
+        L = np.tril(SY, -1)
+        M = np.block([[delta*(S.T @ S), L], [L.T, -np.diag(np.diag(SY))]])
+        W = np.hstack((delta*S, Y))
+        return delta*p - W @ np.linalg.solve(M, W.T @ p)
+
+    def hessp(self, x, p):
+        return self.dot(p)
+
+
+class VaccinationOptimizer:
+    # State of the optimization of the vaccination strategy for one beta and
+    # tau. The optimization variables are the vaccines of the N_o age groups
+    # from first_group in every erva and timestep.
+    # backend is the one of sol ('python' or 'numba'). back_int uses its
+    # vectorized version unless the numba backend is selected
+    def __init__(self, beta, tau, death_optim=False, backend='python', T=110,
+                 n_max=30000):
+        self.beta = beta
+        self.tau = tau
+        self.death_optim = death_optim
+        self.sim_backend = backend
+        self.adjoint_backend = 'numba' if backend == 'numba' else 'numpy'
+        self.T = T
+        self.n_max = n_max
+
+        num_ervas = EXPERIMENTS['num_ervas']
+        number_age_groups = EXPERIMENTS['num_age_groups']
+
+        # age structure in each erva, mobility matrix, population size because
+        # of mobility (N_hat_{l}) and contacts, shared with get_model_parameters
+        print('tau = %s' % (tau, ))
+        self.mob_av, self.beta_gh, self.pop_erva_hat, self.age_er = get_mobility_parameters(number_age_groups,
+                                                                                            num_ervas,
+                                                                                            tau)
+        self.pop_erva = self.age_er.sum(axis=1)
+
+        self.N_p = num_ervas
+        self.N_g = number_age_groups
+        # Optimized age groups: all but the first_group youngest and oldest ones
+        self.first_group = 2
+        self.N_o = number_age_groups - 2*self.first_group
+
+        # transmission parameter
+        self.u = np.zeros((number_age_groups, num_ervas, T))
+
+        # Forward simulations shared by ob_fun and der
+        self.evaluator = ForwardEvaluator(self.simulate)
+
+    def sol(self, nuf):
+        return sol(nuf, self.mob_av, self.beta, self.beta_gh, self.T, self.pop_erva_hat,
+                   self.age_er, backend=self.sim_backend, death_optim=self.death_optim)
+
+    def full_strategy(self, x):
+        # Vaccines of all the age groups, zero for the ones not optimized
+        nuf = np.zeros((self.N_g, self.N_p, self.T))
+        ages = slice(self.first_group, self.first_group+self.N_o)
+        nuf[ages] = np.reshape(x, (self.N_o, self.N_p, self.T))
+        return nuf
+
+    def simulate(self, x):
+        return self.sol(self.full_strategy(x))
+
+    def ob_fun(self, x):
+        Sg, Svg, Sxg, Lg, Dg, Vd, vac = self.evaluator.forward(x)
+
+        l = (Dg)
+        print(l)
+
+        J = l
+        return J
+
+    def der(self, x):
+        Sg, Svg, Sxg, Lg, Dg, Vd, vac = self.evaluator.forward(x)
+        # calculation of the gradient
+        dH = back_int(Sg, Svg, Sxg, Lg, self.u, self.beta_gh, self.beta, self.T, self.age_er,
+                      self.mob_av, self.pop_erva_hat, self.first_group,
+                      backend=self.adjoint_backend, death_optim=self.death_optim,
+                      num_groups=self.N_o)
+
+        dH2 = np.reshape(dH, (self.N_o*self.N_p*self.T))
+
+        return dH2
+
+    def bound_f(self, bound_full, T_i, x, kg_pairs):
+        Ng = self.N_o
+        g0 = self.first_group
+        N_p = self.N_p
+        T = self.T
+        T_old = T_i
+        T_temp = T_i
+        bound_r = np.reshape(bound_full, (Ng, N_p, T))
+        # The solver has usually evaluated the trajectory of its optimum already
+        Sg, Svg, Sxg, Lg, Dg, Vd, vac = self.evaluator.forward(x)
+        Var = False
+        for i in range(T_i+1, T):
+            for g in range(Ng-1, -1, -1):
+                for k in range(N_p):
+                    if Sg[g+g0, k, i] == 0:
+                        if (g, k) not in kg_pairs:
+                            T_i = i
+                            print(T_i, g, k)
+                            bound_r[g, k, i-1] = Sg[g+g0, k, i-1] - Lg[g+g0, k, i-1]*Sg[g+g0, k, i-1]
+                            bound_r[g, k, i:T] = 0.0
+                            T_temp = i
+                            kg_pairs.append((g, k))
+                            Var = True
+            if Var:
+                break
+
+        bound_rf = np.reshape(bound_r, Ng*N_p*T)
+
+        return bound_rf, T_i, kg_pairs
+
+    def minimize_deaths(self, x0, Af, b, bounds, maxiter, method, callback=None):
+        if method == 'SLSQP':
+            # The SLSQP of scipy only takes dense constraint Jacobians, so the
+            # default method still builds the (T, N_o*N_p*T) matrix. Only
+            # trust-constr uses the sparse one
+            Af_dense = Af.toarray()
+            cons = {
+                    "type": "eq", "fun": lambda x:  Af_dense @ x - b,
+                    'jac': lambda x: Af_dense
+            }
+            return minimize(self.ob_fun, x0, method='SLSQP', jac=self.der,
+                            constraints=[cons], options={'maxiter': maxiter, 'disp': True},
+                            bounds=bounds, callback=callback)
+        elif method == 'trust-constr':
+            # trust-constr keeps the sparse constraint matrix in its
+            # factorizations. The Hessian is only used through its products
+            # with vectors, updated with every gradient
+            cons = LinearConstraint(Af, b, b)
+            hessian = LimitedMemoryHessian()
+
+            def jac(x):
+                gradient = self.der(x)
+                hessian.update(x, gradient)
+                return gradient
+
+            return minimize(self.ob_fun, x0, method='trust-constr', jac=jac,
+                            hessp=hessian.hessp, constraints=[cons],
+                            options={'maxiter': maxiter, 'verbose': 1},
+                            bounds=bounds, callback=callback)
+        else:
+            raise ValueError('Unknown method: %s' % (method, ))
 
-    print('tau = %s' % (r, ))
-    for k in range(N_p):
-        for m in range(N_p):
-            if k == m:
-                mob_av[k, m] = (1.-r) + r*m_av[k, m]
-            else:
-                mob_av[k, m] = r*m_av[k, m]
-
-    ####################################################################
-    # equation (3) in overleaf (change in population size because of mobility) N_hat_{lg}, N_hat_{l}
-    global pop_erva_hat
-    pop_erva_hat = np.zeros(N_p)
-    age_er_hat = np.zeros((Ng, N_p))
-
-    for m in range(N_p):
-        m_k = 0.0
-        for k in range(N_p):
-            m_k = m_k + pop_erva[k]*mob_av[k, m]
-            for g in range(Ng):
-                age_er_hat[g, m] = sum(age_er[:, g]*mob_av[:, m])
-
-        pop_erva_hat[m] = m_k
-
-    age_pop = sum(age_er)
-    global beta_gh
-    beta_gh = np.zeros((Ng, Ng))
-
-    for g in range(Ng):
-        for h in range(Ng):
-            if g == h:
-                for m in range(N_p):
-                    sum_kg2 = 0.0
-                    for k in range(N_p):
-                        sum_kg2 = sum_kg2 + age_er[k, g]*mob_av[k, m]*mob_av[k, m]/pop_erva_hat[m]
-                sum_kg = sum(age_er_hat[g, :]*age_er_hat[h, :]/pop_erva_hat)
-                beta_gh[g, h] = age_pop[g]*c_gh_3[g, h]/(sum_kg-sum_kg2)
+    def record_round(self, round_i, res, T_i, kg_pairs, start_time):
+        elapsed_time = time.time() - start_time
+        round_info = {
+            'round': round_i,
+            'objective': float(res.fun),
+            'iterations': res.nit,
+            'evaluations': res.nfev,
+            'T_i': T_i,
+            'closed_pairs': len(kg_pairs),
+            'time': elapsed_time,
+        }
+        self.telemetry.append(round_info)
+        print('Round %(round)s. Objective: %(objective)s. Iterations: %(iterations)s. '
+              'Evaluations: %(evaluations)s. T_i: %(T_i)s. Closed pairs: %(closed_pairs)s. '
+              'Time: %(time).2f s' % round_info)
+
+    def inputs_digest(self):
+        # Digest of the data the optimization starts from: the epidemic state
+        # at t0 (the warm-up of get_vac), the model parameters and the rates
+        # of EPIDEMIC
+        t0 = EXPERIMENTS['t0']
+        epidemic_npy = read_epidemic_state(warm_up_csv_path(self.N_g), t0, STATE_COLUMNS)
+        return parameters_digest(t0, epidemic_npy, self.mob_av, self.beta_gh,
+                                 self.pop_erva_hat, self.age_er, epidemic_rates(EPIDEMIC),
+                                 age_parameters(EPIDEMIC, self.N_g), EPIDEMIC['e'],
+                                 EPIDEMIC['alpha'])
+
+    def checkpoint_settings(self, method, maxiter):
+        # A checkpoint is only resumed by an optimization with the same
+        # settings and inputs
+        return json.dumps({
+            'beta': float(self.beta),
+            'tau': float(self.tau),
+            'death_optim': bool(self.death_optim),
+            'T': self.T,
+            'n_max': float(self.n_max),
+            'method': method,
+            'maxiter': list(maxiter),
+            't0': EXPERIMENTS['t0'],
+            'inputs': self.inputs_digest(),
+        })
+
+    def save_checkpoint(self, checkpoint, settings, round_i, x, iterations, bound, T_i,
+                        kg_pairs):
+        # Writing to a temporary file first so that a job killed while writing
+        # keeps the previous checkpoint
+        checkpoint_dir = os.path.dirname(os.path.abspath(checkpoint))
+        fd, tmp_file = tempfile.mkstemp(suffix='.npz', dir=checkpoint_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f,
+                     settings=settings,
+                     round=round_i,
+                     x=x,
+                     iterations=iterations,
+                     bound=bound,
+                     T_i=T_i,
+                     kg_pairs=np.array(kg_pairs, dtype=int).reshape(-1, 2),
+                     telemetry=json.dumps(self.telemetry))
+        os.replace(tmp_file, checkpoint)
+
+    def load_checkpoint(self, checkpoint, settings):
+        # State of the round in progress or None if there is no checkpoint
+        if not os.path.isfile(checkpoint):
+            return None
+        with np.load(checkpoint) as saved:
+            if str(saved['settings']) != settings:
+                raise ValueError('Checkpoint %s has different settings: %s' % (checkpoint,
+                                                                               saved['settings']))
+            return {
+                'round': int(saved['round']),
+                'x': saved['x'],
+                'iterations': int(saved['iterations']),
+                'bound': saved['bound'],
+                'T_i': int(saved['T_i']),
+                'kg_pairs': [(int(g), int(k)) for g, k in saved['kg_pairs']],
+                'telemetry': json.loads(str(saved['telemetry'])),
+            }
+
+    def run(self, filename=None, method='SLSQP', maxiter=(5, 3), checkpoint=None,
+            resume=False):
+        # method is 'SLSQP' (dense constraints) or 'trust-constr' (sparse
+        # constraints). maxiter has the iterations of the first minimization
+        # and of every refinement of the bounds. Every round of trust-constr
+        # starts from x0 instead of the previous optimum.
+        # With checkpoint, the state of the optimization is written to that
+        # file at the start of every round and, with SLSQP, after every
+        # iteration (trust-constr resumes from the start of the round).
+        # resume=True continues from it if it exists.
+        # Returns the optimized strategy (N_g, N_p, T), saved to filename if given
+        T = self.T
+        # number of optimization variables
+        N_f = self.N_o*self.N_p
+
+        # constraints
+        Af, b = vaccination_constraints(self.age_er, T, self.n_max, self.first_group, self.N_o)
+
+        print(np.shape(Af))
+        print(T*N_f)
+
+        print('first')
+
+        # bounds for minimum and maximum value for the optimization variable
+        now = datetime.now()
+        current_time = now.strftime("%H:%M:%S")
+        print("Current Time =", current_time)
+
+        x0 = np.zeros(N_f*T)
+        bound0 = np.zeros(N_f*T)
+
+        bound1 = vaccination_upper_bounds(self.age_er, T, self.n_max, self.first_group,
+                                          self.N_o)
+
+        settings = self.checkpoint_settings(method, maxiter)
+        state = None
+        if resume and checkpoint is not None:
+            state = self.load_checkpoint(checkpoint, settings)
+
+        if state is None:
+            # Objective, iterations and time of every minimization
+            self.telemetry = []
+            # Round 0 is the first minimization, the next ones refine the bounds
+            round_i = 0
+            x_start = x0
+            iterations = 0
+            bound_old = bound1
+            T_old = 0
+            old_kg_pairs = []
+        else:
+            self.telemetry = state['telemetry']
+            round_i = state['round']
+            x_start = state['x']
+            iterations = state['iterations']
+            bound_old = state['bound']
+            T_old = state['T_i']
+            old_kg_pairs = state['kg_pairs']
+            print('Resuming from %s. Round: %s. Iteration: %s' % (checkpoint, round_i, iterations))
+
+        while True:
+            round_maxiter = maxiter[0] if round_i == 0 else maxiter[1]
+            callback = None
+            if checkpoint is not None:
+                self.save_checkpoint(checkpoint, settings, round_i, x_start, iterations,
+                                     bound_old, T_old, old_kg_pairs)
+                if method == 'SLSQP':
+                    progress = {'iterations': iterations}
+
+                    def callback(xk):
+                        progress['iterations'] += 1
+                        self.save_checkpoint(checkpoint, settings, round_i, xk,
+                                             progress['iterations'], bound_old, T_old,
+                                             old_kg_pairs)
+
+            bounds = Bounds(bound0, bound_old)
+
+            start_time = time.time()
+            res = self.minimize_deaths(x_start, Af, b, bounds,
+                                       max(round_maxiter - iterations, 1), method, callback)
+            self.record_round(round_i, res, T_old, old_kg_pairs, start_time)
+
+            x_old = res.x
+            if round_i == 24:
+                break
+
+            bound_old, T_old, old_kg_pairs = self.bound_f(bound_old, T_old, x_old, old_kg_pairs)
+            if len(old_kg_pairs) >= 24:
+                break
+
+            round_i += 1
+            iterations = 0
+            # SLSQP starts from the previous optimum projected onto the new
+            # bounds. The iterates of trust-constr do not satisfy the bounds
+            # before convergence, and projecting them breaks the daily
+            # vaccination constraint, so it starts from x0
+            if method == 'SLSQP':
+                x_start = np.clip(x_old, bound0, bound_old)
             else:
-                sum_kg = age_er_hat[g, :]*age_er_hat[h, :]
-                beta_gh[g, h] = age_pop[g]*c_gh_3[g, h]/(sum(sum_kg/pop_erva_hat))
+                x_start = x0
 
-    ######################################################################################
-    N_p = num_ervas
-    Ng = number_age_groups
-    # number of optimization variables
-    N_f = (Ng-4)*N_p
-    global T
-    T = 110
-
-    # transmission parameter
-    global u
-    u = np.zeros((Ng, N_p, T))
-    time = np.arange(0, T)
-    n_max = 30000
-
-    # constraints
-    a1 = np.eye(T)*age_er[0, 2]
-    a2 = np.eye(T)*age_er[1, 2]
-    a3 = np.eye(T)*age_er[2, 2]
-    a4 = np.eye(T)*age_er[3, 2]
-    a5 = np.eye(T)*age_er[4, 2]
-
-    b1 = np.eye(T)*age_er[0, 3]
-    b2 = np.eye(T)*age_er[1, 3]
-    b3 = np.eye(T)*age_er[2, 3]
-    b4 = np.eye(T)*age_er[3, 3]
-    b5 = np.eye(T)*age_er[4, 3]
-
-    c0 = np.eye(T)*age_er[0, 4]
-    c01 = np.eye(T)*age_er[1, 4]
-    c02 = np.eye(T)*age_er[2, 4]
-    c03 = np.eye(T)*age_er[3, 4]
-    c04 = np.eye(T)*age_er[4, 4]
-
-    c1 = np.eye(T)*age_er[0, 5]
-    c2 = np.eye(T)*age_er[1, 5]
-    c3 = np.eye(T)*age_er[2, 5]
-    c4 = np.eye(T)*age_er[3, 5]
-    c5 = np.eye(T)*age_er[4, 5]
-
-    c6 = np.eye(T)*age_er[0, 6]
-    c7 = np.eye(T)*age_er[1, 6]
-    c8 = np.eye(T)*age_er[2, 6]
-    c9 = np.eye(T)*age_er[3, 6]
-    c10 = np.eye(T)*age_er[4, 6]
-
-    Af = np.concatenate((a1, a2, a3, a4, a5,
-                         b1, b2, b3, b4, b5,
-                         c0, c01, c02, c03, c04,
-                         c1, c2, c3, c4, c5, c6, c7, c8, c9, c10), axis=1)
-
-    print(np.shape(Af))
-    print(T*N_f)
+        nuf = self.full_strategy(x_old)
+        print('Total iterations: %s' % (sum(round_info['iterations'] for round_info in self.telemetry), ))
 
-    b = n_max*np.ones(T)
-    print('first')
-
-    cons = {
-            "type": "eq", "fun": lambda x:  Af @ x - b,
-            'jac': lambda x: Af
-    }
-
-    # bounds for minimum and maximum value for the optimization variable
-    bound0 = np.zeros(T*N_f)
-
-    now = datetime.now()
-    current_time = now.strftime("%H:%M:%S")
-    print("Current Time =", current_time)
-
-    x0 = np.zeros(N_f*T)
-    bound0 = np.zeros(N_f*T)
-
-    bound1 = np.zeros(T*N_f)
-    ########check this again
-    bound1[0:T] = n_max/age_er[0, 2]
-    bound1[T:2*T] = n_max/age_er[1, 2]
-    bound1[2*T:3*T] = n_max/age_er[2, 2]
-    bound1[3*T:4*T] = n_max/age_er[3, 2]
-    bound1[4*T:5*T] = n_max/age_er[4, 2]
-
-    bound1[5*T:6*T] = n_max/age_er[0, 3]
-    bound1[6*T:7*T] = n_max/age_er[1, 3]
-    bound1[7*T:8*T] = n_max/age_er[2, 3]
-    bound1[8*T:9*T] = n_max/age_er[3, 3]
-    bound1[9*T:10*T] = n_max/age_er[4, 3]
-
-    bound1[10*T:11*T] = n_max/age_er[0, 4]
-    bound1[11*T:12*T] = n_max/age_er[1, 4]
-    bound1[12*T:13*T] = n_max/age_er[2, 4]
-    bound1[13*T:14*T] = n_max/age_er[3, 4]
-    bound1[14*T:15*T] = n_max/age_er[4, 4]
-
-    bound1[15*T:16*T] = n_max/age_er[0, 5]
-    bound1[16*T:17*T] = n_max/age_er[1, 5]
-    bound1[17*T:18*T] = n_max/age_er[2, 5]
-    bound1[18*T:19*T] = n_max/age_er[3, 5]
-    bound1[19*T:20*T] = n_max/age_er[4, 5]
-
-    bound1[20*T:21*T] = n_max/age_er[0, 6]
-    bound1[21*T:22*T] = n_max/age_er[1, 6]
-    bound1[22*T:23*T] = n_max/age_er[2, 6]
-    bound1[23*T:24*T] = n_max/age_er[3, 6]
-    bound1[24*T:25*T] = n_max/age_er[4, 6]
-
-    bounds = Bounds(bound0, bound1)
-
-    res = minimize(ob_fun, x0, method='SLSQP', jac=der,
-                   constraints=[cons], options={'maxiter': 5, 'disp': True},
-                   bounds=bounds)
-
-    now = datetime.now()
-    current_time = now.strftime("%H:%M:%S")
-    print("Current Time =", current_time)
-
-    opc_o = np.reshape(res.x, (5, N_p, T))
-    nu2_o = np.zeros((2, N_p, T))
-    nu3_o = np.zeros((2, N_p, T))
-    nuf_o = np.concatenate((nu2_o, opc_o, nu3_o))
-    u_old = nuf_o
-
-    T_old = 0
-    bound_old = bound1
-
-    old_kg_pairs = []
-    for i in range(24):
-        bound_new, T_new, new_kg_pairs = bound_f(bound_old, T_old, u_old, old_kg_pairs)
-        bound_old = bound_new
-        T_old = T_new
-        old_kg_pairs = new_kg_pairs
-        if len(new_kg_pairs) >= 24:
-            nuf = u_old
-            break
-        bounds = Bounds(bound0, bound_new)
-
-        res = minimize(ob_fun, x0, method='SLSQP', jac=der,
-                       constraints=[cons], options={'maxiter': 3, 'disp': True},
-                       bounds=bounds)
-
-        opc = np.reshape(res.x, (5, N_p, T))
-        nu2 = np.zeros((2, N_p, T))
-        nu3 = np.zeros((2, N_p, T))
-        nuf = np.concatenate((nu2, opc, nu3))
-        u_old = nuf
-
-    now = datetime.now()
-
-    current_time = now.strftime("%H:%M:%S")
-    print("Current Time =", current_time)
-    np.save(filename, nuf)
-    print('File written to: %s' % (filename, ))
-
-
-def run_optimize(r, beta_sim, tau, death_optim_in):
-    filename = "R_%s_op_sol_tau%s.npy" % (r, tau, death_optim_in)
+        now = datetime.now()
+
+        current_time = now.strftime("%H:%M:%S")
+        print("Current Time =", current_time)
+        if filename is not None:
+            np.save(filename, nuf)
+            print('File written to: %s' % (filename, ))
+        if checkpoint is not None and os.path.isfile(checkpoint):
+            os.remove(checkpoint)
+
+        return nuf
+
+
+def get_rho(tau):
+    # Spectral radius of the next generation matrix, as in experiments.py
+    _, _, _, _, rho = get_model_parameters(EXPERIMENTS['num_age_groups'],
+                                           EXPERIMENTS['num_ervas'],
+                                           EXPERIMENTS['init_vacc'],
+                                           EXPERIMENTS['t0'],
+                                           tau)
+    return rho
+
+
+def get_beta(r, tau):
+    # Transmission parameter that gives the reproduction number r
+    return r/get_rho(tau)
+
+
+def checkpoint_path(filename):
+    # R_1.0_op_sol_tau0.5.npy is checkpointed to R_1.0_op_sol_tau0.5_checkpoint.npz
+    base_name, _ = os.path.splitext(filename)
+    return base_name + '_checkpoint.npz'
+
+
+def optimize(filename, beta_sim=0.03559801015581483, r=1.0, death_optim_in=False,
+             backend='python', method='SLSQP', maxiter=(5, 3), resume=False):
+    # r is the mobility (tau) of the optimization. The optimization is
+    # checkpointed next to filename and resume=True continues from there
+    optimizer = VaccinationOptimizer(beta_sim, r, death_optim=death_optim_in,
+                                     backend=backend)
+    return optimizer.run(filename, method=method, maxiter=maxiter,
+                         checkpoint=checkpoint_path(filename), resume=resume)
+
+
+def run_optimize(r, beta_sim, tau, death_optim_in, optimize_kwargs=None):
+    # beta_sim=None computes beta from r and tau. Returns the metadata of the
+    # strategy for the strategy library
+    filename = "R_%s_op_sol_tau%s.npy" % (r, tau)
     try:
         start_time = time.time()
         proc_number = os.getpid()
+        if beta_sim is None:
+            beta_sim = get_beta(r, tau)
         print('Starting (%s). R: %s. Tau: %s. Death optim: %s' % (proc_number, r,
                                                                   tau, death_optim_in))
 
         dir_path = os.path.dirname(os.path.realpath(__file__))
         file_path = os.path.join(dir_path, 'out', filename)
-        optimize(beta_sim=beta_sim, r=tau, filename=file_path,
-                 death_optim_in=death_optim_in)
+        run_kwargs = dict(optimize_kwargs or {})
+        backend = run_kwargs.pop('backend', 'python')
+        optimizer = VaccinationOptimizer(beta_sim, tau, death_optim=death_optim_in,
+                                         backend=backend)
+        optimizer.run(file_path, checkpoint=checkpoint_path(file_path), **run_kwargs)
 
         elapsed_time = time.time() - start_time
         elapsed_delta = dt.timedelta(seconds=elapsed_time)
@@ -771,7 +1030,14 @@ def run_optimize(r, beta_sim, tau, death_optim_in):
                                                                             tau,
                                                                             death_optim_in,
                                                                             elapsed_delta))
-        return filename
+        return {
+            'file': filename,
+            'r': r,
+            'tau': tau,
+            'beta': float(beta_sim),
+            'death_optim': death_optim_in,
+            'objective': optimizer.telemetry[-1]['objective'],
+        }
     except Exception:
         logger = logging.getLogger()
         numeric_log_level = getattr(logging, "DEBUG", None)
@@ -786,41 +1052,66 @@ def run_optimize(r, beta_sim, tau, death_optim_in):
         return None
 
 
-def run_parallel_optimizations():
-    all_experiments = [
-        (0.75,  0.,  0.016577192790495632, False),
-        (0.75,  0.5,  0.017420081058752156, False),
-        (0.75,  1.0,  0.017799005077907416, False),
-        (1.0,  0.,  0.022102923720660844, False),
-        (1.0,  0.5,  0.023226774745002877, False),
-        (1.0,  1.0,  0.023732006770543223, False),
-        (1.25,  0.,  0.027628654650826055, False),
-        (1.25,  0.5,  0.029033468431253595, False),
-        (1.25,  1.0,  0.02966500846317903, False),
-        (1.5,  0.,  0.033154385580991264, False),
-        (1.5,  0.5,  0.03484016211750431, False),
-        (1.5,  1.0,  0.03559801015581483, False),
-    ]
-    num_cpus = os.cpu_count()
+def run_parallel_optimizations(r_effs=EXPERIMENTS['r_effs'], taus=EXPERIMENTS['taus'],
+                               death_optim_in=False, use_threads=False, num_workers=None,
+                               optimize_kwargs=None):
+    # Optimizes every pair of r and tau, with the same file names that
+    # experiments.py reads. beta is computed from the spectral radius before
+    # starting the workers, so the model parameters are computed (and cached)
+    # once. With use_threads the optimizations share the
+    # process, and the mobility parameters and warm-up states are reused
+    # between them. Only the numba kernels run in parallel in threads (the
+    # python backend holds the GIL), so it is the default backend of
+    # use_threads when numba is installed. The resulting strategies are
+    # added to the strategy library
+    optimize_kwargs = dict(optimize_kwargs or {})
+    if use_threads and 'backend' not in optimize_kwargs:
+        if NUMBA_AVAILABLE:
+            optimize_kwargs['backend'] = 'numba'
+        else:
+            print('numba is not installed: the threads run one at a time')
+    rhos = {tau: get_rho(tau) for tau in taus}
+    all_experiments = []
+    for r in r_effs:
+        for tau in taus:
+            all_experiments.append((r, tau, r/rhos[tau], death_optim_in))
+
+    num_cpus = os.cpu_count() if num_workers is None else num_workers
     start_time = time.time()
     num_experiments = len(all_experiments)
     result_filenames = []
     print('Running %s experiments with %s CPUS.' % (num_experiments, num_cpus))
-    with Pool(processes=num_cpus) as pool:
+    pool_class = ThreadPool if use_threads else Pool
+    with pool_class(processes=num_cpus) as pool:
         # Calling the function to execute forward simulation in asynchronous way
         async_res = [pool.apply_async(func=run_optimize,
-                                      args=(r, beta_sim, tau, death_optim_in))
+                                      args=(r, beta_sim, tau, death_optim_in,
+                                            optimize_kwargs))
                      for r, tau, beta_sim, death_optim_in in all_experiments]
 
         # Waiting for the values of the async execution
-        for res in async_res:
-            filename = res.get()
-            result_filenames.append(filename)
+        results = [res.get() for res in async_res]
     elapsed_time = time.time() - start_time
     elapsed_delta = dt.timedelta(seconds=elapsed_time)
     print('Finished experiments. Elapsed: %s' % (elapsed_delta, ))
+
+    strategies = []
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    for metadata in results:
+        if metadata is None:
+            result_filenames.append(None)
+            continue
+        result_filenames.append(metadata['file'])
+        metadata['rho'] = float(rhos[metadata['tau']])
+        metadata['t0'] = EXPERIMENTS['t0']
+        u_op = np.load(os.path.join(dir_path, 'out', metadata['file']))
+        strategies.append((metadata, u_op))
     print('Resulting filenames: %s' % (result_filenames, ))
 
+    if len(strategies) > 0:
+        update_strategy_library(strategies)
+        print('Strategy library written to: %s' % (STRATEGY_LIBRARY, ))
+
 
 if __name__ == "__main__":
     run_parallel_optimizations()
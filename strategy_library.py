@@ -0,0 +1,145 @@
+import numpy as np
+import json
+import os
+import struct
+import tempfile
+import zipfile
+
+
+# Library with the optimized strategies of all the R and tau values
+# (see write_strategy_library)
+STRATEGY_LIBRARY = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'out', 'optimal_strategies.npz')
+
+
+def strategy_key(metadata):
+    return (float(metadata['r']), float(metadata['tau']), bool(metadata['death_optim']))
+
+
+def write_strategy_library(strategies, library_name=STRATEGY_LIBRARY, dtype=np.float64):
+    # strategies is a list of (metadata, u) with u of shape (N_g, N_p, T) and
+    # metadata a dictionary with at least r, tau and death_optim (and
+    # beta, rho, t0, objective, ...). Only the age groups vaccinated in some
+    # strategy (2 to 6 for the optimizer) are stored, as an array of shape
+    # (strategies, age groups, N_p, T) so that every strategy is a
+    # contiguous block. Strategies with fewer timesteps than the longest one
+    # (T=110 of the optimizer and T=115 of older files) are padded with
+    # zeros, as forward_integration does, and their own T is kept in the
+    # index
+    num_age_groups, num_ervas, _ = strategies[0][1].shape
+    vaccinated = np.zeros(num_age_groups, dtype=bool)
+    for metadata, u in strategies:
+        if u.ndim != 3 or u.shape[:2] != (num_age_groups, num_ervas):
+            raise ValueError('Strategy r=%s tau=%s has shape %s, expected (%s, %s, T)'
+                             % (metadata['r'], metadata['tau'], u.shape, num_age_groups,
+                                num_ervas))
+        vaccinated |= np.any(u != 0, axis=(1, 2))
+    age_groups = np.flatnonzero(vaccinated)
+    lengths = [u.shape[2] for _, u in strategies]
+    T = max(lengths)
+
+    values = np.zeros((len(strategies), len(age_groups), num_ervas, T), dtype=dtype)
+    for s, (metadata, u) in enumerate(strategies):
+        values[s, :, :, :lengths[s]] = u[age_groups]
+
+    index = {
+        'num_age_groups': num_age_groups,
+        'age_groups': age_groups.tolist(),
+        'dtype': np.dtype(dtype).name,
+        'lengths': lengths,
+        'strategies': [metadata for metadata, _ in strategies],
+    }
+
+    # The values and the index are members (values.npy and index.npy) of a
+    # single uncompressed archive, written to a temporary file first so that
+    # readers never see a partial library or values that do not match the
+    # index
+    library_dir = os.path.dirname(os.path.abspath(library_name))
+    os.makedirs(library_dir, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(suffix='.npz', dir=library_dir)
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, values=values, index=np.array(json.dumps(index)))
+    os.replace(tmp_name, library_name)
+
+
+def member_offset(library_name, info):
+    # Position in the archive of the data of a stored (uncompressed) member:
+    # after its local header (30 bytes), file name and extra field
+    with open(library_name, 'rb') as f:
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+    name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def read_strategy_library(library_name=STRATEGY_LIBRARY):
+    # Values (memory-mapped from the archive) and index of the library or
+    # None if it does not exist. No strategy is read until it is used
+    if not os.path.isfile(library_name):
+        return None
+    with zipfile.ZipFile(library_name) as archive:
+        with archive.open('index.npy') as f:
+            index = json.loads(str(np.lib.format.read_array(f)))
+        info = archive.getinfo('values.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError('Compressed values in %s' % (library_name, ))
+
+    with open(library_name, 'rb') as f:
+        f.seek(member_offset(library_name, info))
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    values = np.memmap(library_name, dtype=dtype, mode='r', shape=shape, offset=offset,
+                       order='F' if fortran_order else 'C')
+
+    expected = (len(index['strategies']), len(index['age_groups']))
+    if shape[:2] != expected or max(index['lengths'], default=0) > shape[3]:
+        raise ValueError('Values of %s with shape %s do not match its index' % (library_name,
+                                                                                shape))
+    return values, index
+
+
+def update_strategy_library(strategies, library_name=STRATEGY_LIBRARY, dtype=None):
+    # Adds the strategies to the library, replacing the ones with the same
+    # r, tau and death_optim. By default the library keeps its dtype
+    # (float64 for a new library)
+    new_keys = set(strategy_key(metadata) for metadata, _ in strategies)
+    library = read_strategy_library(library_name)
+    kept = []
+    if library is not None:
+        _, index = library
+        if dtype is None:
+            dtype = index['dtype']
+        for s, metadata in enumerate(index['strategies']):
+            if strategy_key(metadata) not in new_keys:
+                kept.append((metadata, library_strategy(library, s)))
+    if dtype is None:
+        dtype = np.float64
+
+    write_strategy_library(kept + list(strategies), library_name=library_name, dtype=dtype)
+
+
+def library_strategy(library, s):
+    # Strategy s of the library with all the age groups, shape (N_g, N_p, T)
+    # with its own T
+    values, index = library
+    _, _, num_ervas, _ = values.shape
+    T = index['lengths'][s]
+    u = np.zeros((index['num_age_groups'], num_ervas, T))
+    u[index['age_groups']] = values[s, :, :, :T]
+    return u
+
+
+def find_strategy(library, r, tau, death_optim=False):
+    # Position of the strategy of r and tau in the library or None
+    if library is None:
+        return None
+    _, index = library
+    key = (float(r), float(tau), bool(death_optim))
+    for s, metadata in enumerate(index['strategies']):
+        if strategy_key(metadata) == key:
+            return s
+    return None
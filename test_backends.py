@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import optimized_vaccination
+from env_var import EPIDEMIC
+from forward_integration import forward_integration
+from numba_kernels import NUMBA_AVAILABLE
+from optimized_vaccination import back_int, sol
+from test_forward_integration import N_G, N_P, synthetic_inputs
+
+
+T = 20
+NUMBA = pytest.param('numba', marks=pytest.mark.skipif(not NUMBA_AVAILABLE,
+                                                        reason='numba is not installed'))
+
+
+def assert_outputs_close(outputs, reference, rtol=1e-10):
+    for output, expected in zip(outputs, reference):
+        np.testing.assert_allclose(output, expected, rtol=rtol, atol=1e-15)
+
+
+def synthetic_warm_up(seed=0, num_ervas=N_P):
+    # Initial values of sol in the order returned by get_vac
+    rng = np.random.default_rng(seed)
+    shape = (N_G, num_ervas)
+    s0 = rng.uniform(0.6, 0.9, size=shape)
+    svg0, sxg0, vg0 = [rng.uniform(0., 0.05, size=shape) for _ in range(3)]
+    eg0, ig0, q0, q1, hw0, hc0, hr0 = [rng.uniform(0., 1e-3, size=shape) for _ in range(7)]
+    rg0 = rng.uniform(0., 0.05, size=shape)
+    dg0 = np.zeros(shape)
+    return s0, svg0, sxg0, vg0, eg0, ig0, q0, q1, hw0, hc0, hr0, rg0, dg0, 0.
+
+
+@pytest.fixture
+def warm_up(monkeypatch):
+    # sol starts from the warm-up state of get_vac, read from the epidemic
+    # state files. Synthetic values keep the test independent of the data
+    monkeypatch.setattr(optimized_vaccination, 'get_vac',
+                        lambda *args: synthetic_warm_up())
+
+
+@pytest.mark.parametrize('backend', ['python', NUMBA])
+@pytest.mark.parametrize('precomputed', [False, True])
+def test_forward_integration_backends(backend, precomputed):
+    age_er, c1, pop_hat, c_gh, epidemic_npy, u_op = synthetic_inputs(num_ervas=N_P)
+    u_op = u_op[:, :, :T] if precomputed else None
+    args = (1e3, c1, 0.03, c_gh, T, pop_hat, age_er, None, [0.5, 0.5, 0.],
+            EPIDEMIC['e'], epidemic_npy, True)
+
+    reference = forward_integration(*args, backend='numpy', u_op=u_op)
+    outputs = forward_integration(*args, backend=backend, u_op=u_op)
+    assert_outputs_close(outputs, reference)
+
+
+@pytest.mark.parametrize('death_optim', [False, True])
+def test_sol_numba_matches_python(warm_up, death_optim):
+    if not NUMBA_AVAILABLE:
+        pytest.skip('numba is not installed')
+    age_er, c1, pop_hat, c_gh, _, _ = synthetic_inputs()
+    u_con = np.random.default_rng(3).uniform(0., 2e-3, size=(N_G, N_P, T))
+
+    reference = sol(u_con, c1, 0.03, c_gh, T, pop_hat, age_er, backend='python',
+                    death_optim=death_optim)
+    outputs = sol(u_con, c1, 0.03, c_gh, T, pop_hat, age_er, backend='numba',
+                  death_optim=death_optim)
+    assert_outputs_close(outputs, reference)
+
+
+@pytest.mark.parametrize('backend', ['numpy', NUMBA])
+@pytest.mark.parametrize('death_optim', [False, True])
+def test_back_int_backends(warm_up, backend, death_optim):
+    age_er, c1, pop_hat, c_gh, _, _ = synthetic_inputs()
+    u_con = np.random.default_rng(3).uniform(0., 2e-3, size=(N_G, N_P, T))
+    S_g, S_vg, S_xg, L_g = sol(u_con, c1, 0.03, c_gh, T, pop_hat, age_er,
+                               death_optim=death_optim)[:4]
+    args = (S_g, S_vg, S_xg, L_g, np.zeros(T), c_gh, 0.03, T, age_er, c1, pop_hat, 2)
+
+    reference = back_int(*args, backend='python', death_optim=death_optim)
+    dH = back_int(*args, backend=backend, death_optim=death_optim)
+    np.testing.assert_allclose(dH, reference, rtol=1e-10, atol=1e-15)
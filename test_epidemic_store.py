@@ -0,0 +1,129 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from env_var import EPIDEMIC
+from epidemic_store import (
+    STATE_COLUMNS, append_epidemic_state, cases_state_path, read_cases_state,
+    read_epidemic_state, read_store_index, replace_last_rows, store_paths,
+    write_epidemic_state
+)
+
+
+ERVAS = EPIDEMIC['ervas_order'] + ['Åland']
+AGES = ['age_%d' % (g, ) for g in range(9)]
+DATES = pd.date_range('2021-03-01', periods=12).strftime('%Y-%m-%d').tolist()
+
+
+def synthetic_state(dates, seed=0):
+    # Epidemic state with the layout of initial_states.py, rows by date, erva
+    # and age, and its daily detected cases
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product([dates, ERVAS, AGES], names=['date', 'erva', 'age'])
+    epidemic_state = pd.DataFrame(rng.uniform(0., 1e4, size=(len(index), len(STATE_COLUMNS))),
+                                  index=index, columns=STATE_COLUMNS).reset_index()
+    cases = rng.uniform(0., 50., size=(len(dates), len(ERVAS), len(AGES)))
+    return epidemic_state, (ERVAS, AGES, cases)
+
+
+def store_files(csv_name):
+    npy_name, json_name = store_paths(csv_name)
+    return [csv_name, npy_name, cases_state_path(csv_name)]
+
+
+def assert_same_store(csv_name, expected_name):
+    # Same CSV, arrays and index (but the CSV signature) as expected_name
+    for name, expected in zip(store_files(csv_name), store_files(expected_name)):
+        with open(name, 'rb') as f, open(expected, 'rb') as f_expected:
+            assert f.read() == f_expected.read(), name
+    index = read_store_index(csv_name)
+    expected_index = read_store_index(expected_name)
+    assert index is not None and expected_index is not None
+    index.pop('csv_signature')
+    expected_index.pop('csv_signature')
+    assert index == expected_index
+
+
+@pytest.mark.parametrize('start_i', [0, 5, len(DATES) - 1, len(DATES)])
+def test_append_replaces_last_dates(tmp_path, start_i):
+    csv_name = str(tmp_path / 'epidemic_finland_9.csv')
+    state, (_, _, cases) = synthetic_state(DATES, seed=0)
+    write_epidemic_state(state, csv_name, (ERVAS, AGES, cases))
+    inodes = [os.stat(name).st_ino for name in store_files(csv_name)[1:]]
+
+    # Dates from start_i, revised and two new ones
+    new_dates = pd.date_range(DATES[start_i] if start_i < len(DATES) else '2021-03-13',
+                              periods=len(DATES) - start_i + 2).strftime('%Y-%m-%d').tolist()
+    new_state, (_, _, new_cases) = synthetic_state(new_dates, seed=1)
+    append_epidemic_state(new_state, csv_name, (ERVAS, AGES, new_cases), new_dates[0])
+
+    expected_name = str(tmp_path / 'expected.csv')
+    kept = state['date'].isin(DATES[:start_i])
+    write_epidemic_state(pd.concat([state[kept], new_state], ignore_index=True), expected_name,
+                         (ERVAS, AGES, np.concatenate((cases[:start_i], new_cases))))
+    assert_same_store(csv_name, expected_name)
+    # The arrays were extended in place
+    assert [os.stat(name).st_ino for name in store_files(csv_name)[1:]] == inodes
+
+    # The CSV was cut at the stored offset of the first new date
+    index = read_store_index(csv_name)
+    with open(csv_name, 'rb') as f:
+        f.seek(index['csv_offsets'][start_i])
+        assert f.readline().decode('utf-8').startswith(new_dates[0] + ',')
+    assert read_cases_state(csv_name)['dates'] == DATES[:start_i] + new_dates
+    last_day = new_state[(new_state['date'] == new_dates[-1])
+                         & new_state['erva'].isin(EPIDEMIC['ervas_order'])]
+    np.testing.assert_array_equal(read_epidemic_state(csv_name, new_dates[-1]),
+                                  last_day[STATE_COLUMNS].values.reshape(5, 9, -1))
+
+
+def test_append_refuses_other_dates(tmp_path):
+    csv_name = str(tmp_path / 'epidemic_finland_9.csv')
+    state, cases = synthetic_state(DATES)
+    write_epidemic_state(state, csv_name, cases)
+
+    # A state that does not start on start_date
+    new_state, new_cases = synthetic_state(DATES[6:], seed=1)
+    with pytest.raises(ValueError):
+        append_epidemic_state(new_state, csv_name, new_cases, DATES[5])
+    # A gap after the last stored date
+    new_state, new_cases = synthetic_state(['2021-03-14', '2021-03-15'], seed=1)
+    with pytest.raises(ValueError):
+        append_epidemic_state(new_state, csv_name, new_cases, '2021-03-14')
+
+    expected_name = str(tmp_path / 'expected.csv')
+    write_epidemic_state(state, expected_name, cases)
+    assert_same_store(csv_name, expected_name)
+
+
+def test_replace_last_rows_in_place(tmp_path):
+    array_name = str(tmp_path / 'values.npy')
+    values = np.arange(9*4, dtype=np.float64).reshape(9, 4)
+    np.save(array_name, values)
+    inode = os.stat(array_name).st_ino
+
+    # The length grows from 9 to 10 rows, with the header of np.save
+    new_rows = -np.arange(3*4, dtype=np.float64).reshape(3, 4)
+    replace_last_rows(array_name, 7, new_rows)
+    assert os.stat(array_name).st_ino == inode
+    expected_name = str(tmp_path / 'expected.npy')
+    np.save(expected_name, np.concatenate((values[:7], new_rows)))
+    with open(array_name, 'rb') as f, open(expected_name, 'rb') as f_expected:
+        assert f.read() == f_expected.read()
+
+    # Shorter
+    replace_last_rows(array_name, 2, new_rows[:1])
+    np.testing.assert_array_equal(np.load(array_name), np.concatenate((values[:2], new_rows[:1])))
+
+
+def test_replace_last_rows_rewritten(tmp_path):
+    # Fortran order arrays can not grow in place, the array is written again
+    array_name = str(tmp_path / 'values.npy')
+    values = np.asfortranarray(np.arange(9*4, dtype=np.float64).reshape(9, 4))
+    np.save(array_name, values)
+    inode = os.stat(array_name).st_ino
+
+    new_rows = -np.arange(3*4, dtype=np.float64).reshape(3, 4)
+    replace_last_rows(array_name, 8, new_rows)
+    assert os.stat(array_name).st_ino != inode
+    np.testing.assert_array_equal(np.load(array_name), np.concatenate((values[:8], new_rows)))
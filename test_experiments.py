@@ -0,0 +1,66 @@
+import numpy as np
+from env_var import EPIDEMIC
+from experiments import RESULTS_OBSERVABLES, execute_batched_forward
+from forward_integration import forward_integration
+from test_forward_integration import T, synthetic_inputs
+
+
+def synthetic_experiments():
+    # Two taus (different mobility) with a policy and an optimized strategy
+    age_er, _, _, _, epidemic_npy, u_op = synthetic_inputs()
+    experiments = {}
+    for seed, r in enumerate([1.0, 1.5]):
+        experiments[r] = {}
+        _, c1, pop_hat, c_gh, _, _ = synthetic_inputs(seed)
+        experiments[r][0.5] = {}
+        for ws, label in [([1/3, 1/3, 1/3], 'mixed'), ([0., 1., 0.], 'infected'),
+                          (None, 'optimized')]:
+            parameters = {
+                'u_con': 2e3,
+                'c1': c1,
+                'beta': 0.02*r,
+                'c_gh': c_gh,
+                'T': T,
+                'pop_hat': pop_hat,
+                'age_er': age_er,
+                't0': None,
+                'ws_vacc': ws,
+                'e': EPIDEMIC['e'],
+                'init_vacc': True,
+                'epidemic_npy': epidemic_npy,
+                'u_op_file': None,
+                'u_op': None if ws is not None else u_op,
+            }
+            experiments[r][0.5][label] = {'parameters': parameters}
+    return experiments
+
+
+def unbatched_results(params):
+    # Results of execute_parallel_forward, one forward_integration per scenario
+    params = dict(params)
+    age_er_prop = params['age_er'].T[:, :, np.newaxis]
+    _, _, H_wg, H_cg, H_rg, I_g, D_g, u_g, hosp_i, infs_i = forward_integration(**params)
+    deaths_incidence = D_g.copy()
+    deaths_incidence[:, :, 1:] -= D_g[:, :, :-1]
+    return {
+        'total hospitalizations': (H_wg + H_cg + H_rg)*age_er_prop,
+        'infectious people': I_g*age_er_prop,
+        'incidence': infs_i*age_er_prop,
+        'mortality': deaths_incidence*age_er_prop,
+        'vaccinations': u_g*age_er_prop,
+        'vaccinations_raw': u_g,
+        'new hospitalizations': hosp_i*age_er_prop,
+    }
+
+
+def test_batched_matches_unbatched():
+    experiments = synthetic_experiments()
+    execute_batched_forward(experiments)
+
+    for r_level in experiments.values():
+        for tau_level in r_level.values():
+            for label_level in tau_level.values():
+                expected = unbatched_results(label_level['parameters'])
+                for name in RESULTS_OBSERVABLES:
+                    np.testing.assert_allclose(label_level['results'][name], expected[name],
+                                               rtol=1e-10, atol=1e-10, err_msg=name)
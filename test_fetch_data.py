@@ -0,0 +1,402 @@
+import datetime
+import json
+import logging
+from io import StringIO
+import numpy as np
+import pandas as pd
+import pytest
+import http_cache
+from env_var import EPIDEMIC, HTTP_CACHE, MAPPINGS, REQUESTS
+from fetch_data import (
+    construct_cases_age_erva_array, construct_cases_age_erva_daily,
+    construct_finland_age_cases_daily, construct_hs_hosp_age_erva,
+    construct_thl_vaccines_erva_daily, erva_age_categoricals,
+    fetch_finland_cases_age_weekly, transform_thl_week_datetime
+)
+
+
+LOGGER = logging.getLogger(__name__)
+HEADERS = {'User-Agent': 'Me'}
+# THL weeks of the recorded responses. The vaccinations start on week 53
+# of 2020, as in REQUESTS['vaccination']
+WEEKS = ['Year 2020 Week %02d' % (week, ) for week in range(50, 54)]
+WEEKS += ['Year 2021 Week %02d' % (week, ) for week in range(1, 6)]
+FIRST_VACCINATION_WEEK = 'Year 2020 Week 53'
+HCDS = [hcd for hcd, erva in MAPPINGS['hcd_erva'].items() if erva not in ('All', 'Other')]
+HS_ERVAS = ['HYKS', 'KYS', 'OYS', 'TAYS', 'TYKS']
+
+
+class RecordedResponse:
+    # Response of the API as stored by http_cache.store_response
+    def __init__(self, text):
+        self.content = text.encode('utf-8')
+        self.headers = {}
+        self.apparent_encoding = 'utf-8'
+
+
+def week_dates(weeks):
+    # Dates (datetime) of the days of the THL weeks
+    return [transform_thl_week_datetime(week) + datetime.timedelta(days=day)
+            for week in weeks for day in range(7)]
+
+
+def vaccination_csv(weeks, rng):
+    # Weekly doses by hospital district and age, with missing values
+    lines = ['Time;Area;Age;Vaccination dose;val']
+    weeks = [week for week in weeks if week >= FIRST_VACCINATION_WEEK] + ['All times']
+    for week in weeks:
+        for area in HCDS + ['All areas']:
+            for age in MAPPINGS['age_groups'][9]['vaccines']:
+                for dose in ['First dose', 'Second dose', 'All doses']:
+                    val = rng.integers(0, 400)
+                    lines.append('%s;%s;%s;%s;%s' % (week, area, age, dose,
+                                                     val if val % 17 else ''))
+    return '\n'.join(lines)
+
+
+def cases_age_csv(weeks, rng):
+    # Weekly cases by age, with hidden values ('..'), totals different from
+    # the sum of the age groups and a week without cases
+    lines = ['Time;Age;Measure;val']
+    ages = list(MAPPINGS['age_groups'][9]['cases'])
+    for week in weeks:
+        values = rng.integers(0, 300, size=len(ages) - 1)
+        total = values.sum() + rng.integers(-20, 30)
+        if week == WEEKS[1]:
+            values[:] = total = 0
+        for age, val in zip(ages, list(values) + [total]):
+            hidden = val % 23 == 0 and age != 'All ages'
+            lines.append('%s;%s;Number of cases;%s' % (week, age, '..' if hidden else val))
+    lines.append('All times;All ages;Number of cases;99999')
+    return '\n'.join(lines)
+
+
+def cases_day_csv(weeks, rng):
+    # Daily cases by hospital district, with weekly and total counts. The
+    # last days of the weeks are not reported yet
+    lines = ['Area;Time;Measure;val']
+    dates = [date.strftime('%Y-%m-%d') for date in week_dates(weeks)[:-3]]
+    for area in HCDS + ['All areas']:
+        values = rng.integers(0, 40, size=7*len(WEEKS))
+        for date, val in zip(dates, values):
+            lines.append('%s;%s;Number of cases;%d' % (area, date, val))
+        lines.append('%s;Week 2021-01;Number of cases;5' % (area, ))
+        lines.append('%s;All times;Number of cases;999' % (area, ))
+    return '\n'.join(lines)
+
+
+def hospitalizations_json(weeks, rng):
+    # Hospitalizations of the weekdays by erva. KYS misses the first Friday
+    hospitalised = []
+    for date in week_dates(weeks):
+        if date.weekday() >= 5:
+            continue
+        for area in HS_ERVAS + ['Finland']:
+            if area == 'KYS' and date == week_dates(weeks)[4]:
+                continue
+            ward, icu, dead = rng.integers(0, 80), rng.integers(0, 20), rng.integers(0, 5)
+            hospitalised.append({'date': date.strftime('%Y-%m-%dT00:00:00.000Z'), 'area': area,
+                                 'totalHospitalised': int(ward + icu), 'inWard': int(ward),
+                                 'inIcu': int(icu), 'dead': int(dead)})
+    return json.dumps({'hospitalised': hospitalised})
+
+
+def api_payloads(num_weeks=len(WEEKS), seed=0):
+    # Responses of the APIs with the first num_weeks of WEEKS. The values of
+    # a week are the same for any num_weeks
+    return {
+        source: payload(WEEKS[:num_weeks], np.random.default_rng(seed))
+        for source, payload in [('vaccination', vaccination_csv), ('cases_by_age', cases_age_csv),
+                                ('cases_by_day', cases_day_csv),
+                                ('hospitalizations', hospitalizations_json)]
+    }
+
+
+def record_api(num_weeks=len(WEEKS), seed=0):
+    # Stores the responses in the cache, replayed in offline mode
+    for source, payload in api_payloads(num_weeks, seed).items():
+        http_cache.store_response(REQUESTS[source], RecordedResponse(payload))
+
+
+@pytest.fixture
+def recorded_api(tmp_path, monkeypatch):
+    monkeypatch.setitem(HTTP_CACHE, 'directory', str(tmp_path / 'http_cache'))
+    monkeypatch.setitem(HTTP_CACHE, 'mode', 'offline')
+    record_api()
+
+
+def api_text(source):
+    response = http_cache.cached_get(LOGGER, REQUESTS[source], headers=HEADERS)
+    response.encoding = response.apparent_encoding
+    return response.text
+
+
+# Original implementations, with requests.get replaced by the cache
+
+def reference_vaccines_weekly(number_age_groups=9):
+    vaccinated_df = pd.read_csv(StringIO(api_text('vaccination')), sep=";")
+    vaccinated_df = vaccinated_df.fillna(0)
+    hcd_erva_mapping = MAPPINGS['hcd_erva']
+    vaccinated_df['erva'] = vaccinated_df.apply(lambda row: hcd_erva_mapping[row['Area']], axis=1)
+    age_group_mapping = MAPPINGS['age_groups'][number_age_groups]['vaccines']
+    vaccinated_df['age group'] = vaccinated_df.apply(lambda row: age_group_mapping[row['Age']], axis=1)
+    columns_agg_erva = ['age group', 'Vaccination dose', 'Time', 'erva']
+    vaccinated_erva = vaccinated_df.groupby(by=columns_agg_erva, as_index=False).sum()
+    vaccinated_erva = vaccinated_erva[['erva', 'Time', 'age group', 'Vaccination dose', 'val']]
+    vaccinated_erva = vaccinated_erva.sort_values(by=['erva', 'Time', 'age group', 'Vaccination dose'])
+    vaccinated_erva = vaccinated_erva[~vaccinated_erva['Time'].str.contains('All')]
+    vaccinated_erva = vaccinated_erva[~vaccinated_erva['erva'].str.contains('All')]
+    vaccinated_erva = vaccinated_erva[~vaccinated_erva['age group'].str.contains('All')]
+    vaccinated_erva = vaccinated_erva[~vaccinated_erva['Vaccination dose'].str.contains('All')]
+    return vaccinated_erva
+
+
+def reference_vaccines_daily(number_age_groups=9):
+    vaccinated_weekly = reference_vaccines_weekly(number_age_groups=number_age_groups)
+    vaccinated_list = vaccinated_weekly.values
+    dates = np.unique(vaccinated_list[:, 1])
+    ervas = np.unique(vaccinated_list[:, 0])
+    age_groups = pd.unique(vaccinated_weekly['age group'])
+
+    final_lines = ['date;erva;age;First dose;Second dose']
+    for date in dates:
+        for erva in ervas:
+            vacc_week = vaccinated_list[np.where(
+                            (vaccinated_list[:, 1] == date) & (vaccinated_list[:, 0] == erva)
+                        )]
+            vacc_day_vals = np.copy(vacc_week)[:, 4]/7
+            monday_of_week = transform_thl_week_datetime(date)
+            for day in range(7):
+                date_str = (monday_of_week + datetime.timedelta(days=day)).strftime('%Y-%m-%d')
+                line_counter = 0
+                for age_g in age_groups:
+                    final_lines.append(';'.join([date_str, erva, age_g,
+                                                 str(vacc_day_vals[line_counter]),
+                                                 str(vacc_day_vals[line_counter+1])]))
+                    line_counter += 2
+    return pd.read_csv(StringIO('\n'.join(final_lines)), sep=";")
+
+
+def reference_hospitalizations():
+    hospital_df = pd.DataFrame(json.loads(api_text('hospitalizations'))['hospitalised'])
+    hospital_df = hospital_df[~hospital_df['area'].str.contains('Finland')]
+    hospital_df.columns = ['date', 'erva', 'hospitalized', 'ward', 'icu', 'dead']
+    hospital_df['date'] = hospital_df.apply(lambda row: row['date'].split('T')[0], axis=1)
+    return hospital_df.sort_values(['date', 'erva'])
+
+
+def reference_hosp_age_erva(number_age_groups=9):
+    hosp_by_erva = reference_hospitalizations()
+    age_groups = MAPPINGS['age_groups'][number_age_groups]['names']
+    probs_age_icu = EPIDEMIC['proportion_icu_age'][number_age_groups]
+    probs_age_ward = EPIDEMIC['proportion_ward_age'][number_age_groups]
+    probs_age_death = EPIDEMIC['proportion_deaths_age'][number_age_groups]
+
+    hosp_by_erva_list = hosp_by_erva.values
+    dates = np.unique(hosp_by_erva_list[:, 0])
+    curr_date = datetime.datetime.strptime(dates[0], "%Y-%m-%d")
+    last_date = datetime.datetime.strptime(dates[-1], "%Y-%m-%d")
+    ervas = np.unique(hosp_by_erva_list[:, 1])
+
+    final_lines = ['date;erva;age;ward;icu;death']
+    while curr_date <= last_date:
+        day_of_week = curr_date.weekday()
+        for erva in ervas:
+            if day_of_week == 5:
+                use_date = (curr_date - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+            elif day_of_week == 6:
+                use_date = (curr_date + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+            else:
+                use_date = curr_date.strftime("%Y-%m-%d")
+            values_day_erva = hosp_by_erva_list[np.where((
+                                hosp_by_erva_list[:, 0] == use_date) & (hosp_by_erva_list[:, 1] == erva)
+                              )]
+            ward_day_erva = 0 if len(values_day_erva[:, 3]) == 0 else values_day_erva[:, 3].item()
+            icu_day_erva = 0 if len(values_day_erva[:, 4]) == 0 else values_day_erva[:, 4].item()
+            death_day_erva = 0 if len(values_day_erva[:, 5]) == 0 else values_day_erva[:, 5].item()
+            ward_age_day_erva = ward_day_erva*probs_age_ward
+            icu_age_day_erva = icu_day_erva*probs_age_icu
+            death_age_day_erva = death_day_erva*probs_age_death
+            for i, group in enumerate(age_groups):
+                final_lines.append(';'.join([curr_date.strftime("%Y-%m-%d"), erva, group,
+                                             str(ward_age_day_erva[i]), str(icu_age_day_erva[i]),
+                                             str(death_age_day_erva[i])]))
+        curr_date = curr_date + datetime.timedelta(days=1)
+    return pd.read_csv(StringIO('\n'.join(final_lines)), sep=";")
+
+
+def reference_age_cases_daily(number_age_groups=9):
+    cases, cases_prop = reference_cases_age_weekly(number_age_groups=number_age_groups)
+    cases_list = cases.values
+    cases_prop_list = cases_prop.values
+    dates = np.unique(cases_list[:, 0])
+
+    age_groups = MAPPINGS['age_groups'][number_age_groups]['names']
+    header = ';'.join(['Time'] + list(age_groups))
+    final_lines_day = [header, ]
+    final_lines_prop = [header, ]
+    for date in dates:
+        cases_daily_vals = np.copy(cases_list[np.where(cases_list[:, 0] == date)])[:, 2]/7
+        cases_week_prop = cases_prop_list[np.where(cases_prop_list[:, 0] == date)]
+        monday_of_week = transform_thl_week_datetime(date)
+        for day in range(7):
+            date_str = (monday_of_week + datetime.timedelta(days=day)).strftime('%Y-%m-%d')
+            line_day = [date_str, ]
+            line_prop = [date_str, ]
+            for i, age_i in enumerate(age_groups):
+                line_day.append(str(cases_daily_vals[i]))
+                line_prop.append(str(cases_week_prop[i, 2]))
+            final_lines_day.append(';'.join(line_day))
+            final_lines_prop.append(';'.join(line_prop))
+
+    age_cases_daily = pd.read_csv(StringIO('\n'.join(final_lines_day)), sep=";")
+    age_cases_prop = pd.read_csv(StringIO('\n'.join(final_lines_prop)), sep=";")
+    return age_cases_daily, age_cases_prop
+
+
+def reference_cases_age_weekly(number_age_groups=9):
+    new_cases_df = pd.read_csv(StringIO(api_text('cases_by_age')), sep=";")
+    new_cases_df = new_cases_df[~new_cases_df['Time'].str.contains('All')]
+    new_cases_df.loc[new_cases_df['val'] == '..', 'val'] = 0
+    new_cases_df = new_cases_df.fillna(0)
+    age_group_mapping = MAPPINGS['age_groups'][number_age_groups]['cases']
+    new_cases_df['age_group'] = new_cases_df.apply(lambda row: age_group_mapping[row['Age']], axis=1)
+    new_cases_df = new_cases_df.astype({'val': 'int32'})
+    cases_age = new_cases_df.groupby(by=['Time', 'age_group'], as_index=False).sum(numeric_only=True)
+
+    age_groups = MAPPINGS['age_groups'][number_age_groups]['names']
+    cases_age_prop = cases_age.copy()
+    for time in pd.unique(cases_age['Time']):
+        date_df = cases_age.loc[cases_age['Time'] == time, ]
+        tot_val = date_df[date_df['age_group'].str.contains('All')]['val'].values[0]
+        age_val = np.sum(date_df[~date_df['age_group'].str.contains('All')]['val'].values)
+        if age_val != tot_val:
+            missing_cases = tot_val - age_val
+            add_cases = np.floor(missing_cases / len(age_groups))
+            cases_age.loc[cases_age['Time'] == time, 'val'] += add_cases
+            left_cases = missing_cases % len(age_groups)
+            age_i = 0
+            while left_cases > 0:
+                condition = (cases_age['Time'] == time) & (cases_age['age_group'] == age_groups[age_i])
+                cases_age.loc[condition, 'val'] += 1
+                age_i += 1
+                left_cases -= 1
+        if tot_val != 0:
+            cases_age_prop.loc[cases_age['Time'] == time, 'val'] = (
+                cases_age.loc[cases_age['Time'] == time, 'val'] / tot_val
+            )
+
+    cases_age_prop = cases_age_prop.fillna(0)
+    cases_age = cases_age[~cases_age['age_group'].str.contains('All')]
+    cases_age_prop = cases_age_prop[~cases_age_prop['age_group'].str.contains('All')]
+    return cases_age, cases_age_prop
+
+
+def reference_cases_erva_daily():
+    new_cases_df = pd.read_csv(StringIO(api_text('cases_by_day')), sep=";")
+    new_cases_df = new_cases_df[~new_cases_df['Time'].str.contains('Week|All')]
+    new_cases_df = new_cases_df.fillna(0)
+    new_cases_df = new_cases_df.drop(columns=['Measure'])
+    hcd_erva_mapping = MAPPINGS['hcd_erva']
+    new_cases_df['erva'] = new_cases_df.apply(lambda row: hcd_erva_mapping[row['Area']], axis=1)
+    reported_cases_erva = new_cases_df.groupby(by=['Time', 'erva'], as_index=False).sum(numeric_only=True)
+    return reported_cases_erva[~reported_cases_erva['erva'].str.contains('All')]
+
+
+def reference_cases_age_erva_daily(number_age_groups=9):
+    _, cases_age_prop = reference_age_cases_daily(number_age_groups=number_age_groups)
+    cases_erva = reference_cases_erva_daily()
+
+    cases_by_age_erva = []
+    for row_age_prop in cases_age_prop.values:
+        time, *probs = row_age_prop
+        cases_erva_date = cases_erva.loc[cases_erva['Time'] == time, ].values
+        for cases_line in cases_erva_date:
+            _, erva, cases = cases_line
+            cases_by_age_erva.append([time, erva, *(cases*np.array(probs))])
+
+    age_groups = MAPPINGS['age_groups'][number_age_groups]['names']
+    return pd.DataFrame(data=cases_by_age_erva, columns=['Time', 'erva'] + list(age_groups))
+
+
+def assert_same_frame(frame, expected, start_date=None, date_column='date'):
+    # Same columns and rows as expected (from start_date), with the labels
+    # compared as strings and the values up to the rounding of the CSV text
+    # of the original implementations
+    if start_date is not None:
+        expected = expected[expected[date_column] >= start_date]
+    frame = frame.reset_index(drop=True)
+    expected = expected.reset_index(drop=True)
+    assert list(frame.columns) == list(expected.columns)
+    for column in frame.columns:
+        if frame[column].dtype.kind in 'fiu':
+            np.testing.assert_allclose(frame[column].values, expected[column].values,
+                                       rtol=1e-12, err_msg=column)
+        else:
+            assert list(frame[column].astype(str)) == list(expected[column].astype(str)), column
+
+
+@pytest.mark.parametrize('start_date', [None, '2021-01-06', '2021-01-09'])
+def test_vaccines_daily_match_original(recorded_api, start_date):
+    vaccinated = construct_thl_vaccines_erva_daily(LOGGER, start_date=start_date)
+    assert_same_frame(vaccinated, reference_vaccines_daily(), start_date)
+
+
+@pytest.mark.parametrize('start_date', [None, '2021-01-05', '2021-01-09', '2021-01-10'])
+def test_hospitalizations_match_original(recorded_api, start_date):
+    hospitalizations = construct_hs_hosp_age_erva(LOGGER, start_date=start_date)
+    assert_same_frame(hospitalizations, reference_hosp_age_erva(), start_date)
+
+
+@pytest.mark.parametrize('start_date', [None, '2020-12-14', '2021-01-06'])
+def test_cases_age_weekly_match_original(recorded_api, start_date):
+    cases_age = fetch_finland_cases_age_weekly(LOGGER, start_date=start_date)
+    for frame, expected in zip(cases_age, reference_cases_age_weekly()):
+        if start_date is not None:
+            mondays = expected['Time'].map(transform_thl_week_datetime)
+            expected = expected[mondays + datetime.timedelta(days=6) >= start_date]
+        assert_same_frame(frame[['Time', 'age_group', 'val']], expected[['Time', 'age_group', 'val']])
+
+    # The proportions of the week without cases are 0, the others add up to 1
+    proportions = cases_age[1].groupby('Time')['val'].sum()
+    np.testing.assert_allclose(proportions, np.where(proportions.index == WEEKS[1], 0., 1.))
+
+
+@pytest.mark.parametrize('start_date', [None, '2021-01-06'])
+def test_age_cases_daily_match_original(recorded_api, start_date):
+    age_cases = construct_finland_age_cases_daily(LOGGER, start_date=start_date)
+    for frame, expected in zip(age_cases, reference_age_cases_daily()):
+        assert_same_frame(frame, expected, start_date, date_column='Time')
+
+
+@pytest.mark.parametrize('start_date', [None, '2021-01-06', '2021-01-10'])
+def test_cases_age_erva_match_original(recorded_api, start_date):
+    expected = reference_cases_age_erva_daily()
+    cases = construct_cases_age_erva_daily(LOGGER, start_date=start_date)
+    assert_same_frame(cases, expected, start_date, date_column='Time')
+
+    # The array has the same values, with shape (dates, ervas, age groups)
+    dates, ervas, age_groups, cases_array = construct_cases_age_erva_array(LOGGER,
+                                                                          start_date=start_date)
+    assert list(ervas) == sorted(set(MAPPINGS['hcd_erva'].values()) - {'All', 'Other'})
+    # Only the days with reported cases
+    assert dates[-1] == week_dates(WEEKS)[-4].strftime('%Y-%m-%d')
+    assert cases_array.shape == (len(dates), len(ervas), len(age_groups))
+    assert list(np.repeat(dates, len(ervas))) == list(cases['Time'])
+    np.testing.assert_array_equal(cases_array.reshape(-1, len(age_groups)), cases[age_groups].values)
+
+
+def test_erva_age_categoricals_refuses_unknown_labels():
+    dataframe = pd.DataFrame(data={'erva': ['HYKS', 'OYS'], 'age': ['0-9', '80+'],
+                                   'ward': [1., 2.]})
+    dataframe = erva_age_categoricals(dataframe)
+    assert list(dataframe['erva']) == ['HYKS', 'OYS']
+    assert list(dataframe['age'].cat.categories)[-1] == '80+'
+
+    for column, label in [('erva', 'Helsinki'), ('age', '80-89')]:
+        dataframe = pd.DataFrame(data={'erva': ['HYKS', 'OYS'], 'age': ['0-9', '80+']})
+        dataframe.loc[1, column] = label
+        with pytest.raises(ValueError, match=label):
+            erva_age_categoricals(dataframe)
+    with pytest.raises(ValueError):
+        erva_age_categoricals(pd.DataFrame(data={'erva': ['HYKS', np.nan], 'age': ['0-9', '0-9']}))
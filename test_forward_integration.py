@@ -0,0 +1,346 @@
+import numpy as np
+import pandas as pd
+import pytest
+import forward_integration as fi
+from env_var import EPIDEMIC
+from epidemic_store import STATE_COLUMNS
+from forward_integration import (
+    force_of_infection, forward_integration, forward_integration_batch,
+    forward_integration_stream, get_model_parameters, mobility_kernel,
+    next_generation_matrix, spectral_radius
+)
+
+
+N_G = 9
+N_P = 3
+T = 25
+
+
+def synthetic_inputs(seed=0, num_ervas=N_P):
+    # Small random model: populations, mobility, contacts and an initial
+    # state with the columns of the epidemic store (proportions)
+    rng = np.random.default_rng(seed)
+    age_er = rng.uniform(1e4, 1e5, size=(num_ervas, N_G))
+    c1 = rng.uniform(0., 1., size=(num_ervas, num_ervas)) + np.eye(num_ervas)
+    c1 = c1/c1.sum(axis=1, keepdims=True)
+    pop_hat = age_er.sum(axis=1) @ c1
+    c_gh = rng.uniform(0.1, 2., size=(N_G, N_G))
+    epidemic_npy = np.zeros((N_G, num_ervas, 8))
+    epidemic_npy[:, :, 1] = rng.uniform(1e-4, 1e-3, size=(N_G, num_ervas))
+    epidemic_npy[:, :, 2] = rng.uniform(1e-4, 1e-3, size=(N_G, num_ervas))
+    epidemic_npy[:, :, 3] = rng.uniform(0., 0.05, size=(N_G, num_ervas))
+    epidemic_npy[:, :, 4] = rng.uniform(0., 0.05, size=(N_G, num_ervas))
+    epidemic_npy[:, :, 0] = 1 - epidemic_npy[:, :, 1:5].sum(axis=2)
+    u_op = rng.uniform(0., 2e-3, size=(N_G, num_ervas, T))
+    return age_er, c1, pop_hat, c_gh, epidemic_npy, u_op
+
+
+def reference_force_of_inf(I_h, c_gh, k, mob, pop_hat, age_er, I_2):
+    # Triple loop of the original implementation, for age group g = c_gh[:, g]
+    num_ervas, num_age_groups = age_er.shape
+    fi = 0.0
+    for h in range(num_age_groups):
+        for m in range(num_ervas):
+            for l in range(num_ervas):
+                fi = fi + (mob[k, m]*mob[l, m]*(I_h[h, l]+I_2[h, l])*c_gh[h]*age_er[l, h])/pop_hat[m]
+    return fi
+
+
+def reference_metric_weights(metric, j, delay, use_ervas, age_er):
+    # Normalized counts of the last period per erva, as in the original
+    # get_metric_erva_weigth
+    metric_t = metric[:, :, max(j - delay, 0):j].sum(axis=2)
+    metric_t = (metric_t*age_er.T).sum(axis=0)
+    if np.allclose(metric_t, 0):
+        metric_t[:] = 1
+    metric_norm = np.zeros(metric_t.shape)
+    metric_norm[use_ervas] = metric_t[use_ervas]/np.sum(metric_t[use_ervas])
+    return metric_norm
+
+
+def reference_forward(c1, beta, c_gh, pop_hat, age_er, e, epidemic_npy, u_op,
+                      u_con=0., ws_vacc=None):
+    # Original timestep, one age group and erva at a time, with a
+    # precomputed vaccination strategy (u_op) or the vaccines u_con
+    # assigned by the policy weights ws_vacc (u_op None)
+    num_ervas, num_age_groups = age_er.shape
+    omega = EPIDEMIC['omega']
+    pi = EPIDEMIC['pi']
+    T_E, T_V, T_I = EPIDEMIC['T_E'], EPIDEMIC['T_V'], EPIDEMIC['T_I']
+    T_q0, T_q1 = EPIDEMIC['T_q0'], EPIDEMIC['T_q1']
+    T_hw, T_hc, T_hr = EPIDEMIC['T_hw'], EPIDEMIC['T_hc'], EPIDEMIC['T_hr']
+    mu_q = EPIDEMIC['mu_q'][num_age_groups]
+    mu_w = EPIDEMIC['mu_w'][num_age_groups]
+    mu_c = EPIDEMIC['mu_c'][num_age_groups]
+    p_H = EPIDEMIC['p_H'][num_age_groups]
+    p_c = EPIDEMIC['p_c'][num_age_groups]
+
+    x = {name: np.zeros((num_age_groups, num_ervas, T)) for name in
+         ['S_g', 'S_xg', 'S_vg', 'S_pg', 'V_g', 'E_g', 'E2_g', 'I_g', 'I2_g',
+          'Q_0g', 'Q_1g', 'H_wg', 'H_cg', 'H_rg', 'R_g', 'D_g']}
+    x['S_g'][:, :, 0] = epidemic_npy[:, :, 0]
+    x['I_g'][:, :, 0] = 0.9*epidemic_npy[:, :, 1]
+    x['I2_g'][:, :, 0] = 0.1*epidemic_npy[:, :, 1]
+    x['E_g'][:, :, 0] = 0.9*epidemic_npy[:, :, 2]
+    x['E2_g'][:, :, 0] = 0.1*epidemic_npy[:, :, 2]
+    x['R_g'][:, :, 0] = epidemic_npy[:, :, 3]
+    x['V_g'][:, :, 0] = epidemic_npy[:, :, 4]
+    x['S_xg'][:, :, 0] = epidemic_npy[:, :, 5]
+    x['H_wg'][:, :, 0] = epidemic_npy[:, :, 6]
+    x['H_cg'][:, :, 0] = epidemic_npy[:, :, 7]
+    infections_incidence = np.zeros((num_age_groups, num_ervas, T))
+    use_policy = u_op is None
+    if use_policy:
+        u = np.zeros((num_age_groups, num_ervas, T))
+    else:
+        u = u_op.copy()
+    pop_erva = age_er.sum(axis=1)
+    age_group_indicators = np.array([num_age_groups-1]*num_ervas)
+    delay = EPIDEMIC['delay_check_vacc']
+
+    remain_last = 0
+    for j in range(T-1):
+        S_g, S_xg, S_vg, S_pg = x['S_g'], x['S_xg'], x['S_vg'], x['S_pg']
+        V_g, E_g, E2_g, I_g, I2_g = x['V_g'], x['E_g'], x['E2_g'], x['I_g'], x['I2_g']
+        Q_0g, Q_1g, H_wg, H_cg = x['Q_0g'], x['Q_1g'], x['H_wg'], x['H_cg']
+        H_rg, R_g, D_g = x['H_rg'], x['R_g'], x['D_g']
+        if use_policy:
+            u_con_remain = u_con + remain_last
+            remain_last = 0
+            use_ervas = age_group_indicators != -1
+            pops_erva_prop = np.zeros(pop_erva.shape)
+            pops_erva_prop[use_ervas] = pop_erva[use_ervas]/np.sum(pop_erva[use_ervas])
+            hosp_norm = reference_metric_weights(H_wg + H_cg + x['H_rg'], j, delay,
+                                                 use_ervas, age_er)
+            infe_norm = reference_metric_weights(infections_incidence, j, delay,
+                                                 use_ervas, age_er)
+            policy = ws_vacc[0]*pops_erva_prop + ws_vacc[1]*infe_norm + ws_vacc[2]*hosp_norm
+            u_erva = u_con_remain*policy
+
+        for n in range(num_ervas):
+            for g in range(num_age_groups-1, -1, -1):
+                lambda_g = reference_force_of_inf(I_g[:, :, j], c_gh[:, g], n, c1, pop_hat,
+                                                  age_er, I2_g[:, :, j])
+                c = (g, n, j)
+                c_1 = (g, n, j+1)
+                if use_policy:
+                    # Greedy allocation from the oldest age group
+                    S_left = S_g[c] - beta*lambda_g*S_g[c]
+                    if S_left <= 0:
+                        age_group_indicators[n] = g - 1
+                        if g <= 1 and u_erva[n] > 0:
+                            if n+1 < num_ervas:
+                                u_erva[n+1] += u_erva[n]
+                                u_erva[n] = 0
+                            else:
+                                remain_last += u_erva[n]
+                    if age_group_indicators[n] == g and g > 1:
+                        u[c] += u_erva[n]/age_er[n, g]
+                        u_erva[n] = 0
+                        all_aplied = S_left - u[c]
+                        if all_aplied < 0:
+                            age_group_indicators[n] = g - 1
+                            left_over_real = np.abs(all_aplied)*age_er[n, g]
+                            if g-1 >= 0:
+                                u_erva[n] = left_over_real
+                            elif n+1 < num_ervas:
+                                u_erva[n+1] += left_over_real
+                            else:
+                                remain_last += left_over_real
+                    elif g <= 1 and u_erva[n] > 0:
+                        if n+1 < num_ervas:
+                            u_erva[n+1] += u_erva[n]
+                            u_erva[n] = 0
+                        else:
+                            remain_last += u_erva[n]
+                u[c] = min(u[c], max(0.0, S_g[c] - beta*lambda_g*S_g[c]))
+                S_g[c_1] = S_g[c] - beta*lambda_g*S_g[c] - u[c]
+                S_xg[c_1] = S_xg[c] - beta*lambda_g*S_xg[c]
+                S_vg[c_1] = S_vg[c] - beta*lambda_g*S_vg[c] + u[c] - T_V*S_vg[c]
+                S_pg[c_1] = S_pg[c] - omega*beta*lambda_g*S_pg[c] + (1.-e)*T_V*S_vg[c]
+                V_g[c_1] = V_g[c] + e*T_V*S_vg[c]
+                E_g[c_1] = E_g[c] + beta*lambda_g*(S_g[c]+S_vg[c]+S_xg[c]) - T_E*E_g[c]
+                E2_g[c_1] = E2_g[c] + omega*beta*lambda_g*S_pg[c] - T_E*E2_g[c]
+                I_g[c_1] = I_g[c] + T_E*E_g[c] - T_I*I_g[c]
+                I2_g[c_1] = I2_g[c] + T_E*E2_g[c] - T_I*I2_g[c]
+                Q_0g[c_1] = Q_0g[c] + (1.-p_H[g])*T_I*I_g[c] - T_q0*Q_0g[c] + (1.-pi*p_H[g])*T_I*I2_g[c]
+                Q_1g[c_1] = Q_1g[c] + p_H[g]*T_I*I_g[c] + pi*p_H[g]*T_I*I2_g[c] - T_q1*Q_1g[c]
+                H_wg[c_1] = H_wg[c] + T_q1*Q_1g[c] - T_hw*H_wg[c]
+                H_cg[c_1] = H_cg[c] + p_c[g]*T_hw*H_wg[c] - T_hc*H_cg[c]
+                H_rg[c_1] = H_rg[c] + (1.-mu_c[g])*T_hc*H_cg[c] - T_hr*H_rg[c]
+                R_g[c_1] = R_g[c] + T_hr*H_rg[c] + (1.-mu_w[g])*(1.-p_c[g])*T_hw*H_wg[c] + (1.-mu_q[g])*T_q0*Q_0g[c]
+                D_g[c_1] = D_g[c] + mu_q[g]*T_q0*Q_0g[c] + mu_w[g]*(1.-p_c[g])*T_hw*H_wg[c] + mu_c[g]*T_hc*H_cg[c]
+                infections_incidence[c] = T_E*E_g[c]
+
+    return x['S_g'], x['E_g'], x['H_wg'], x['H_cg'], x['H_rg'], x['I_g'], x['D_g'], u
+
+
+def test_force_of_infection_matches_loop():
+    age_er, c1, pop_hat, c_gh, _, _ = synthetic_inputs()
+    rng = np.random.default_rng(1)
+    I_h = rng.uniform(0., 1e-3, size=(N_G, N_P))
+    I_2 = rng.uniform(0., 1e-3, size=(N_G, N_P))
+
+    lambda_g = force_of_infection(I_h + I_2, c_gh, mobility_kernel(c1, pop_hat), age_er)
+
+    expected = np.array([[reference_force_of_inf(I_h, c_gh[:, g], k, c1, pop_hat, age_er, I_2)
+                          for k in range(N_P)] for g in range(N_G)])
+    np.testing.assert_allclose(lambda_g, expected, rtol=1e-12)
+
+
+def test_force_of_infection_broadcasts_scenarios():
+    # Leading axes of I_h, c_gh and the kernel are scenarios
+    scenarios = [synthetic_inputs(seed) for seed in range(3)]
+    age_er = scenarios[0][0]
+    rng = np.random.default_rng(2)
+    I_h = rng.uniform(0., 1e-3, size=(3, N_G, N_P))
+    c1 = np.stack([s[1] for s in scenarios])
+    pop_hat = np.stack([s[2] for s in scenarios])
+    c_gh = np.stack([s[3] for s in scenarios])
+
+    batched = force_of_infection(I_h, c_gh, mobility_kernel(c1, pop_hat), age_er)
+    for s in range(3):
+        single = force_of_infection(I_h[s], c_gh[s], mobility_kernel(c1[s], pop_hat[s]), age_er)
+        np.testing.assert_allclose(batched[s], single, rtol=1e-14)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_forward_integration_matches_loop(seed):
+    age_er, c1, pop_hat, c_gh, epidemic_npy, u_op = synthetic_inputs(seed)
+    beta, e = 0.03, EPIDEMIC['e']
+
+    outputs = forward_integration(0., c1, beta, c_gh, T, pop_hat, age_er, None,
+                                  [0., 0., 0.], e, epidemic_npy, True, u_op=u_op)
+    expected = reference_forward(c1, beta, c_gh, pop_hat, age_er, e, epidemic_npy, u_op)
+
+    # S_g, E_g, H_wg, H_cg, H_rg, I_g, D_g and u
+    for output, reference in zip(outputs[:8], expected):
+        np.testing.assert_allclose(output, reference, rtol=1e-10, atol=1e-15)
+
+
+@pytest.mark.parametrize('u_con', [1e3, 6e4])
+@pytest.mark.parametrize('ws_vacc', [[1., 0., 0.], [0.2, 0.5, 0.3]])
+def test_forward_integration_policy_matches_loop(u_con, ws_vacc):
+    # With 6e4 vaccines per day the age groups of every erva run out of
+    # susceptibles and the leftovers move to the next group, erva and day
+    age_er, c1, pop_hat, c_gh, epidemic_npy, _ = synthetic_inputs()
+    beta, e = 0.03, EPIDEMIC['e']
+
+    outputs = forward_integration(u_con, c1, beta, c_gh, T, pop_hat, age_er, None,
+                                  ws_vacc, e, epidemic_npy, True)
+    expected = reference_forward(c1, beta, c_gh, pop_hat, age_er, e, epidemic_npy, None,
+                                 u_con=u_con, ws_vacc=ws_vacc)
+
+    for output, reference in zip(outputs[:8], expected):
+        np.testing.assert_allclose(output, reference, rtol=1e-10, atol=1e-15)
+
+
+def test_forward_integration_batch_matches_single():
+    age_er, c1, pop_hat, c_gh, epidemic_npy, u_op = synthetic_inputs()
+    beta, e = 0.03, EPIDEMIC['e']
+    ws_vacc = [[1., 0., 0.], [0., 1., 0.]]
+
+    batch = forward_integration_batch(1e3, np.stack([c1, c1]), [beta, 2*beta],
+                                      np.stack([c_gh, c_gh]), T, np.stack([pop_hat, pop_hat]),
+                                      age_er, ws_vacc, e, epidemic_npy)
+    for s in range(2):
+        single = forward_integration(1e3, c1, [beta, 2*beta][s], c_gh, T, pop_hat, age_er, None,
+                                     ws_vacc[s], e, epidemic_npy, True)
+        for output_batch, output_single in zip(batch, single):
+            np.testing.assert_allclose(output_batch[s], output_single, rtol=1e-13, atol=1e-18)
+
+
+@pytest.mark.parametrize('aggregate', [None, 'age', 'erva', 'all'])
+def test_forward_integration_stream_matches_batch(aggregate):
+    age_er, c1, pop_hat, c_gh, epidemic_npy, u_op = synthetic_inputs()
+    ws_vacc = [[0.5, 0.5, 0.], [0., 0., 1.], None]
+    u_ops = [None, None, u_op]
+    beta = [0.03, 0.05, 0.04]
+    c1, c_gh, pop_hat = np.stack([c1]*3), np.stack([c_gh]*3), np.stack([pop_hat]*3)
+
+    batch = forward_integration_batch(1e3, c1, beta, c_gh, T, pop_hat, age_er, ws_vacc,
+                                      EPIDEMIC['e'], epidemic_npy, u_op=u_ops)
+    stream = forward_integration_stream(1e3, c1, beta, c_gh, T, pop_hat,
+                                        age_er, ws_vacc, EPIDEMIC['e'], epidemic_npy,
+                                        ['total hospitalizations', 'mortality', 'vaccinations',
+                                         'new hospitalizations'],
+                                        u_op=u_ops, aggregate=aggregate)
+
+    _, _, H_wg, H_cg, H_rg, _, D_g, u, hosp_i, _ = batch
+    deaths_incidence = D_g.copy()
+    deaths_incidence[..., 1:] -= D_g[..., :-1]
+    age_er_prop = age_er.T[:, :, np.newaxis]
+    expected = {
+        'total hospitalizations': (H_wg + H_cg + H_rg)*age_er_prop,
+        'mortality': deaths_incidence*age_er_prop,
+        'vaccinations': u*age_er_prop,
+        'new hospitalizations': hosp_i*age_er_prop,
+    }
+    axes = {None: (), 'age': (1, ), 'erva': (2, ), 'all': (1, 2)}[aggregate]
+    for name, values in expected.items():
+        np.testing.assert_allclose(stream[name], values.sum(axis=axes), rtol=1e-10,
+                                   atol=1e-10, err_msg=name)
+
+
+def write_epidemic_csv(csv_name, dates, seed=0):
+    # Epidemic state with the layout of initial_states.py for the ervas of
+    # ervas_order and 9 age groups
+    rng = np.random.default_rng(seed)
+    ervas = EPIDEMIC['ervas_order']
+    ages = ['age_%d' % (g, ) for g in range(N_G)]
+    index = pd.MultiIndex.from_product([dates, ervas, ages], names=['date', 'erva', 'age'])
+    epidemic_state = pd.DataFrame(rng.uniform(0., 1e4, size=(len(index), len(STATE_COLUMNS))),
+                                  index=index, columns=STATE_COLUMNS).reset_index()
+    epidemic_state.to_csv(csv_name, index=False)
+
+
+@pytest.fixture
+def parameters_files(tmp_path, monkeypatch):
+    # get_model_parameters reads out/epidemic_finland_9.csv from the
+    # working directory and caches the results in PARAMETERS_CACHE_DIR
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(fi, 'PARAMETERS_CACHE_DIR', str(tmp_path / 'cache'))
+    (tmp_path / 'out').mkdir()
+    csv_name = str(tmp_path / 'out' / 'epidemic_finland_9.csv')
+    write_epidemic_csv(csv_name, ['2021-05-01', '2021-05-02'])
+    return csv_name
+
+
+def test_cached_parameters_match_uncached(parameters_files, monkeypatch):
+    cached = get_model_parameters(9, 5, True, '2021-05-02', 0.5)
+    uncached = get_model_parameters(9, 5, True, '2021-05-02', 0.5, use_cache=False)
+    for value, expected in zip(cached, uncached):
+        np.testing.assert_array_equal(value, expected)
+
+    # Read from the cache files, nothing is computed again
+    def fail(*args):
+        raise AssertionError('Parameters computed again')
+    monkeypatch.setattr(fi, 'spectral_radius', fail)
+    monkeypatch.setattr(fi, 'compute_mobility_parameters', fail)
+    for value, expected in zip(get_model_parameters(9, 5, True, '2021-05-02', 0.5), uncached):
+        np.testing.assert_array_equal(value, expected)
+
+
+def test_cached_parameters_invalidated(parameters_files):
+    rho = get_model_parameters(9, 5, True, '2021-05-02', 0.5)[4]
+    # A different state at t0 is a different cache entry
+    write_epidemic_csv(parameters_files, ['2021-05-01', '2021-05-02'], seed=1)
+    rho_changed = get_model_parameters(9, 5, True, '2021-05-02', 0.5)[4]
+    expected = get_model_parameters(9, 5, True, '2021-05-02', 0.5, use_cache=False)[4]
+    assert rho_changed != rho
+    assert rho_changed == expected
+
+
+@pytest.mark.parametrize('num_ervas, num_age_groups', [(5, 9), (3, 8), (1, 2), (2, 1), (1, 3)])
+def test_spectral_radius_matches_dense(num_ervas, num_age_groups):
+    # (1, 2) and (2, 1) use the dense fallback for less than 3 rows
+    rng = np.random.default_rng(num_ervas*num_age_groups)
+    epidemic_sus = rng.uniform(1e3, 1e5, size=(num_ervas, num_age_groups))
+    beta_gh = rng.uniform(0.1, 2., size=(num_age_groups, num_age_groups))
+    mob_av = rng.uniform(0., 0.1, size=(num_ervas, num_ervas)) + np.eye(num_ervas)
+    pop_erva_hat = rng.uniform(1e5, 1e6, size=num_ervas)
+
+    ngm = next_generation_matrix(epidemic_sus, beta_gh, mob_av, pop_erva_hat)
+    expected = np.max(np.abs(np.linalg.eigvals(ngm)))
+    rho = spectral_radius(epidemic_sus, beta_gh, mob_av, pop_erva_hat)
+    np.testing.assert_allclose(rho, expected, rtol=1e-10)
@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import http_cache
+from env_var import HTTP_CACHE
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # API with ETags. The paths in server.fail_first answer 503 once
+    def do_GET(self):
+        server = self.server
+        path = self.path.strip('/')
+        server.hits.append(path)
+        if path in server.fail_first:
+            server.fail_first.discard(path)
+            self.send_response(503)
+            self.end_headers()
+            return
+        body = server.bodies[path]
+        etag = '"%s"' % (hashlib.md5(body).hexdigest(), )
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setitem(HTTP_CACHE, 'directory', str(tmp_path))
+    monkeypatch.setitem(HTTP_CACHE, 'mode', 'revalidate')
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    stub.hits = []
+    stub.fail_first = set()
+    stub.bodies = {'cases': b'{"cases": [1, 2, 3]}', 'vaccination': b'date;doses\n'}
+    thread = threading.Thread(target=stub.serve_forever, daemon=True)
+    thread.start()
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+    http_cache.PENDING.clear()
+
+
+def url(server, path):
+    return 'http://127.0.0.1:%d/%s' % (server.server_port, path)
+
+
+def test_revalidate_reuses_not_modified(server, monkeypatch):
+    first = http_cache.cached_get(LOGGER, url(server, 'cases'))
+    assert first.status_code == 200
+
+    # Younger than max_age: no request
+    assert http_cache.cached_get(LOGGER, url(server, 'cases')).content == first.content
+    assert server.hits == ['cases']
+
+    # Older than max_age: revalidated, answered 304
+    monkeypatch.setitem(HTTP_CACHE, 'max_age', 0)
+    response = http_cache.cached_get(LOGGER, url(server, 'cases'))
+    assert server.hits == ['cases', 'cases']
+    assert isinstance(response, http_cache.CachedResponse)
+    assert response.json() == {'cases': [1, 2, 3]}
+
+
+def test_offline_replays_cache(server, monkeypatch):
+    http_cache.cached_get(LOGGER, url(server, 'cases'))
+    monkeypatch.setitem(HTTP_CACHE, 'mode', 'offline')
+
+    assert http_cache.cached_get(LOGGER, url(server, 'cases')).json() == {'cases': [1, 2, 3]}
+    with pytest.raises(RuntimeError):
+        http_cache.cached_get(LOGGER, url(server, 'vaccination'))
+    assert server.hits == ['cases']
+
+
+def test_retries_unavailable(server):
+    server.fail_first.add('cases')
+    response = http_cache.cached_get(LOGGER, url(server, 'cases'))
+    assert response.status_code == 200
+    assert server.hits == ['cases', 'cases']
+
+
+def test_prefetched_uses_pending_requests(server):
+    urls = [url(server, 'cases'), url(server, 'vaccination')]
+    with http_cache.prefetched(LOGGER, urls):
+        assert set(http_cache.PENDING) == {http_cache.request_key(u) for u in urls}
+        assert http_cache.cached_get(LOGGER, urls[0]).status_code == 200
+    # The unused response finished and was cached with the block
+    assert http_cache.PENDING == {}
+    assert sorted(server.hits) == ['cases', 'vaccination']
+    assert http_cache.read_entry(urls[1]) is not None
+
+
+def test_prefetched_clears_pending_on_error(server):
+    urls = [url(server, 'cases'), url(server, 'vaccination')]
+    with pytest.raises(KeyError):
+        with http_cache.prefetched(LOGGER, urls):
+            raise KeyError('parsing failed')
+    assert http_cache.PENDING == {}
+    assert all(http_cache.read_entry(u) is not None for u in urls)
+
+
+def test_prefetched_without_urls(server):
+    with http_cache.prefetched(LOGGER, []):
+        assert http_cache.PENDING == {}
+    assert server.hits == []
+
+
+def test_prefetched_other_headers(server, monkeypatch):
+    # A request with other headers is sent again, the pending one stays
+    monkeypatch.setitem(HTTP_CACHE, 'mode', 'disabled')
+    urls = [url(server, 'cases')]
+    with http_cache.prefetched(LOGGER, urls, headers={'User-Agent': 'Me'}):
+        response = http_cache.cached_get(LOGGER, urls[0], headers={'Accept': 'text/csv'})
+        assert response.status_code == 200
+        assert list(http_cache.PENDING) == [http_cache.request_key(urls[0], {'User-Agent': 'Me'})]
+        http_cache.cached_get(LOGGER, urls[0], headers={'User-Agent': 'Me'})
+        assert http_cache.PENDING == {}
+    assert server.hits == ['cases', 'cases']
+
+
+def test_prefetched_overlapping_blocks(server, monkeypatch):
+    # The end of a block only drops its own pending requests
+    monkeypatch.setitem(HTTP_CACHE, 'mode', 'disabled')
+    urls = [url(server, 'cases'), url(server, 'vaccination')]
+    with http_cache.prefetched(LOGGER, urls):
+        with http_cache.prefetched(LOGGER, urls[:1]):
+            assert len(http_cache.PENDING[http_cache.request_key(urls[0])]) == 2
+        assert len(http_cache.PENDING[http_cache.request_key(urls[0])]) == 1
+        assert http_cache.cached_get(LOGGER, urls[0]).json() == {'cases': [1, 2, 3]}
+        assert list(http_cache.PENDING) == [http_cache.request_key(urls[1])]
+    assert http_cache.PENDING == {}
+    assert sorted(server.hits) == ['cases', 'cases', 'vaccination']
@@ -0,0 +1,195 @@
+import logging
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import initial_states
+from env_var import EPIDEMIC, MAPPINGS
+from epidemic_store import read_cases_state, write_epidemic_state
+from fetch_data import static_population_erva_age
+from initial_states import (
+    compartment_values_daily, full_epidemic_state_finland, update_epidemic_state_finland
+)
+from test_epidemic_store import DATES, assert_same_store, synthetic_state
+from test_fetch_data import WEEKS, record_api, recorded_api
+
+
+LOGGER = logging.getLogger(__name__)
+ERVA_POP_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             'stats', 'erva_population_age_2020.csv')
+ERVAS = ['HYKS', 'KYS', 'OYS', 'TAYS', 'TYKS', 'Åland']
+COMPARTMENTS = ['susceptible', 'infected detected', 'infected undetected',
+                'infected', 'exposed', 'recovered']
+
+
+def synthetic_daily_cases(days=40, seed=0, first_date='2021-01-04'):
+    # Result of daily_detected_cases with random cases for the ervas of the
+    # population file
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(first_date, periods=days).strftime('%Y-%m-%d').values
+    ages = MAPPINGS['age_groups'][9]['names']
+    cases = rng.uniform(0., 50., size=(days, len(ERVAS), len(ages)))
+    return dates, np.array(ERVAS, dtype=object), ages, cases
+
+
+def reference_compartments(cases_by_age_erva, erva_pop_file, number_age_groups=9):
+    # Original loop over the days of compartment_values_daily, for the
+    # dataframe of construct_cases_age_erva_daily. Rows by erva, age and date
+    inf_period = int((EPIDEMIC['T_I'])**(-1))
+    lat_period = int((EPIDEMIC['T_E'])**(-1))
+    a = EPIDEMIC['unreported_exponent']
+
+    dates = pd.unique(cases_by_age_erva['Time'])
+    ervas = pd.unique(cases_by_age_erva['erva'])
+    num_ervas = len(ervas)
+    ages_names = cases_by_age_erva.columns[2:]
+    cases_erva_age_npy = cases_by_age_erva.values[:, 2:]
+    days = len(dates)
+    ages = len(ages_names)
+    cases_erva_age_npy = cases_erva_age_npy.reshape(days, num_ervas, ages)
+
+    infectious_detected = np.zeros_like(cases_erva_age_npy)
+    recovered_detected = np.zeros_like(cases_erva_age_npy)
+    lookback_period = inf_period + lat_period
+    for day_t in range(days):
+        omega = max(day_t - lookback_period + 1, 0)
+        infectious_detected[day_t, ] = cases_erva_age_npy[omega:day_t+1, ].sum(axis=0)
+        recovered_detected[day_t, ] = cases_erva_age_npy[:omega, ].sum(axis=0)
+
+    k = np.arange(ages) + 1
+    upscale_factor = (1 + 9*k**(-a))[np.newaxis, np.newaxis, :]
+    infectious_undetected = infectious_detected * upscale_factor
+    recovered_undetected = recovered_detected * upscale_factor
+    infected_total = infectious_detected + infectious_undetected
+    recovered_total = recovered_detected + recovered_undetected
+    infected_real = (inf_period/lookback_period)*infected_total
+    exposed_real = (lat_period/lookback_period)*infected_total
+
+    pop_ervas, _ = static_population_erva_age(LOGGER, erva_pop_file,
+                                              number_age_groups=number_age_groups)
+    pop_ervas = pop_ervas[~pop_ervas['erva'].str.contains('All')]
+    pop_ervas = pop_ervas.sort_values(['erva', 'age_group'])
+    pop_ervas_npy = pop_ervas['Total'].values.reshape(num_ervas, ages)[np.newaxis, :]
+    susceptible = pop_ervas_npy - exposed_real - infected_real - recovered_total
+
+    frames = []
+    for erva_i, erva_name in enumerate(ervas):
+        for age_i, age_name in enumerate(ages_names):
+            frames.append(pd.DataFrame(data={
+                'date': dates,
+                'erva': [erva_name]*days,
+                'age': [age_name]*days,
+                'susceptible': susceptible[:, erva_i, age_i],
+                'infected detected': infectious_detected[:, erva_i, age_i],
+                'infected undetected': infectious_undetected[:, erva_i, age_i],
+                'infected': infected_real[:, erva_i, age_i],
+                'exposed': exposed_real[:, erva_i, age_i],
+                'recovered': recovered_total[:, erva_i, age_i],
+            }))
+    return pd.concat(frames)
+
+
+def cases_dataframe(daily_cases):
+    # daily_cases as the dataframe of construct_cases_age_erva_daily
+    dates, ervas, ages, cases = daily_cases
+    num_dates, num_ervas, num_ages = cases.shape
+    dataframe = pd.DataFrame(data=cases.reshape(num_dates*num_ervas, num_ages), columns=ages)
+    dataframe.insert(0, 'Time', np.repeat(dates, num_ervas))
+    dataframe.insert(1, 'erva', np.tile(ervas, num_dates))
+    return dataframe
+
+
+def assert_same_rows(state, expected, columns, **kwargs):
+    # Same rows (in any order) with the same values of columns
+    keys = ['date', 'erva', 'age']
+    state = state.astype({'erva': str, 'age': str}).sort_values(keys).reset_index(drop=True)
+    expected = expected.astype({'erva': str, 'age': str}).sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(state[keys], expected[keys])
+    np.testing.assert_allclose(state[columns].values.astype(np.float64),
+                               expected[columns].values.astype(np.float64), **kwargs)
+
+
+def test_compartments_match_loop():
+    daily_cases = synthetic_daily_cases()
+    compartments = compartment_values_daily(LOGGER, ERVA_POP_FILE, daily_cases=daily_cases)
+    expected = reference_compartments(cases_dataframe(daily_cases), ERVA_POP_FILE)
+
+    # Rows by date, erva and age
+    dates, ervas, ages, _ = daily_cases
+    assert list(compartments['date'][:len(ervas)*len(ages)]) == [dates[0]]*len(ervas)*len(ages)
+    assert list(compartments['erva'][:2*len(ages):len(ages)]) == list(ervas[:2])
+    assert_same_rows(compartments, expected, COMPARTMENTS, rtol=1e-12, atol=1e-9)
+
+
+def test_compartments_from_previous_cases():
+    # The last days constructed with the cases of the days before them have
+    # the same values as when all the days are constructed
+    dates, ervas, ages, cases = synthetic_daily_cases()
+    compartments = compartment_values_daily(LOGGER, ERVA_POP_FILE,
+                                            daily_cases=(dates, ervas, ages, cases))
+    last_days = compartment_values_daily(LOGGER, ERVA_POP_FILE,
+                                         daily_cases=(dates[25:], ervas, ages, cases[25:]),
+                                         previous_cases=cases[:25])
+    expected = compartments[compartments['date'] >= dates[25]].reset_index(drop=True)
+    pd.testing.assert_frame_equal(last_days, expected, check_exact=True)
+
+
+@pytest.mark.parametrize('init_vacc', [True, False])
+@pytest.mark.parametrize('revision_days', [14, 1000])
+def test_update_matches_full(recorded_api, tmp_path, init_vacc, revision_days):
+    # State of the first weeks updated with the responses of all the weeks,
+    # the last 14 days or all of them (from the first stored day)
+    csv_name = str(tmp_path / 'epidemic_finland_9.csv')
+    record_api(num_weeks=len(WEEKS) - 2)
+    full_epidemic_state_finland(LOGGER, ERVA_POP_FILE, csv_name, init_vacc=init_vacc)
+    record_api()
+    update_epidemic_state_finland(LOGGER, ERVA_POP_FILE, csv_name, init_vacc=init_vacc,
+                                  revision_days=revision_days)
+
+    expected_name = str(tmp_path / 'expected.csv')
+    full_epidemic_state_finland(LOGGER, ERVA_POP_FILE, expected_name, init_vacc=init_vacc)
+    assert_same_store(csv_name, expected_name)
+
+
+def test_update_constructs_from_stored_cases(recorded_api, tmp_path, monkeypatch):
+    csv_name = str(tmp_path / 'epidemic_finland_9.csv')
+    record_api(num_weeks=len(WEEKS) - 2)
+    full_epidemic_state_finland(LOGGER, ERVA_POP_FILE, csv_name)
+    cases_state = read_cases_state(csv_name)
+    stored_dates, stored_cases = cases_state['dates'], np.array(cases_state['cases'])
+    record_api()
+
+    calls = []
+
+    def compartments(*args, **kwargs):
+        calls.append(kwargs)
+        return compartment_values_daily(*args, **kwargs)
+
+    monkeypatch.setattr(initial_states, 'compartment_values_daily', compartments)
+    update_epidemic_state_finland(LOGGER, ERVA_POP_FILE, csv_name, revision_days=10)
+
+    # The last 10 days and the new ones are constructed with the stored
+    # cases of the days before them
+    start_i = len(stored_dates) - 10
+    dates, _, _, cases = calls[0]['daily_cases']
+    assert dates[0] == stored_dates[start_i]
+    assert len(dates) > 10
+    np.testing.assert_array_equal(calls[0]['previous_cases'], stored_cases[:start_i])
+    np.testing.assert_array_equal(cases[:10], stored_cases[start_i:])
+
+
+def test_update_rebuilds_with_gap(recorded_api, tmp_path):
+    # Without a previous state or with a missing day in the revised days, all
+    # the days are constructed
+    csv_name = str(tmp_path / 'epidemic_finland_9.csv')
+    expected_name = str(tmp_path / 'expected.csv')
+    full_epidemic_state_finland(LOGGER, ERVA_POP_FILE, expected_name)
+
+    update_epidemic_state_finland(LOGGER, ERVA_POP_FILE, csv_name)
+    assert_same_store(csv_name, expected_name)
+
+    gap_dates = DATES[:-5] + DATES[-4:]
+    state, cases = synthetic_state(gap_dates)
+    write_epidemic_state(state, csv_name, cases)
+    update_epidemic_state_finland(LOGGER, ERVA_POP_FILE, csv_name, revision_days=5)
+    assert_same_store(csv_name, expected_name)
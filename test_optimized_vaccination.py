@@ -0,0 +1,215 @@
+import numpy as np
+import os
+import pytest
+from scipy.optimize import Bounds, LinearConstraint, minimize
+import forward_integration
+import optimized_vaccination
+from env_var import EXPERIMENTS
+from optimized_vaccination import (
+    LimitedMemoryHessian, VaccinationOptimizer, get_vac, vaccination_constraints
+)
+from test_backends import synthetic_warm_up
+from test_forward_integration import synthetic_inputs, write_epidemic_csv
+
+
+def bfgs_matrix(steps, gradient_changes, delta):
+    # Dense BFGS updates from delta*I, as in Nocedal and Wright (6.19)
+    B = delta*np.eye(len(steps[0]))
+    for s, y in zip(steps, gradient_changes):
+        Bs = B @ s
+        B = B - np.outer(Bs, Bs)/(s @ Bs) + np.outer(y, y)/(y @ s)
+    return B
+
+
+def test_limited_memory_hessian_matches_bfgs():
+    rng = np.random.default_rng(0)
+    n = 12
+    A = rng.normal(size=(n, n))
+    A = A @ A.T + n*np.eye(n)
+    hessian = LimitedMemoryHessian(memory=4)
+    for x in rng.normal(size=(7, n)):
+        hessian.update(x, A @ x)
+
+    # Only the last 4 pairs are kept
+    assert len(hessian.steps) == 4
+    y = hessian.gradient_changes[-1]
+    delta = (y @ y)/(hessian.steps[-1] @ y)
+    B = bfgs_matrix(hessian.steps, hessian.gradient_changes, delta)
+    p = rng.normal(size=n)
+    np.testing.assert_allclose(hessian.hessp(None, p), B @ p, rtol=1e-9)
+
+
+def test_limited_memory_hessian_trust_constr():
+    # Quadratic with the sparse daily constraints of the optimizer
+    rng = np.random.default_rng(1)
+    age_er = rng.uniform(1e4, 1e5, size=(3, 9))
+    T, first_group, num_groups = 6, 2, 5
+    Af, b = vaccination_constraints(age_er, T, 3e4, first_group, num_groups)
+    n = Af.shape[1]
+    weights = rng.uniform(1., 2., size=n)
+    target = rng.uniform(0., 0.1, size=n)
+
+    hessian = LimitedMemoryHessian()
+
+    def jac(x):
+        gradient = weights*(x - target)
+        hessian.update(x, gradient)
+        return gradient
+
+    res = minimize(lambda x: 0.5*weights @ (x - target)**2, np.zeros(n), jac=jac,
+                   hessp=hessian.hessp, method='trust-constr',
+                   constraints=[LinearConstraint(Af, b, b)],
+                   bounds=Bounds(np.zeros(n), np.full(n, np.inf)),
+                   options={'maxiter': 500})
+    assert res.constr_violation < 1e-6
+    # Solution of the same problem with the exact Hessian
+    exact = minimize(lambda x: 0.5*weights @ (x - target)**2, np.zeros(n),
+                     jac=lambda x: weights*(x - target), hess=lambda x: np.diag(weights),
+                     method='trust-constr', constraints=[LinearConstraint(Af, b, b)],
+                     bounds=Bounds(np.zeros(n), np.full(n, np.inf)),
+                     options={'maxiter': 500})
+    np.testing.assert_allclose(res.fun, exact.fun, rtol=1e-4)
+
+
+@pytest.fixture
+def warm_up_calls(tmp_path, monkeypatch):
+    # get_vac with an epidemic state file in tmp_path and a simulate_warm_up
+    # that records its calls
+    csv_name = tmp_path / 'epidemic_finland_9.csv'
+    csv_name.write_text('date,erva,age\n')
+    calls = []
+
+    def simulate_warm_up(c1, beta, *args):
+        calls.append(beta)
+        return synthetic_warm_up()
+
+    monkeypatch.setattr(optimized_vaccination, 'warm_up_csv_path', lambda *args: str(csv_name))
+    monkeypatch.setattr(optimized_vaccination, 'simulate_warm_up', simulate_warm_up)
+    optimized_vaccination.clear_warm_up_cache()
+    yield csv_name, calls
+    optimized_vaccination.clear_warm_up_cache()
+
+
+def test_warm_up_cache_hit(warm_up_calls):
+    _, calls = warm_up_calls
+    age_er, c1, pop_hat, c_gh, _, _ = synthetic_inputs()
+    first = get_vac(1e3, c1, 0.03, c_gh, 10, pop_hat, age_er)
+    # u_con and T are not part of the warm-up
+    assert get_vac(2e3, c1, 0.03, c_gh, 20, pop_hat, age_er) is first
+    assert calls == [0.03]
+    # The cached arrays cannot be modified by the callers
+    assert not first[0].flags.writeable
+
+    get_vac(1e3, c1, 0.04, c_gh, 10, pop_hat, age_er)
+    assert calls == [0.03, 0.04]
+
+
+def test_warm_up_cache_invalidated(warm_up_calls):
+    csv_name, calls = warm_up_calls
+    age_er, c1, pop_hat, c_gh, _, _ = synthetic_inputs()
+    get_vac(1e3, c1, 0.03, c_gh, 10, pop_hat, age_er)
+    # New signature of the epidemic state file
+    csv_name.write_text('date,erva,age\n2021-05-01,HYKS,0-9\n')
+    os.utime(csv_name, ns=(0, 0))
+    get_vac(1e3, c1, 0.03, c_gh, 10, pop_hat, age_er)
+    assert calls == [0.03, 0.03]
+
+
+def test_warm_up_cache_bounded(warm_up_calls, monkeypatch):
+    _, calls = warm_up_calls
+    monkeypatch.setattr(optimized_vaccination, 'WARM_UP_CACHE_SIZE', 2)
+    age_er, c1, pop_hat, c_gh, _, _ = synthetic_inputs()
+    for beta in [0.01, 0.02, 0.01, 0.03]:
+        get_vac(1e3, c1, beta, c_gh, 10, pop_hat, age_er)
+    # 0.02 was the least recently used one
+    assert len(optimized_vaccination.warm_up_cache) == 2
+    get_vac(1e3, c1, 0.01, c_gh, 10, pop_hat, age_er)
+    get_vac(1e3, c1, 0.02, c_gh, 10, pop_hat, age_er)
+    assert calls == [0.01, 0.02, 0.03, 0.02]
+
+
+@pytest.fixture
+def optimizer(tmp_path, monkeypatch):
+    # Optimizer of 8 days starting from a synthetic epidemic state at t0
+    csv_name = str(tmp_path / 'epidemic_finland_9.csv')
+    write_epidemic_csv(csv_name, ['2021-04-17', EXPERIMENTS['t0']])
+    monkeypatch.setattr(optimized_vaccination, 'warm_up_csv_path', lambda *args: csv_name)
+    monkeypatch.setattr(optimized_vaccination, 'get_vac',
+                        lambda *args: synthetic_warm_up(num_ervas=5))
+    monkeypatch.setattr(forward_integration, 'PARAMETERS_CACHE_DIR', str(tmp_path / 'cache'))
+    optimizer = VaccinationOptimizer(0.03, 0.5, T=8, n_max=3000)
+    optimizer.telemetry = [{'round': 0, 'objective': 1.}]
+    return optimizer, csv_name
+
+
+def save_state(optimizer, checkpoint):
+    settings = optimizer.checkpoint_settings('SLSQP', (3, 2))
+    x = np.linspace(0., 1., optimizer.N_o*optimizer.N_p*optimizer.T)
+    optimizer.save_checkpoint(checkpoint, settings, 1, x, 2, 2*x, 3, [(0, 1), (2, 4)])
+    return x
+
+
+def test_checkpoint_round_trip(optimizer, tmp_path):
+    optimizer, _ = optimizer
+    checkpoint = str(tmp_path / 'checkpoint.npz')
+    x = save_state(optimizer, checkpoint)
+
+    state = optimizer.load_checkpoint(checkpoint, optimizer.checkpoint_settings('SLSQP', (3, 2)))
+    np.testing.assert_array_equal(state['x'], x)
+    np.testing.assert_array_equal(state['bound'], 2*x)
+    assert (state['round'], state['iterations'], state['T_i']) == (1, 2, 3)
+    assert state['kg_pairs'] == [(0, 1), (2, 4)]
+    assert state['telemetry'] == optimizer.telemetry
+    assert optimizer.load_checkpoint(str(tmp_path / 'missing.npz'), '') is None
+
+
+def test_checkpoint_other_inputs_refused(optimizer, tmp_path, monkeypatch):
+    optimizer, csv_name = optimizer
+    checkpoint = str(tmp_path / 'checkpoint.npz')
+    save_state(optimizer, checkpoint)
+
+    # Another maxiter, t0 or epidemic state are other optimizations
+    with pytest.raises(ValueError):
+        optimizer.load_checkpoint(checkpoint, optimizer.checkpoint_settings('SLSQP', (3, 3)))
+    with monkeypatch.context() as m:
+        m.setitem(EXPERIMENTS, 't0', '2021-04-17')
+        with pytest.raises(ValueError):
+            optimizer.load_checkpoint(checkpoint, optimizer.checkpoint_settings('SLSQP', (3, 2)))
+    write_epidemic_csv(csv_name, ['2021-04-17', EXPERIMENTS['t0']], seed=1)
+    with pytest.raises(ValueError):
+        optimizer.load_checkpoint(checkpoint, optimizer.checkpoint_settings('SLSQP', (3, 2)))
+
+
+def test_checkpoint_resume(optimizer, tmp_path, monkeypatch):
+    optimizer, _ = optimizer
+    checkpoint = str(tmp_path / 'checkpoint.npz')
+    save_checkpoint = optimizer.save_checkpoint
+    saved = []
+
+    def interrupted(*args):
+        # Killed after the checkpoint of the first iteration
+        save_checkpoint(*args)
+        saved.append(args[4])
+        if len(saved) == 2:
+            raise KeyboardInterrupt
+    with monkeypatch.context() as m:
+        m.setattr(optimizer, 'save_checkpoint', interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            optimizer.run(checkpoint=checkpoint, maxiter=(3, 2))
+    state = optimizer.load_checkpoint(checkpoint, optimizer.checkpoint_settings('SLSQP', (3, 2)))
+    assert (state['round'], state['iterations']) == (0, 1)
+
+    minimize_deaths = optimizer.minimize_deaths
+    starts = []
+
+    def recorded(x0, Af, b, bounds, maxiter, *args):
+        starts.append((np.array(x0), maxiter))
+        return minimize_deaths(x0, Af, b, bounds, maxiter, *args)
+    monkeypatch.setattr(optimizer, 'minimize_deaths', recorded)
+    nuf = optimizer.run(checkpoint=checkpoint, maxiter=(3, 2), resume=True)
+
+    # The first round continues from the checkpoint with the iterations left
+    np.testing.assert_array_equal(starts[0][0], state['x'])
+    assert starts[0][1] == 2
+    assert nuf.shape == (optimizer.N_g, optimizer.N_p, optimizer.T)
+    assert not os.path.isfile(checkpoint)
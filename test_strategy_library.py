@@ -0,0 +1,71 @@
+import json
+import numpy as np
+import pytest
+from strategy_library import (
+    find_strategy, library_strategy, read_strategy_library, update_strategy_library,
+    write_strategy_library
+)
+
+
+def strategy(seed, T, num_ervas=5):
+    # Vaccines of the age groups 2 to 6, as the optimizer
+    u = np.zeros((9, num_ervas, T))
+    u[2:7] = np.random.default_rng(seed).uniform(0., 1e-3, size=(5, num_ervas, T))
+    return u
+
+
+def metadata(r, tau, death_optim=False):
+    return {'r': r, 'tau': tau, 'death_optim': death_optim, 'beta': 0.03*r}
+
+
+def test_library_round_trip(tmp_path):
+    library_name = str(tmp_path / 'strategies.npz')
+    strategies = [(metadata(1.0, 0.5), strategy(0, 110)), (metadata(1.5, 0.), strategy(1, 115))]
+    write_strategy_library(strategies, library_name=library_name)
+
+    library = read_strategy_library(library_name)
+    values, index = library
+    # The values are read from the archive when used
+    assert isinstance(values, np.memmap)
+    assert values.shape == (2, 5, 5, 115)
+    assert index['strategies'] == [m for m, _ in strategies]
+    for s, (_, u) in enumerate(strategies):
+        # Each strategy with its own T
+        np.testing.assert_array_equal(library_strategy(library, s), u)
+    assert find_strategy(library, 1.5, 0) == 1
+    assert find_strategy(library, 1.5, 0, death_optim=True) is None
+    assert read_strategy_library(str(tmp_path / 'missing.npz')) is None
+
+
+def test_library_update(tmp_path):
+    library_name = str(tmp_path / 'strategies.npz')
+    write_strategy_library([(metadata(1.0, 0.5), strategy(0, 110)),
+                            (metadata(1.5, 0.), strategy(1, 110))],
+                           library_name=library_name, dtype=np.float32)
+    update_strategy_library([(metadata(1.0, 0.5), strategy(2, 115)),
+                             (metadata(0.75, 1.), strategy(3, 110))],
+                            library_name=library_name)
+
+    library = read_strategy_library(library_name)
+    values, index = library
+    # Same key replaced, the library keeps its dtype
+    assert values.dtype == np.float32
+    assert [(m['r'], m['tau']) for m in index['strategies']] == [(1.5, 0.), (1.0, 0.5),
+                                                                 (0.75, 1.)]
+    for s, seed, T in [(0, 1, 110), (1, 2, 115), (2, 3, 110)]:
+        np.testing.assert_allclose(library_strategy(library, s), strategy(seed, T), rtol=1e-6)
+
+
+def test_library_refuses_other_shapes(tmp_path):
+    library_name = str(tmp_path / 'strategies.npz')
+    with pytest.raises(ValueError):
+        write_strategy_library([(metadata(1.0, 0.5), strategy(0, 110)),
+                                (metadata(1.5, 0.), strategy(1, 110, num_ervas=3))],
+                               library_name=library_name)
+
+    # Values that do not match the index
+    index = {'num_age_groups': 9, 'age_groups': [2, 3, 4, 5, 6], 'dtype': 'float64',
+             'lengths': [110], 'strategies': [metadata(1.0, 0.5)]}
+    np.savez(library_name, values=np.zeros((2, 5, 5, 110)), index=np.array(json.dumps(index)))
+    with pytest.raises(ValueError):
+        read_strategy_library(library_name)